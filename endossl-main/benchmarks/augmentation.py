@@ -0,0 +1,63 @@
+"""Throughput comparison between the per-sample augmentation path (double decoding and randaug on each image) and the
+batched augmentation of data/batched_augment.py. Run it from the endossl-main folder with
+
+    python benchmarks/augmentation.py --data_root cholec80
+
+without --data_root only the augmentation of in-memory frames is measured.
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import torch
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data import cholec80_images
+from data.batched_augment import BatchedRandAugment
+from benchmarks.common import time_fn, loader_throughput
+
+
+def benchmark_augment_only(batch_size: int = 64, repeats: int = 5) -> dict:
+    """Time the generation of two augmented views for a batch of already decoded frames."""
+    images = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8)
+    augment = BatchedRandAugment()
+
+    def per_sample():
+        return [(cholec80_images.randaug(img), cholec80_images.randaug(img)) for img in images]
+
+    def batched():
+        return augment(images), augment(images)
+
+    results = {'per_sample': time_fn(per_sample, repeats), 'batched': time_fn(batched, repeats)}
+    for res in results.values():
+        res['samples_per_sec'] = batch_size / res['mean_s']
+    results['speedup'] = results['per_sample']['mean_s'] / results['batched']['mean_s']
+    return results
+
+
+def benchmark_loaders(data_root: str, batch_size: int = 64, num_batches: int = 10) -> dict:
+    """Compare the samples per second of the training dataloader with and without the batched augmentation."""
+    results = {}
+    for name, batched in (('per_sample', False), ('batched', True)):
+        loader = cholec80_images.get_pytorch_dataloaders(data_root, batch_size, double_img=True,
+                                                         batched_augment=batched)['train']
+        results[name] = loader_throughput(loader, num_batches)
+    results['speedup'] = results['batched']['samples_per_sec'] / results['per_sample']['samples_per_sec']
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', default=None)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_batches', type=int, default=10)
+    args = parser.parse_args()
+
+    results = {'augment_only': benchmark_augment_only(args.batch_size)}
+    if args.data_root is not None:
+        results['dataloader'] = benchmark_loaders(args.data_root, args.batch_size, args.num_batches)
+    print(json.dumps(results, indent=2))
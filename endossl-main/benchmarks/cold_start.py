@@ -0,0 +1,120 @@
+"""Cold-start time of MyViTMSNModel: time from the start of a new process to the end of the first forward, split in
+the imports, the construction of the model and the first forward. Each mode is run in a new Python process:
+
+- hub: the previous construction, AutoImageProcessor.from_pretrained and ViTMSNModel.from_pretrained with the model
+  name, that checks the Hugging Face hub at each construction;
+- hf_local: the same Hugging Face loading but from the local model folder, i.e. the previous construction without the
+  network latency;
+- cache: MyViTMSNModel built from the local model cache, see models/model_cache.py;
+- config_only: MyViTMSNModel built only from the cached configuration, with load_weights=False.
+
+With --random_weights the model cache is filled with a randomly initialized ViT-small in a temporary folder, so the
+benchmark runs without network access (the hub mode is skipped). Run it from the endossl-main folder with
+
+    python benchmarks/cold_start.py --repeats 3
+"""
+
+import time
+
+_START = time.perf_counter()
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+MODES = ('hub', 'hf_local', 'cache', 'config_only')
+
+
+def _child(mode: str, model_name: str) -> dict:
+    """Body of the benchmark process of a mode, returning the times measured from the start of the process."""
+    import torch
+    from models import model_cache
+    from models.MyViTMSN import MyViTMSNModel
+    from models.preprocessing import ViTImagePreprocessor
+    imported = time.perf_counter()
+
+    if mode in ('hub', 'hf_local'):
+        from transformers import AutoImageProcessor, ViTMSNModel
+        name = model_name if mode == 'hub' else model_cache.model_dir(model_name)
+        model = torch.nn.Module()
+        model.preprocess = ViTImagePreprocessor.from_image_processor(AutoImageProcessor.from_pretrained(name))
+        model.vitMsn = ViTMSNModel.from_pretrained(name)
+        forward = lambda x: model.vitMsn(model.preprocess(x))[0][:, 0]
+    else:
+        model = MyViTMSNModel(model_name, load_weights=mode == 'cache')
+        forward = model
+    model.eval()
+    built = time.perf_counter()
+
+    with torch.no_grad():
+        forward(torch.randint(0, 256, (1, 3, 224, 224), dtype=torch.uint8))
+    done = time.perf_counter()
+    return {'import_s': imported - _START, 'build_s': built - imported, 'first_forward_s': done - built,
+            'total_s': done - _START}
+
+
+def fill_random_cache(cache_root: str, model_name: str) -> str:
+    """Save in the model cache a ViT-small with random weights and the ViT-MSN image processor configuration, as
+    model_cache.download would do with the real model."""
+    from transformers import ViTMSNConfig, ViTMSNModel, ViTImageProcessor
+    os.environ['ENDOSSL_MODEL_CACHE'] = cache_root
+    from models import model_cache
+    directory = model_cache.model_dir(model_name)
+    config = ViTMSNConfig(num_hidden_layers=12, hidden_size=384, num_attention_heads=6, intermediate_size=1536)
+    ViTMSNModel(config).save_pretrained(directory, safe_serialization=True)
+    ViTImageProcessor(image_mean=[0.485, 0.456, 0.406], image_std=[0.229, 0.224, 0.225]).save_pretrained(directory)
+    return directory
+
+
+def benchmark_cold_start(modes=MODES, repeats: int = 3, model_name: str = 'facebook/vit-msn-small') -> dict:
+    """Run each mode repeats times in new processes and return the mean of each time, together with the wall time of
+    the whole process (interpreter start included)."""
+    results = {}
+    for mode in modes:
+        runs = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            out = subprocess.run([sys.executable, os.path.realpath(__file__), '--child', mode, '--model', model_name],
+                                 capture_output=True, text=True)
+            process_s = time.perf_counter() - start
+            if out.returncode != 0:
+                runs = None
+                results[mode] = {'error': out.stderr.strip().splitlines()[-1] if out.stderr.strip() else 'failed'}
+                break
+            runs.append({**json.loads(out.stdout.strip().splitlines()[-1]), 'process_s': process_s})
+        if runs:
+            results[mode] = {key: sum(run[key] for run in runs) / len(runs) for key in runs[0]}
+            results[mode]['repeats'] = repeats
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=MODES)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--model', default='facebook/vit-msn-small')
+    parser.add_argument('--random_weights', action='store_true', help='use a random model in a temporary cache')
+    parser.add_argument('--child', default=None, choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(_child(args.child, args.model)))
+        sys.exit(0)
+
+    modes = args.modes
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.random_weights:
+            fill_random_cache(tmp_dir, args.model)
+            modes = [m for m in modes if m != 'hub']
+        else:
+            from models import model_cache
+            if not model_cache.is_cached(args.model):
+                model_cache.download(args.model)
+        results = benchmark_cold_start(modes, args.repeats, args.model)
+    print(json.dumps(results, indent=2))
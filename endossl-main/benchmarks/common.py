@@ -0,0 +1,29 @@
+"""Helpers shared by the benchmark scripts of this folder. The timing of a function and the measure of the peak memory
+are the ones of the training code, in down_stream/instrumentation.py and down_stream/memory_budget.py."""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from down_stream.instrumentation import time_fn
+from down_stream.memory_budget import reset_peak_memory, peak_memory_mb
+
+
+def loader_throughput(loader, num_batches: int = 20, warmup: int = 2) -> dict:
+    """Iterate over num_batches batches of the loader, after warmup batches, and return the samples per second. The
+    number of samples of a batch is the length of its first element."""
+    iterator = iter(loader)
+    for _ in range(warmup):
+        next(iterator)
+
+    samples, batches = 0, 0
+    start = time.perf_counter()
+    for batch in iterator:
+        samples += len(batch[0])
+        batches += 1
+        if batches == num_batches:
+            break
+    seconds = time.perf_counter() - start
+    return {'samples_per_sec': samples / seconds, 'batches': batches, 'seconds': seconds}
@@ -0,0 +1,144 @@
+"""Epoch time and linear probe quality of the MSN pretraining over all the frames and with the ClusterSampler over the
+near-duplicate clusters of data/dedup.py. For each sampling the same small ViT-MSN model is pretrained for a few epochs,
+then a linear classifier of the phases is trained on the frozen CLS features of the target ViT of the training videos
+and evaluated with the macro F1 score on the test videos. Run it from the endossl-main folder with
+
+    python benchmarks/dedup.py --data_root cholec80 --train_videos 1 2 3 4 --test_videos 49 50 --epochs 2
+
+without --data_root it is used a synthetic dataset, see data/synthetic.py, where the F1 score only checks that the
+pipeline works.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from torchmetrics.classification import MulticlassF1Score
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data import cholec80_images
+from data import dedup
+from data.synthetic import generate_synthetic_cholec80
+from data.batched_augment import BatchedRandAugment, BatchedAugmentCollate
+from models.MyViTMSN_pretraining import MyViTMSNModel_pretraining
+from models.msn_loss import MSNLoss
+from benchmarks.suite import small_vit_config, local_image_processor
+
+
+def pretrain(dataset, sampler, config, epochs: int = 2, batch_size: int = 16, seed: int = 0) -> dict:
+    """Pretrain a ViT-MSN model on the dataset, with the sampler or with a shuffle over all the frames, returning the
+    model and the time of each epoch."""
+    torch.manual_seed(seed)
+    loader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, shuffle=sampler is None, drop_last=True,
+                        collate_fn=BatchedAugmentCollate(BatchedRandAugment(), num_views=2))
+    model = MyViTMSNModel_pretraining(ipe=len(loader), num_epochs=epochs, config=config,
+                                      image_processor=local_image_processor())
+    model.train()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-3, weight_decay=0.01)
+    criterion = MSNLoss()
+
+    epoch_seconds = []
+    for epoch in range(epochs):
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+        start = time.perf_counter()
+        for inputs_anchor, inputs_target, _ in loader:
+            optimizer.zero_grad()
+            criterion(*model(inputs_anchor, inputs_target)).backward()
+            optimizer.step()
+            model.exponential_moving_average()
+        epoch_seconds.append(time.perf_counter() - start)
+    return {'model': model, 'epoch_seconds': epoch_seconds, 'steps_per_epoch': len(loader)}
+
+
+def extract_features(model: MyViTMSNModel_pretraining, dataset, batch_size: int = 64) -> (torch.Tensor, torch.Tensor):
+    """Return the CLS features of the target ViT and the labels of all the frames of the dataset."""
+    features, labels = [], []
+    with torch.inference_mode():
+        for inputs, batch_labels in DataLoader(dataset, batch_size=batch_size):
+            features.append(model.vitMsn_target(model.preprocess(inputs))[0][:, 0])
+            labels.append(batch_labels)
+    return torch.cat(features), torch.cat(labels)
+
+
+def linear_probe_f1(train_features, train_labels, test_features, test_labels, num_classes: int = 7,
+                    steps: int = 300) -> float:
+    """Train a linear classifier on the standardized features with full-batch AdamW and return the macro F1 score on the
+    test features."""
+    mean, std = train_features.mean(dim=0), train_features.std(dim=0) + 1e-6
+    probe = nn.Linear(train_features.shape[1], num_classes)
+    optimizer = torch.optim.AdamW(probe.parameters(), lr=1e-2, weight_decay=1e-4)
+    for _ in range(steps):
+        optimizer.zero_grad()
+        nn.functional.cross_entropy(probe((train_features - mean) / std), train_labels).backward()
+        optimizer.step()
+    with torch.no_grad():
+        predictions = probe((test_features - mean) / std)
+    return MulticlassF1Score(num_classes=num_classes, average='macro')(predictions, test_labels).item()
+
+
+def benchmark_dedup(data_root: str, train_ids: list, test_ids: list, epochs: int = 2, batch_size: int = 16,
+                    max_distance: int = 10, samples_per_cluster: int = 1, config=None,
+                    split_on_labels: bool = False) -> dict:
+    """Compare the pretraining over all the frames with the one over the near-duplicate clusters, building the index
+    of the training videos if needed."""
+    config = config or small_vit_config()
+    train_dataset = cholec80_images.CustomCholec80Dataset(data_root, train_ids)
+    start = time.perf_counter()
+    dedup.build_dedup_index(train_dataset, max_distance=max_distance, split_on_labels=split_on_labels)
+    index_seconds = time.perf_counter() - start
+    clusters = dedup.dataset_clusters(train_dataset, dedup.load_dedup_index(data_root, train_ids))
+
+    probe_train = cholec80_images.CustomCholec80Dataset(data_root, train_ids)
+    probe_test = cholec80_images.CustomCholec80Dataset(data_root, test_ids)
+    results = {'frames': len(clusters), 'num_clusters': int(len(np.unique(clusters))), 'index_seconds': index_seconds,
+               'max_distance': max_distance, 'samples_per_cluster': samples_per_cluster,
+               'split_on_labels': split_on_labels}
+    for name, sampler in (('all_frames', None), ('clusters', dedup.ClusterSampler(clusters, samples_per_cluster))):
+        run = pretrain(train_dataset, sampler, config, epochs, batch_size)
+        train_features, train_labels = extract_features(run['model'], probe_train)
+        test_features, test_labels = extract_features(run['model'], probe_test)
+        results[name] = {'epoch_seconds': float(np.mean(run['epoch_seconds'])),
+                         'steps_per_epoch': run['steps_per_epoch'],
+                         'linear_probe_f1': linear_probe_f1(train_features, train_labels, test_features, test_labels)}
+    full, clustered = results['all_frames'], results['clusters']
+    results['epoch_time_reduction'] = 1. - clustered['epoch_seconds'] / full['epoch_seconds']
+    results['linear_probe_f1_change'] = clustered['linear_probe_f1'] - full['linear_probe_f1']
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', default=None, help='dataset folder, default a temporary synthetic dataset')
+    parser.add_argument('--train_videos', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--test_videos', type=int, nargs='+', default=[4])
+    parser.add_argument('--frames_per_video', type=int, default=100, help='frames of the synthetic videos')
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--max_distance', type=int, default=10)
+    parser.add_argument('--samples_per_cluster', type=int, default=1)
+    parser.add_argument('--num_hidden_layers', type=int, default=2)
+    parser.add_argument('--split_on_labels', action='store_true', help='cut the clusters also at the phase changes')
+    args = parser.parse_args()
+
+    train_ids = [f'video{i:02}' for i in args.train_videos]
+    test_ids = [f'video{i:02}' for i in args.test_videos]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_root = args.data_root
+        if data_root is None:
+            data_root = tmp_dir
+            generate_synthetic_cholec80(data_root, max(args.train_videos + args.test_videos), args.frames_per_video,
+                                        height=240, width=427)
+        results = benchmark_dedup(data_root, train_ids, test_ids, args.epochs, args.batch_size, args.max_distance,
+                                  args.samples_per_cluster, small_vit_config(args.num_hidden_layers),
+                                  args.split_on_labels)
+    print(json.dumps(results, indent=2))
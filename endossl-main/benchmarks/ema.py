@@ -0,0 +1,60 @@
+"""Cost per step of the EMA update of the target ViT, comparing the previous per-parameter Python loop with the
+multi-tensor foreach update of MyViTMSNModel_pretraining.exponential_moving_average. Run it from the endossl-main
+folder with
+
+    python benchmarks/ema.py
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import torch
+from transformers import ViTMSNModel, ViTConfig
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from benchmarks.common import time_fn
+
+
+def ema_loop(anchor, target, m: float):
+    """Previous implementation of the EMA update, with a temporary tensor for each parameter."""
+    with torch.no_grad():
+        for param_q, param_k in zip(anchor.parameters(), target.parameters()):
+            param_k.data.mul_(m).add_((1. - m) * param_q.detach().data)
+
+
+def ema_foreach(anchor, target, m: float):
+    """Current implementation of the EMA update, a single foreach lerp over all the parameters."""
+    with torch.no_grad():
+        torch._foreach_lerp_([p.detach() for p in target.parameters()], [p.detach() for p in anchor.parameters()], 1. - m)
+
+
+def benchmark_ema(repeats: int = 20, device: str = 'cpu', config: ViTConfig = None) -> dict:
+    """Time the two EMA updates on a pair of ViT-MSN models with the configuration of the pretraining model."""
+    config = config or ViTConfig(num_hidden_layers=12, hidden_size=384, num_attention_heads=6, intermediate_size=1536)
+    anchor = ViTMSNModel(config).to(device)
+    target = ViTMSNModel(config).to(device)
+
+    def timed(fn):
+        def step():
+            fn(anchor, target, 0.996)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+        return step
+
+    results = {'loop': time_fn(timed(ema_loop), repeats), 'foreach': time_fn(timed(ema_foreach), repeats)}
+    results['num_parameters'] = sum(p.numel() for p in anchor.parameters())
+    results['speedup'] = results['loop']['mean_s'] / results['foreach']['mean_s']
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print(json.dumps(benchmark_ema(args.repeats, device), indent=2))
@@ -0,0 +1,100 @@
+"""Peak memory and throughput of a pretraining step with the same effective batch size and different micro-batch sizes,
+with and without the activation checkpointing of the anchor encoder. Each setting is measured in a new process, so the
+peak memory of a setting is not affected by the previous ones. Optionally it is also run the probe of the largest
+micro-batch that fits in a memory budget. Run it from the endossl-main folder with
+
+    python benchmarks/memory_budget.py --batch_size 32 --micro_batch_size 32 16 8 --memory_budget_mb 4000
+"""
+
+import os
+import sys
+import json
+import argparse
+import multiprocessing
+
+import torch
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from models.MyViTMSN_pretraining import MyViTMSNModel_pretraining
+from models.msn_loss import MSNLoss
+from down_stream import precision
+from down_stream import ViT_pretraining
+from benchmarks.common import time_fn, reset_peak_memory, peak_memory_mb
+
+
+def benchmark_setting(batch_size: int = 32, micro_batch_size: int = 32, gradient_checkpointing: bool = False,
+                      repeats: int = 3, device: str = 'cpu') -> dict:
+    """Measure the step time, the samples per second and the peak memory of the forward and backward of a batch of
+    batch_size random images, accumulating the gradients over micro-batches of micro_batch_size images."""
+    model = MyViTMSNModel_pretraining(ipe=1, num_epochs=1, device=device,
+                                      gradient_checkpointing=gradient_checkpointing).to(device)
+    model.train()
+    scaler = precision.grad_scaler(ViT_pretraining.Config.precision, device)
+    criterion = MSNLoss()
+    img_anchor = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+    img_target = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+
+    def step():
+        if micro_batch_size < batch_size:
+            ViT_pretraining.accumulate_gradients(model, model, criterion, img_anchor, img_target, micro_batch_size,
+                                                 scaler, device)
+        else:
+            output_anchor, output_target = model(img_anchor, img_target)
+            criterion(output_anchor, output_target).backward()
+        model.zero_grad(set_to_none=True)
+
+    step()
+    reset_peak_memory()
+    result = time_fn(step, repeats, warmup=0)
+    result.update({'batch_size': batch_size, 'micro_batch_size': micro_batch_size,
+                   'gradient_checkpointing': gradient_checkpointing, 'peak_memory_mb': peak_memory_mb(),
+                   'samples_per_sec': batch_size / result['mean_s']})
+    return result
+
+
+def _run_setting(kwargs: dict) -> dict:
+    return benchmark_setting(**kwargs)
+
+
+def benchmark_memory_budget(batch_size: int = 32, micro_batch_sizes=(32, 16, 8), checkpointing=(False, True),
+                            repeats: int = 3, device: str = 'cpu') -> list:
+    """Measure all the combinations of micro-batch size and activation checkpointing, each one in a new process."""
+    settings = [{'batch_size': batch_size, 'micro_batch_size': m, 'gradient_checkpointing': c, 'repeats': repeats,
+                 'device': device} for c in checkpointing for m in micro_batch_sizes]
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for setting in settings:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(_run_setting, (setting,)))
+    return results
+
+
+def benchmark_probe(memory_budget_mb: float, batch_size: int = 32, gradient_checkpointing: bool = False,
+                    device: str = 'cpu') -> int:
+    """Run the probe of the training script for the memory budget in input and return the micro-batch size found."""
+    ViT_pretraining.Config.batch_size = batch_size
+    model = MyViTMSNModel_pretraining(ipe=1, num_epochs=1, device=device,
+                                      gradient_checkpointing=gradient_checkpointing).to(device)
+    model.train()
+    return ViT_pretraining.probe_micro_batch_size(model, MSNLoss(), [p for p in model.parameters() if p.requires_grad],
+                                                  device, memory_budget_mb)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--micro_batch_size', type=int, nargs='+', default=[32, 16, 8])
+    parser.add_argument('--no_checkpointing', action='store_true', help='measure only without checkpointing')
+    parser.add_argument('--memory_budget_mb', type=float, default=None)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    checkpointing = (False,) if args.no_checkpointing else (False, True)
+    results = {'settings': benchmark_memory_budget(args.batch_size, args.micro_batch_size, checkpointing,
+                                                   args.repeats, device)}
+    if args.memory_budget_mb is not None:
+        results['probe_micro_batch_size'] = benchmark_probe(args.memory_budget_mb, args.batch_size, device=device)
+    print(json.dumps(results, indent=2))
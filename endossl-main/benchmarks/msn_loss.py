@@ -0,0 +1,122 @@
+"""Peak memory and step time of the MSN pretraining step with the previous loss and with MSNLoss (models/msn_loss.py).
+
+The previous step recorded the target branch with autograd, since the prototypes require gradients, passed the anchor
+probabilities to nn.CrossEntropyLoss, that applies another log_softmax on them, and computed the regularizations
+with the logarithm of the clamped probabilities. The current step runs the target branch in inference mode and
+computes the whole loss from one log_softmax of the anchor logits. Each step is measured in a new process, so the peak
+memory of one implementation is not affected by the other. It is also timed the loss alone, forward and backward from
+fixed CLS features, where the two implementations differ. Run it from the endossl-main folder with
+
+    python benchmarks/msn_loss.py --batch_size 200 --num_layers 12
+"""
+
+import os
+import sys
+import json
+import math
+import argparse
+import multiprocessing
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from models.MyViTMSN_pretraining import MyViTMSNModel_pretraining
+from models.msn_loss import MSNLoss
+from benchmarks.suite import small_vit_config, local_image_processor
+from benchmarks.common import time_fn, reset_peak_memory, peak_memory_mb
+
+IMPLEMENTATIONS = ('previous', 'msn_loss')
+
+
+def previous_loss(anchor_probabilities: torch.Tensor, target_probabilities: torch.Tensor) -> torch.Tensor:
+    """Previous loss of ViT_pretraining: cross entropy of the probabilities, ME-MAX and entropy with the logarithm of
+    the clamped probabilities."""
+    avg_anchor = torch.mean(anchor_probabilities, dim=0)
+    me_max = torch.sum(avg_anchor * torch.log(avg_anchor.clamp_min(1e-12))) + math.log(float(len(avg_anchor)))
+    entropy = torch.mean(torch.sum(-anchor_probabilities * torch.log(anchor_probabilities.clamp_min(1e-12)), dim=1))
+    return nn.functional.cross_entropy(anchor_probabilities, target_probabilities) + 5 * me_max + entropy
+
+
+def previous_target_output(model: MyViTMSNModel_pretraining, img_target: torch.Tensor) -> torch.Tensor:
+    """Previous target branch, recorded by autograd and without sharpening."""
+    output_target = model.vitMsn_target(model.preprocess(img_target))[0]
+    output_target = nn.functional.normalize(output_target[:, 0, :])
+    return nn.functional.softmax(output_target @ model.prototypes.T / model.tau, dim=1)
+
+
+def benchmark_step(implementation: str, batch_size: int = 200, num_layers: int = 12, repeats: int = 3,
+                   device: str = 'cpu') -> dict:
+    """Measure the time and the peak memory of the forward and backward of a batch of random images with the
+    ViT-small configuration of the pretraining model and num_layers layers."""
+    config = small_vit_config(num_hidden_layers=num_layers, hidden_size=384, num_attention_heads=6)
+    model = MyViTMSNModel_pretraining(ipe=1, num_epochs=1, device=device, config=config,
+                                      image_processor=local_image_processor()).to(device)
+    model.train()
+    criterion = MSNLoss()
+    img_anchor = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+    img_target = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+
+    def step():
+        if implementation == 'previous':
+            loss = previous_loss(model.anchor_output(img_anchor), previous_target_output(model, img_target))
+        else:
+            loss = criterion(*model(img_anchor, img_target))
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+
+    step()
+    reset_peak_memory()
+    result = time_fn(step, repeats, warmup=0)
+    result.update({'implementation': implementation, 'batch_size': batch_size, 'num_layers': num_layers,
+                   'peak_memory_mb': peak_memory_mb(), 'samples_per_sec': batch_size / result['mean_s']})
+    return result
+
+
+def benchmark_loss_only(batch_size: int = 200, num_prototypes: int = 1024, hidden_size: int = 384,
+                        repeats: int = 20) -> dict:
+    """Time the projection on the prototypes and the loss, forward and backward, from fixed CLS features."""
+    anchor = torch.randn(batch_size, hidden_size, requires_grad=True)
+    target = torch.randn(batch_size, hidden_size)
+    prototypes = nn.Parameter(torch.randn(num_prototypes, hidden_size))
+    criterion = MSNLoss()
+
+    def previous():
+        anchor_probabilities = nn.functional.softmax(nn.functional.normalize(anchor) @ prototypes.T / 0.1, dim=1)
+        target_probabilities = nn.functional.softmax(nn.functional.normalize(target) @ prototypes.T / 0.1, dim=1)
+        previous_loss(anchor_probabilities, target_probabilities).backward()
+
+    def current():
+        with torch.inference_mode():
+            target_logits = nn.functional.normalize(target) @ prototypes.T / (0.1 * 0.25)
+            target_probabilities = nn.functional.softmax(target_logits, dim=1)
+        criterion(nn.functional.normalize(anchor) @ prototypes.T / 0.1, target_probabilities.clone()).backward()
+
+    return {'previous': time_fn(previous, repeats), 'msn_loss': time_fn(current, repeats)}
+
+
+def _run_step(kwargs: dict) -> dict:
+    return benchmark_step(**kwargs)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=200)
+    parser.add_argument('--num_layers', type=int, default=12, help='layers of the two ViTs, fewer for less memory')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    results = {'loss_only': benchmark_loss_only(args.batch_size), 'step': {}}
+    context = multiprocessing.get_context('spawn')
+    for implementation in IMPLEMENTATIONS:
+        with context.Pool(1) as pool:
+            results['step'][implementation] = pool.apply(_run_step, ({
+                'implementation': implementation, 'batch_size': args.batch_size, 'num_layers': args.num_layers,
+                'repeats': args.repeats, 'device': device},))
+    previous, current = results['step']['previous'], results['step']['msn_loss']
+    results['step_speedup'] = previous['mean_s'] / current['mean_s']
+    results['peak_memory_reduction_mb'] = previous['peak_memory_mb'] - current['peak_memory_mb']
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,55 @@
+"""Step time and peak memory of the MSN pretraining model with and without the dropping of the masked patches in the
+anchor branch. Run it from the endossl-main folder with
+
+    python benchmarks/patch_dropping.py --batch_size 32
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import torch
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from models.MyViTMSN_pretraining import MyViTMSNModel_pretraining
+from benchmarks.common import time_fn, reset_peak_memory, peak_memory_mb
+
+
+def benchmark_patch_dropping(batch_size: int = 32, mask_ratio: float = 0.5, repeats: int = 5, device: str = 'cpu') -> dict:
+    """Measure a forward and backward step of the pretraining model for the two anchor paths."""
+    img_anchor = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+    img_target = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+
+    results = {}
+    for name, drop in (('mask_tokens', False), ('dropped_patches', True)):
+        model = MyViTMSNModel_pretraining(ipe=1, num_epochs=1, device=device, mask_ratio=mask_ratio,
+                                          drop_masked_patches=drop).to(device)
+
+        def step():
+            output_anchor, output_target = model(img_anchor, img_target)
+            output_anchor.sum().backward()
+            model.zero_grad(set_to_none=True)
+
+        step()
+        reset_peak_memory()
+        results[name] = time_fn(step, repeats, warmup=0)
+        results[name]['peak_memory_mb'] = peak_memory_mb()
+        del model
+
+    results['speedup'] = results['mask_tokens']['mean_s'] / results['dropped_patches']['mean_s']
+    results['memory_saving_mb'] = results['mask_tokens']['peak_memory_mb'] - results['dropped_patches']['peak_memory_mb']
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--mask_ratio', type=float, default=0.5)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print(json.dumps(benchmark_patch_dropping(args.batch_size, args.mask_ratio, args.repeats, device), indent=2))
@@ -0,0 +1,79 @@
+"""Throughput and accuracy of the mixed precision modes of the training scripts, compared with fp32 on the same data.
+For each precision it is measured the time of a training step of the MSN pretraining model, the loss on the same batch
+and masks, and the agreement of the anchor predictions with the fp32 ones. Run it from the endossl-main folder with
+
+    python benchmarks/precision.py --batch_size 32 --precision fp32 bf16
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import torch
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from models.MyViTMSN_pretraining import MyViTMSNModel_pretraining
+from down_stream import precision as precision_utils
+from models.msn_loss import MSNLoss
+from benchmarks.common import time_fn
+
+
+def benchmark_precision(batch_size: int = 32, precisions=('fp32', 'bf16'), channels_last: bool = False,
+                        repeats: int = 3, device: str = 'cpu', images=None) -> dict:
+    """Compare the precisions in input on the same batch of images, by default random uint8 frames."""
+    if images is None:
+        images = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8)
+    images = precision_utils.to_channels_last(images.to(device), channels_last)
+
+    base_state = MyViTMSNModel_pretraining(ipe=1, num_epochs=1, device=device).state_dict()
+    criterion = MSNLoss()
+
+    results, reference = {}, None
+    for name in precisions:
+        model = MyViTMSNModel_pretraining(ipe=1, num_epochs=1, device=device)
+        model.load_state_dict(base_state)
+        model.to(device)
+        if channels_last:
+            model.to(memory_format=torch.channels_last)
+        scaler = precision_utils.grad_scaler(name, device)
+
+        def loss_fn():
+            torch.manual_seed(0)
+            with precision_utils.autocast(name, device):
+                output_anchor, output_target = model(images, images)
+            output_anchor = output_anchor.float()
+            return criterion(output_anchor, output_target), output_anchor
+
+        def step():
+            loss, _ = loss_fn()
+            scaler.scale(loss).backward()
+            model.zero_grad(set_to_none=True)
+
+        results[name] = time_fn(step, repeats, warmup=1)
+        results[name]['samples_per_sec'] = len(images) / results[name]['mean_s']
+        with torch.no_grad():
+            loss, output_anchor = loss_fn()
+        results[name]['loss'] = loss.item()
+        if reference is None:
+            reference = (loss.item(), output_anchor.argmax(dim=1))
+        else:
+            results[name]['loss_abs_diff'] = abs(loss.item() - reference[0])
+            results[name]['argmax_agreement'] = (output_anchor.argmax(dim=1) == reference[1]).float().mean().item()
+            results[name]['speedup'] = results[precisions[0]]['mean_s'] / results[name]['mean_s']
+        del model
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--precision', nargs='+', default=['fp32', 'bf16'])
+    parser.add_argument('--channels_last', action='store_true')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print(json.dumps(benchmark_precision(args.batch_size, args.precision, args.channels_last, args.repeats, device), indent=2))
@@ -0,0 +1,54 @@
+"""Throughput of the training dataloader for the different storage backends of get_pytorch_dataloaders: the per-file
+PNG path, the memory-mapped frame store and the tar shards. Run it from the endossl-main folder with
+
+    python benchmarks/storage.py --data_root cholec80 --storage png memmap shards
+
+the frame store and the shards must be already created in their default folders, or passed with --memmap_dir and
+--shards_dir. The shards reader fills its shuffle buffer during the warmup batches, so the measured batches should
+contain many more samples than cholec80_images._SHARD_SHUFFLE_BUFFER.
+"""
+
+import os
+import sys
+import json
+import argparse
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data import cholec80_images
+from benchmarks.common import loader_throughput
+
+
+def benchmark_storage(data_root: str, storages=('png', 'shards'), storage_dirs=None, batch_size: int = 64,
+                      num_batches: int = 20, loader_options=None) -> dict:
+    """Measure the samples per second of the training dataloader for each storage backend. The speedup of each backend
+    is relative to the 'png' one, if it is measured."""
+    storage_dirs = storage_dirs or {}
+    results = {}
+    for storage in storages:
+        loader = cholec80_images.get_pytorch_dataloaders(data_root, batch_size, storage=storage,
+                                                         storage_dir=storage_dirs.get(storage),
+                                                         loader_options=loader_options)['train']
+        results[storage] = loader_throughput(loader, num_batches)
+
+    if 'png' in results:
+        for storage in storages:
+            results[storage]['speedup'] = results[storage]['samples_per_sec'] / results['png']['samples_per_sec']
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', default=os.path.join('cholec80'))
+    parser.add_argument('--storage', nargs='+', default=['png', 'shards'])
+    parser.add_argument('--memmap_dir', default=None)
+    parser.add_argument('--shards_dir', default=None)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_batches', type=int, default=20)
+    parser.add_argument('--num_workers', type=int, default=0)
+    args = parser.parse_args()
+
+    results = benchmark_storage(args.data_root, args.storage, {'memmap': args.memmap_dir, 'shards': args.shards_dir},
+                                args.batch_size, args.num_batches, {'num_workers': args.num_workers})
+    print(json.dumps(results, indent=2))
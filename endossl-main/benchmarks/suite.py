@@ -0,0 +1,273 @@
+"""Offline benchmark suite of the data pipeline and of the models, on a synthetic Cholec80 dataset (see
+data/synthetic.py) and on ViT-MSN models built from a local configuration, so it needs neither the real videos nor
+the Hugging Face hub. It measures:
+
+- indexing: building the index of the frames and reading it from the index cache;
+- decode: samples per second of the PNG decoding with resize, of the double randaug path and of the batched
+  augmentation training loader;
+- classifier: forward and training step time of MyViTMSNModel with the frozen backbone;
+- pretraining: forward and training step time of MyViTMSNModel_pretraining, and the cost of its EMA update;
+- epoch: end-to-end time of a pretraining epoch over the synthetic training videos.
+
+The results are saved as JSON, together with the versions and the settings of the run, and can be compared with the
+ones of a previous run. Run it from the endossl-main folder with
+
+    python benchmarks/suite.py --output suite.json
+    python benchmarks/suite.py --output suite_new.json --compare suite.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from transformers import ViTConfig, ViTImageProcessor
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data import cholec80_images
+from data.synthetic import generate_synthetic_cholec80
+from data.batched_augment import BatchedRandAugment, BatchedAugmentCollate
+from models.MyViTMSN import MyViTMSNModel
+from models.MyViTMSN_pretraining import MyViTMSNModel_pretraining
+from models.msn_loss import MSNLoss
+from benchmarks.common import time_fn, loader_throughput
+
+# mean and standard deviation of the 'facebook/vit-msn-small' image processor
+_IMAGE_MEAN = [0.485, 0.456, 0.406]
+_IMAGE_STD = [0.229, 0.224, 0.225]
+
+
+def small_vit_config(num_hidden_layers: int = 2, hidden_size: int = 192, num_attention_heads: int = 3) -> ViTConfig:
+    return ViTConfig(num_hidden_layers=num_hidden_layers, hidden_size=hidden_size,
+                     num_attention_heads=num_attention_heads, intermediate_size=4 * hidden_size)
+
+
+def local_image_processor() -> ViTImageProcessor:
+    """Image processor with the parameters of the ViT-MSN one, built without downloading it."""
+    return ViTImageProcessor(image_mean=_IMAGE_MEAN, image_std=_IMAGE_STD)
+
+
+def _synchronize(device: str):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+
+def benchmark_indexing(data_root: str, video_ids: list, repeats: int = 3) -> dict:
+    """Time the construction of the dataset index without the cache, and with a valid index cache."""
+    def build():
+        cholec80_images.CustomCholec80Dataset(data_root, video_ids, use_index_cache=False)
+
+    def cached():
+        cholec80_images.CustomCholec80Dataset(data_root, video_ids, use_index_cache=True)
+
+    cached()
+    num_frames = len(cholec80_images.CustomCholec80Dataset(data_root, video_ids, use_index_cache=False))
+    return {'build': time_fn(build, repeats, warmup=1), 'cached': time_fn(cached, repeats, warmup=1),
+            'num_frames': num_frames}
+
+
+def benchmark_decode(data_root: str, video_ids: list, num_samples: int = 32, batch_size: int = 8) -> dict:
+    """Samples per second of the decoding of the frames with resize, of the two randaug views of the per-sample
+    training path, and of the training loader with the batched augmentation."""
+    results = {}
+    for name, transformation, double_img in (('decode_resize', 'resize', False), ('randaug_double', 'randaug', True)):
+        dataset = cholec80_images.CustomCholec80Dataset(
+            data_root, video_ids, transform=cholec80_images.get_train_image_transformation(transformation),
+            double_img=double_img)
+        indices = [i % len(dataset) for i in range(num_samples)]
+        start = time.perf_counter()
+        for i in indices:
+            dataset[i]
+        seconds = time.perf_counter() - start
+        results[name] = {'samples_per_sec': num_samples / seconds, 'seconds': seconds}
+
+    dataset = cholec80_images.CustomCholec80Dataset(data_root, video_ids)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0,
+                        collate_fn=BatchedAugmentCollate(BatchedRandAugment(), num_views=2))
+    results['batched_augment_loader'] = loader_throughput(loader, max(1, num_samples // batch_size), warmup=1)
+    return results
+
+
+def benchmark_classifier(config: ViTConfig, batch_size: int = 8, repeats: int = 5, device: str = 'cpu') -> dict:
+    """Time the forward and the training step of MyViTMSNModel, with the backbone frozen as in the classifier
+    training, on random uint8 frames."""
+    model = MyViTMSNModel(device=device, config=config, image_processor=local_image_processor())
+    model.classifier = nn.Linear(model.classifier.in_features, len(cholec80_images._LABEL_NUM_MAPPING))
+    for param in model.vitMsn.parameters():
+        param.requires_grad = False
+    model.to(device)
+    optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+    inputs = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+    labels = torch.randint(0, model.classifier.out_features, (batch_size,), device=device)
+
+    def forward():
+        with torch.no_grad():
+            model(inputs)
+        _synchronize(device)
+
+    def train_step():
+        optimizer.zero_grad()
+        loss = nn.functional.cross_entropy(model(inputs), labels)
+        loss.backward()
+        optimizer.step()
+        _synchronize(device)
+
+    model.eval()
+    results = {'forward': time_fn(forward, repeats)}
+    model.train()
+    results['train_step'] = time_fn(train_step, repeats)
+    for res in results.values():
+        res['samples_per_sec'] = batch_size / res['mean_s']
+    return results
+
+
+def benchmark_pretraining(config: ViTConfig, batch_size: int = 8, repeats: int = 5, device: str = 'cpu') -> dict:
+    """Time the forward, the training step (forward, loss, backward and optimizer step) and the EMA update of
+    MyViTMSNModel_pretraining, on random uint8 frames."""
+    model = MyViTMSNModel_pretraining(ipe=100, num_epochs=1, device=device, config=config,
+                                      image_processor=local_image_processor()).to(device)
+    model.train()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-3)
+    criterion = MSNLoss()
+    img_anchor = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+    img_target = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+
+    def forward():
+        with torch.no_grad():
+            model(img_anchor, img_target)
+        _synchronize(device)
+
+    def train_step():
+        optimizer.zero_grad()
+        output_anchor, output_target = model(img_anchor, img_target)
+        loss = criterion(output_anchor, output_target)
+        loss.backward()
+        optimizer.step()
+        _synchronize(device)
+
+    def ema():
+        model.exponential_moving_average()
+        _synchronize(device)
+
+    results = {'forward': time_fn(forward, repeats), 'train_step': time_fn(train_step, repeats)}
+    for res in results.values():
+        res['samples_per_sec'] = batch_size / res['mean_s']
+    results['ema'] = time_fn(ema, repeats)
+    return results
+
+
+def benchmark_epoch(data_root: str, video_ids: list, config: ViTConfig, batch_size: int = 8,
+                    device: str = 'cpu') -> dict:
+    """Time a whole pretraining epoch over the frames of video_ids: loading with the batched augmentation, forward,
+    backward, optimizer step and EMA, as in ViT_pretraining.training_loop."""
+    dataset = cholec80_images.CustomCholec80Dataset(data_root, video_ids)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=0, drop_last=True,
+                        collate_fn=BatchedAugmentCollate(BatchedRandAugment(), num_views=2))
+    model = MyViTMSNModel_pretraining(ipe=len(loader), num_epochs=1, device=device, config=config,
+                                      image_processor=local_image_processor()).to(device)
+    model.train()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-3)
+    criterion = MSNLoss()
+
+    start = time.perf_counter()
+    steps = 0
+    for inputs_anchor, inputs_target, _ in loader:
+        optimizer.zero_grad()
+        output_anchor, output_target = model(inputs_anchor.to(device), inputs_target.to(device))
+        loss = criterion(output_anchor, output_target)
+        loss.backward()
+        optimizer.step()
+        model.exponential_moving_average()
+        steps += 1
+    _synchronize(device)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'steps': steps, 'samples_per_sec': steps * batch_size / seconds}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(data_root: str, num_videos: int = 4, frames_per_video: int = 32, batch_size: int = 8,
+              repeats: int = 5, config: ViTConfig = None, device: str = 'cpu') -> dict:
+    """Run all the benchmarks, generating the synthetic dataset in data_root if it does not contain one already."""
+    config = config or small_vit_config()
+    video_ids = [f'video{i:02}' for i in range(1, num_videos + 1)]
+    if not all(os.path.isdir(os.path.join(data_root, 'frames', v)) for v in video_ids):
+        generate_synthetic_cholec80(data_root, num_videos, frames_per_video)
+
+    results = {'metadata': {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'git_commit': _git_commit(), 'torch': torch.__version__,
+        'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+        'num_threads': torch.get_num_threads(), 'device': device,
+        'settings': {'data_root': data_root, 'num_videos': num_videos, 'batch_size': batch_size, 'repeats': repeats,
+                     'vit_config': {k: getattr(config, k) for k in ('num_hidden_layers', 'hidden_size',
+                                                                     'num_attention_heads', 'intermediate_size')}}
+    }}
+    results['indexing'] = benchmark_indexing(data_root, video_ids, repeats)
+    results['decode'] = benchmark_decode(data_root, video_ids, 4 * batch_size, batch_size)
+    results['classifier'] = benchmark_classifier(config, batch_size, repeats, device)
+    results['pretraining'] = benchmark_pretraining(config, batch_size, repeats, device)
+    results['epoch'] = benchmark_epoch(data_root, video_ids, config, batch_size, device)
+    return results
+
+
+def compare(previous: dict, current: dict, prefix: str = '') -> dict:
+    """Return the ratio current / previous of the timings (mean_s, seconds) and of the throughputs (samples_per_sec)
+    present in both the results, with the keys joined by '/'. A ratio above 1 is a regression for the timings and an
+    improvement for the throughputs."""
+    ratios = {}
+    for key, value in current.items():
+        if key == 'metadata' or key not in previous:
+            continue
+        if isinstance(value, dict):
+            ratios.update(compare(previous[key], value, prefix + key + '/'))
+        elif key in ('mean_s', 'seconds', 'samples_per_sec') and previous[key]:
+            ratios[prefix + key] = value / previous[key]
+    return ratios
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', default=None, help='synthetic dataset, generated if missing, default a '
+                                                          'temporary folder')
+    parser.add_argument('--num_videos', type=int, default=4)
+    parser.add_argument('--frames_per_video', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--num_hidden_layers', type=int, default=2)
+    parser.add_argument('--hidden_size', type=int, default=192)
+    parser.add_argument('--num_attention_heads', type=int, default=3)
+    parser.add_argument('--output', default='benchmark_suite.json')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    config = small_vit_config(args.num_hidden_layers, args.hidden_size, args.num_attention_heads)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = run_suite(args.data_root or tmp_dir, args.num_videos, args.frames_per_video, args.batch_size,
+                            args.repeats, config, device)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f'Results saved to {args.output}')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        for key, ratio in compare(previous, results).items():
+            print(f'{key:<50}{ratio:>8.2f}x')
@@ -0,0 +1,204 @@
+"""Module for applying the random augmentations of cholec80_images._RAND_AUGMENT to a whole batch at once.
+
+Instead of decoding the same frame twice and augmenting each image on its own, the frame is decoded once and the
+views are generated on the stacked batch: the random resized crop and the horizontal flip become a single affine
+grid_sample, while the color jitter is applied with tensor operations, using different random parameters for each
+sample of the batch.
+"""
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import default_collate
+
+
+def rgb_to_grayscale(images: torch.Tensor) -> torch.Tensor:
+    """Convert a batch of float RGB images (B, 3, H, W) to grayscale (B, 1, H, W), with the same weights of torchvision."""
+    r, g, b = images.unbind(dim=1)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def rgb_to_hsv(images: torch.Tensor) -> torch.Tensor:
+    """Convert a batch of float RGB images with values in [0, 1] to HSV."""
+    r, g, b = images.unbind(dim=1)
+    max_c = images.amax(dim=1)
+    min_c = images.amin(dim=1)
+    delta = max_c - min_c
+    delta_safe = torch.where(delta == 0, torch.ones_like(delta), delta)
+
+    s = delta / torch.where(max_c == 0, torch.ones_like(max_c), max_c)
+    rc = (max_c - r) / delta_safe
+    gc = (max_c - g) / delta_safe
+    bc = (max_c - b) / delta_safe
+
+    h = torch.where(max_c == r, bc - gc, torch.where(max_c == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta == 0, torch.zeros_like(h), h)
+    h = torch.fmod(h / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, max_c), dim=1)
+
+
+def hsv_to_rgb(images: torch.Tensor) -> torch.Tensor:
+    """Convert a batch of HSV images to float RGB images with values in [0, 1]."""
+    h, s, v = images[:, 0:1], images[:, 1:2], images[:, 2:3]
+    # closed form of the conversion, where n = 5, 3, 1 gives respectively the r, g and b channels
+    n = torch.tensor([5.0, 3.0, 1.0], device=images.device, dtype=images.dtype).view(1, 3, 1, 1)
+    k = torch.remainder(n + h * 6.0, 6.0)
+    return v - v * s * torch.minimum(k, 4.0 - k).clamp(0.0, 1.0)
+
+
+class BatchedRandAugment(nn.Module):
+    """Batched version of the cholec80_images._RAND_AUGMENT composition: random resized crop, random horizontal flip and
+    color jitter. Every sample of the batch gets its own random parameters, but each operation is executed once for the
+    whole batch.
+
+    Args:
+        size (tuple): Output size of the random resized crop.
+        scale (tuple): Range of the area of the crop, relative to the area of the image.
+        ratio (tuple): Range of the aspect ratio of the crop.
+        flip_p (float): Probability of the horizontal flip.
+        brightness (float): Brightness jitter, the factor is sampled in [1 - brightness, 1 + brightness].
+        contrast (float): Contrast jitter, the factor is sampled in [1 - contrast, 1 + contrast].
+        saturation (float): Saturation jitter, the factor is sampled in [1 - saturation, 1 + saturation].
+        hue (float): Hue jitter, the shift is sampled in [-hue, hue].
+    """
+    def __init__(self, size=(224, 224), scale=(0.8, 1.0), ratio=(3. / 4., 4. / 3.), flip_p=0.5,
+                 brightness=0.2, contrast=0.2, saturation=0.2, hue=0.2):
+        super(BatchedRandAugment, self).__init__()
+        self.size = tuple(size)
+        self.scale = scale
+        self.ratio = ratio
+        self.flip_p = flip_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+
+    def crop_params(self, batch_size: int, height: int, width: int, device) -> (torch.Tensor, ...):
+        """Sample the crop boxes (top, left, height, width) for the whole batch, following the same procedure of
+        torchvision RandomResizedCrop: 10 attempts for each sample and a central crop as fallback."""
+        attempts = 10
+        area = height * width
+        target_area = area * torch.empty(batch_size, attempts, device=device).uniform_(*self.scale)
+        log_ratio = torch.empty(batch_size, attempts, device=device).uniform_(math.log(self.ratio[0]), math.log(self.ratio[1]))
+        aspect_ratio = torch.exp(log_ratio)
+
+        w = torch.round(torch.sqrt(target_area * aspect_ratio))
+        h = torch.round(torch.sqrt(target_area / aspect_ratio))
+        valid = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+
+        # fallback to the central crop, that is the same for every sample
+        in_ratio = width / height
+        if in_ratio < min(self.ratio):
+            fallback_w, fallback_h = width, round(width / min(self.ratio))
+        elif in_ratio > max(self.ratio):
+            fallback_w, fallback_h = round(height * max(self.ratio)), height
+        else:
+            fallback_w, fallback_h = width, height
+
+        first_valid = torch.argmax(valid.to(torch.uint8), dim=1, keepdim=True)
+        any_valid = valid.any(dim=1)
+        w = torch.where(any_valid, w.gather(1, first_valid).squeeze(1), torch.full_like(any_valid, fallback_w, dtype=w.dtype))
+        h = torch.where(any_valid, h.gather(1, first_valid).squeeze(1), torch.full_like(any_valid, fallback_h, dtype=h.dtype))
+
+        top = torch.floor(torch.rand(batch_size, device=device) * (height - h + 1))
+        left = torch.floor(torch.rand(batch_size, device=device) * (width - w + 1))
+        top = torch.where(any_valid, top, (height - h) // 2)
+        left = torch.where(any_valid, left, (width - w) // 2)
+        return top, left, h, w
+
+    def resized_crop_flip(self, images: torch.Tensor) -> torch.Tensor:
+        """Apply the random resized crop and the random horizontal flip with a single affine grid sampling."""
+        batch_size, channels, height, width = images.shape
+        top, left, h, w = self.crop_params(batch_size, height, width, images.device)
+        flip = torch.rand(batch_size, device=images.device) < self.flip_p
+
+        # affine transformation from the output grid to the normalized coordinates of the crop box
+        theta = torch.zeros(batch_size, 2, 3, device=images.device, dtype=images.dtype)
+        theta[:, 0, 0] = torch.where(flip, -w / width, w / width)
+        theta[:, 0, 2] = (2 * left + w) / width - 1
+        theta[:, 1, 1] = h / height
+        theta[:, 1, 2] = (2 * top + h) / height - 1
+
+        grid = F.affine_grid(theta, [batch_size, channels, *self.size], align_corners=False)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+    def color_jitter(self, images: torch.Tensor) -> torch.Tensor:
+        """Apply brightness, contrast, saturation and hue jitter to a batch of float images with values in [0, 1].
+        The factors are sampled for each sample, while the order of the operations is sampled once for the batch."""
+        batch_size = images.shape[0]
+
+        def factors(amount):
+            return torch.empty(batch_size, 1, 1, 1, device=images.device).uniform_(1 - amount, 1 + amount)
+
+        for fn_id in torch.randperm(4).tolist():
+            if fn_id == 0 and self.brightness > 0:
+                images = (images * factors(self.brightness)).clamp(0.0, 1.0)
+            elif fn_id == 1 and self.contrast > 0:
+                mean = rgb_to_grayscale(images).mean(dim=(1, 2, 3), keepdim=True)
+                c = factors(self.contrast)
+                images = (c * images + (1 - c) * mean).clamp(0.0, 1.0)
+            elif fn_id == 2 and self.saturation > 0:
+                s = factors(self.saturation)
+                images = (s * images + (1 - s) * rgb_to_grayscale(images)).clamp(0.0, 1.0)
+            elif fn_id == 3 and self.hue > 0:
+                shift = torch.empty(batch_size, 1, 1, device=images.device).uniform_(-self.hue, self.hue)
+                hsv = rgb_to_hsv(images)
+                hue = torch.remainder(hsv[:, 0] + shift, 1.0)
+                images = hsv_to_rgb(torch.stack((hue, hsv[:, 1], hsv[:, 2]), dim=1))
+        return images
+
+    @torch.no_grad()
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        """Augment a batch of uint8 images (B, 3, H, W), returning a uint8 batch of the output size."""
+        x = images.to(torch.float32) / 255.
+        x = self.resized_crop_flip(x)
+        x = self.color_jitter(x)
+        return torch.round(x * 255.).to(torch.uint8)
+
+
+class BatchedAugmentCollate:
+    """Collate function that stacks the decoded images of the batch and generates from them num_views augmented views,
+    returning a tuple (view_1, ..., view_n, labels). With num_views=2 it is a drop-in replacement of the dataset
+    double_img option, decoding each frame only once.
+
+    Args:
+        augment (nn.Module): Batched augmentation, e.g. BatchedRandAugment.
+        num_views (int): Number of augmented views to generate from each image.
+    """
+    def __init__(self, augment: nn.Module, num_views: int = 2):
+        self.augment = augment
+        self.num_views = num_views
+
+    def __call__(self, batch):
+        images, labels = default_collate(batch)
+        return (*[self.augment(images) for _ in range(self.num_views)], labels)
+
+
+class MultiCropAugmentCollate:
+    """Collate function for the multi-crop pretraining: from each decoded image it generates the target view, num_global
+    global anchor views of the same size of the target and num_focal focal anchor views, small crops of a small area of
+    the image at a lower resolution. It returns a tuple (anchor_views, target, labels), where anchor_views is the list
+    of the global views followed by the focal views, each one a batch of uint8 images.
+
+    Args:
+        num_global (int): Number of global anchor views.
+        num_focal (int): Number of focal anchor views.
+        global_size (int): Size of the target and of the global views.
+        focal_size (int): Size of the focal views, it should be a multiple of the ViT patch size.
+        focal_scale (tuple): Range of the area of the focal crops, relative to the area of the image.
+    """
+    def __init__(self, num_global: int = 1, num_focal: int = 0, global_size: int = 224, focal_size: int = 96,
+                 focal_scale=(0.05, 0.3)):
+        self.num_global = num_global
+        self.num_focal = num_focal
+        self.global_augment = BatchedRandAugment(size=(global_size, global_size))
+        self.focal_augment = BatchedRandAugment(size=(focal_size, focal_size), scale=focal_scale)
+
+    def __call__(self, batch):
+        images, labels = default_collate(batch)
+        target = self.global_augment(images)
+        anchors = [self.global_augment(images) for _ in range(self.num_global)]
+        anchors += [self.focal_augment(images) for _ in range(self.num_focal)]
+        return anchors, target, labels
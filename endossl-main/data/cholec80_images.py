@@ -1,14 +1,28 @@
 """Module for creating TF datasets for Cholec80 dataset"""
 
 import os
+import sys
 
+import numpy as np
 import torch
 import torchvision
 from torchvision import transforms
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data.frame_store import FrameStore
+from data.shards import ShardedCholec80Dataset
+from data.batched_augment import BatchedRandAugment, BatchedAugmentCollate, MultiCropAugmentCollate
+from data.dedup import ClusterSampler, load_dedup_index, dataset_clusters
+from data import loader_tuning
+from data import index_cache
 
 _SUBSAMPLE_RATE = 25
 
+# number of samples in the shuffle buffer of the training set when the frames are streamed from the shards
+_SHARD_SHUFFLE_BUFFER = 1000
+
 _LABEL_NUM_MAPPING = {
     'GallbladderPackaging': 0,
     'CleaningCoagulation': 1,
@@ -85,13 +99,16 @@ class CustomCholec80Dataset(Dataset):
         transform (function): Transformation function to apply to the images.
         double_img (bool): If True, the __getitem__ method will return the same image twice with different
         random augmentation
+        use_index_cache (bool): If True, the index of the frames is saved in the index_cache folder of data_root and
+        reused by the next initializations, until the frames folders or the annotation files change.
 
     """
-    def __init__(self, data_root, video_ids, transform=resize, double_img=False):
+    def __init__(self, data_root, video_ids, transform=resize, double_img=False, use_index_cache=True):
         self.video_ids = video_ids
         self.data_root = data_root
         self.transform = transform
         self.double_img = double_img
+        self.use_index_cache = use_index_cache
 
         self.all_frame_names, self.all_labels = self.prebuild(video_ids)
     def __len__(self):
@@ -108,33 +125,60 @@ class CustomCholec80Dataset(Dataset):
     def prebuild(self, video_ids):
         """Used for the initialization of the dataset. It will load all the paths of the images and the labels.
         The uploading of the full image will be done in the __getitem__ call, when generating the batch.
+
+        The index is read from the cache in the index_cache folder of data_root if it is still valid, otherwise it is
+        built with build_index and saved in the cache, see data/index_cache.py. The paths are returned as a numpy array
+        of strings and the labels as a uint8 array, while the video id and the frame index of each frame are saved in
+        the all_videos and all_frame_indices attributes.
         """
         frames_dir = os.path.join(self.data_root, 'frames')
         annos_dir = os.path.join(self.data_root, 'phase_annotations')
 
-        all_labels = []
-        all_frame_names = []
-        for video_id in video_ids:
-            video_frames_dir = os.path.join(frames_dir, video_id)
-            frames = [os.path.join(video_frames_dir, f) for f in os.listdir(video_frames_dir)]
+        table = None
+        if self.use_index_cache:
+            cache_path = index_cache.index_cache_path(os.path.join(self.data_root, 'index_cache'), video_ids)
+            signature = index_cache.index_signature(frames_dir, annos_dir, video_ids)
+            table = index_cache.load_index_cache(cache_path, video_ids, signature)
+        if table is None:
+            table = self.build_index(video_ids)
+            if self.use_index_cache:
+                index_cache.save_index_cache(cache_path, video_ids, signature, table)
+
+        self.all_videos = np.asarray(video_ids)[table['videos']]
+        self.all_frame_indices = table['frame_indices']
+        all_frame_names = np.char.add(frames_dir + os.sep, table['frame_names'])
+        return all_frame_names, table['labels']
+
+    def build_index(self, video_ids) -> dict:
+        """Build the index table of the videos, listing the frames folders and reading the annotation files. Return a
+        dictionary with the columns of the table: the frame names relative to the frames folder, the position of the
+        video in video_ids, the frame index and the label of each frame."""
+        frames_dir = os.path.join(self.data_root, 'frames')
+        annos_dir = os.path.join(self.data_root, 'phase_annotations')
+
+        frame_names, videos, frame_indices, labels = [], [], [], []
+        for pos, video_id in enumerate(video_ids):
+            frames = [os.path.join(video_id, f) for f in os.listdir(os.path.join(frames_dir, video_id))]
             with open(os.path.join(annos_dir, video_id + '-phase.txt'), 'r') as f:
-                labels = f.readlines()[1:]
+                video_labels = f.readlines()[1:]
 
             # The videos frames are sampled with a frequency of 1 over 25 frames, but the labels annotations have not
             # been subsampled. We need to subsample the labels to match the frames.
-            labels = labels[::_SUBSAMPLE_RATE]
-            ordered_labels = []
-            # for loop necessary for ordering the labels to the corresponding frame
-            for frame in frames:
-                frame_index = int(frame[-10:-4])
-                ordered_labels.append(labels[frame_index - 1])
+            video_labels = video_labels[::_SUBSAMPLE_RATE]
+            video_labels = np.array([_LABEL_NUM_MAPPING[l.split('\t')[1].strip()] for l in video_labels], dtype=np.uint8)
 
-            ordered_labels = [l.split('\t')[1][:-1] for l in ordered_labels]
-            ordered_labels = [_LABEL_NUM_MAPPING[l] for l in ordered_labels]
+            # the frame index is used for ordering the labels to the corresponding frame
+            video_frame_indices = np.array([int(frame[-10:-4]) for frame in frames], dtype=np.int32)
 
-            all_frame_names += frames
-            all_labels += ordered_labels
-        return all_frame_names, all_labels
+            frame_names += frames
+            videos.append(np.full(len(frames), pos, dtype=np.int16))
+            frame_indices.append(video_frame_indices)
+            labels.append(video_labels[video_frame_indices - 1])
+
+        return {'frame_names': np.array(frame_names),
+                'videos': np.concatenate(videos),
+                'frame_indices': np.concatenate(frame_indices),
+                'labels': np.concatenate(labels)}
 
     def parse_image(self, image_path : str)->torch.Tensor:
         """Parse the image in input, applying the transformation function."""
@@ -143,8 +187,8 @@ class CustomCholec80Dataset(Dataset):
         return self.transform(img)
 
     def parse_label(self, label):
-        """Parse the label in input, converting it to a tensor."""
-        return label
+        """Parse the label in input, converting it to a Python int, so that it is collated as an int64 tensor."""
+        return int(label)
 
     def parse_example(self, image_path, label):
         """Parse the example in input, returning the image and the label."""
@@ -158,7 +202,41 @@ class CustomCholec80Dataset(Dataset):
                 self.parse_label(label))
 
 
-def get_pytorch_dataloaders(data_root, batch_size, double_img=False)->dict:
+class FrameStoreCholec80Dataset(CustomCholec80Dataset):
+    """Cholec80 dataset served from the memory-mapped frame store created with data/frame_store.py. The frames in the
+    store are already decoded and resized, so no PNG is read during training and the __getitem__ call returns slices
+    of the memory map. Since the transformations start with a resize to the same size of the stored frames, that is a
+    no-op, the returned images are identical to the ones of CustomCholec80Dataset.
+
+    In this dataset the all_frame_names attribute contains the rows of the store instead of the paths of the images.
+
+    Args:
+        store_dir (str): Path to the directory of the frame store.
+        video_ids (list): List of the video ids to use, they must be all present in the store.
+        transform (function): Transformation function to apply to the images.
+        double_img (bool): If True, the __getitem__ method will return the same image twice with different
+        random augmentation
+    """
+    def __init__(self, store_dir, video_ids, transform=resize, double_img=False):
+        self.store = FrameStore(store_dir, video_ids)
+        super(FrameStoreCholec80Dataset, self).__init__(store_dir, video_ids, transform, double_img)
+
+    def prebuild(self, video_ids):
+        """Load the rows and the labels from the sidecar files of the store."""
+        self.all_videos = self.store.videos
+        self.all_frame_indices = self.store.frame_indices
+        return np.arange(len(self.store)), self.store.labels
+
+    def parse_image(self, row : int)->torch.Tensor:
+        """Parse the frame in the row of the store, applying the transformation function."""
+        return self.transform(self.store.frame(row))
+
+
+def get_pytorch_dataloaders(data_root, batch_size, double_img=False, storage='png', storage_dir=None,
+                            batched_augment=False, loader_options=None, autotune_loader=False,
+                            loader_options_path=None, num_global_views=1, num_focal_views=0,
+                            focal_size=96, distributed=False, cluster_sampling=False, samples_per_cluster=1,
+                            generator=None)->dict:
     """Function that return a dictionary with the dataloaders for the Cholec80 dataset. Will contain a dataloader for
     train, test and validation set. For the training set, the images will be augmented and it is applied the shuffle.
     The validation and test dataloaders will only apply resize of the images and there will be no shuffle.
@@ -170,27 +248,131 @@ def get_pytorch_dataloaders(data_root, batch_size, double_img=False)->dict:
         each video, with the same numeration, and the labels separated by a tabulation.
         batch_size (int): Batch size for the dataload
         with_image_path (bool): If True, the __getitem__ method will return also the path of the image.
+        storage (str): Where the frames are read from. Can be 'png', for decoding the frames of the data_root folder,
+        'memmap', for reading the frames from the memory-mapped store created with data/frame_store.py, or 'shards',
+        for streaming the frames from the tar shards created with data/shards.py.
+        storage_dir (str): Path to the directory of the frame store or of the shards. Default is the frame_store or
+        the shards folder in data_root.
+        batched_augment (bool): If True, the training images are decoded only once and the random augmentation is
+        applied to the whole batch in the collate function, see data/batched_augment.py. With double_img set to True
+        the batches will still contain the anchor images, the target images and the labels.
+        loader_options (dict): Options of the dataloaders (num_workers, pin_memory, persistent_workers,
+        prefetch_factor and num_threads for the torch intra-op threads), see data/loader_tuning.py.
+        autotune_loader (bool): If True, the loader options are chosen running a short probe over the training
+        dataset with different configurations, and saved in loader_options_path if given.
+        loader_options_path (str): Path of the json file with the loader options. If autotune_loader is False and the
+        file exists, the options are loaded from it instead of using loader_options.
+        num_global_views (int): Number of global anchor views of each training image, used with double_img.
+        num_focal_views (int): Number of low resolution focal anchor views of each training image, used with
+        double_img. If there is more than one anchor view the training batches contain the list of the anchor views,
+        the target images and the labels, see MultiCropAugmentCollate; this requires batched_augment, so that all the
+        views are generated from a single decode of the frame.
+        focal_size (int): Size of the focal views.
+        distributed (bool): If True, and the torch.distributed process group is initialized, the training dataloader
+        uses a DistributedSampler, so each process reads a different part of the shuffled training set; remember to
+        call set_epoch on its sampler at each epoch. It is supported only by the map-style storages, 'png' and 'memmap'.
+        cluster_sampling (bool): If True, each training epoch draws samples_per_cluster frames from each cluster of
+        near-duplicate frames instead of every frame, with a ClusterSampler over the index built by data/dedup.py for
+        the training videos of data_root. It is supported only by the 'png' and 'memmap' storages.
+        samples_per_cluster (int): Number of frames drawn from each cluster at each epoch, used with cluster_sampling.
+        generator (torch.Generator): Generator of the training dataloader, for the shuffle and the base seed of its
+        workers. When it is given the training workers are not persistent, so they are started again at each epoch with
+        a seed drawn from the generator, and reseeding it at each epoch, see checkpointing.seed_loader_generator, makes
+        the random augmentations of the workers depend only on the epoch.
     """
+    if storage not in ('png', 'memmap', 'shards'):
+        raise ValueError('Invalid storage: {}'.format(storage))
+    multi_crop = double_img and (num_global_views != 1 or num_focal_views > 0)
+    if multi_crop and not batched_augment:
+        raise ValueError('The multi-crop views require batched_augment')
+    distributed = distributed and torch.distributed.is_initialized()
+    if distributed and storage == 'shards':
+        raise ValueError('The distributed training supports only the png and memmap storages')
+    if cluster_sampling and storage == 'shards':
+        raise ValueError('The cluster sampling supports only the png and memmap storages')
+    if storage == 'memmap' and storage_dir is None:
+        storage_dir = os.path.join(data_root, 'frame_store')
+    if storage == 'shards' and storage_dir is None:
+        storage_dir = os.path.join(data_root, 'shards')
+    if not autotune_loader and loader_options_path is not None and os.path.exists(loader_options_path):
+        loader_options = loader_tuning.load_loader_options(loader_options_path)
+        print(f'Loader options loaded from {loader_options_path}: {loader_options}')
 
     dataloaders = {}
     for split, ids_range in _CHOLEC80_SPLIT.items():
 
-        if split == 'train':
+        collate_fn = None
+        if split == 'train' and multi_crop:
+            train_transformation = 'resize'
+            collate_fn = MultiCropAugmentCollate(num_global_views, num_focal_views, focal_size=focal_size)
+            double_img = False
+        elif split == 'train' and batched_augment:
+            train_transformation = 'resize'
+            collate_fn = BatchedAugmentCollate(BatchedRandAugment(), num_views=2 if double_img else 1)
+            double_img = False
+        elif split == 'train':
             train_transformation = 'randaug'
         else:
             train_transformation = 'resize'
             double_img = False
 
-        dataset = CustomCholec80Dataset(
-            data_root,
-            [f'video{i:02}' for i in ids_range],
-            transform=get_train_image_transformation(train_transformation),
-            double_img=double_img
-        )
-        if split == 'train':
-            dataloaders[split] = DataLoader(dataset, shuffle=True, batch_size=batch_size)
+        if storage == 'memmap':
+            dataset = FrameStoreCholec80Dataset(
+                storage_dir,
+                [f'video{i:02}' for i in ids_range],
+                transform=get_train_image_transformation(train_transformation),
+                double_img=double_img
+            )
+        elif storage == 'shards':
+            # the shuffle of the training set is done by the dataset, shuffling the shards and using a buffer
+            dataset = ShardedCholec80Dataset(
+                storage_dir,
+                [f'video{i:02}' for i in ids_range],
+                transform=get_train_image_transformation(train_transformation),
+                double_img=double_img,
+                shuffle_buffer=_SHARD_SHUFFLE_BUFFER if split == 'train' else 0,
+                shuffle_shards=split == 'train'
+            )
+        else:
+            dataset = CustomCholec80Dataset(
+                data_root,
+                [f'video{i:02}' for i in ids_range],
+                transform=get_train_image_transformation(train_transformation),
+                double_img=double_img
+            )
+        if split == 'train' and autotune_loader:
+            loader_options = loader_tuning.autotune_loader_options(dataset, batch_size, collate_fn)
+            # a probe that measured nothing returns the default options, that are not saved
+            if loader_options_path is not None and loader_options.get('samples_per_sec') and \
+                    (not distributed or torch.distributed.get_rank() == 0):
+                loader_tuning.save_loader_options(loader_options, loader_options_path)
+
+        train_kwargs = loader_tuning.loader_kwargs(loader_options)
+        if generator is not None and 'persistent_workers' in train_kwargs:
+            train_kwargs['persistent_workers'] = False
+
+        if split == 'train' and cluster_sampling:
+            dedup_index = load_dedup_index(data_root, dataset.video_ids)
+            if dedup_index is None:
+                raise FileNotFoundError(f'Near-duplicate index of the {split} split not found or outdated in '
+                                        f'{data_root}, build it with data/dedup.py')
+            sampler = ClusterSampler(dataset_clusters(dataset, dedup_index), samples_per_cluster,
+                                     num_replicas=torch.distributed.get_world_size() if distributed else None,
+                                     rank=torch.distributed.get_rank() if distributed else None)
+            dataloaders[split] = DataLoader(dataset, sampler=sampler, batch_size=batch_size, collate_fn=collate_fn,
+                                            generator=generator, **train_kwargs)
+        elif split == 'train' and distributed:
+            dataloaders[split] = DataLoader(dataset, sampler=DistributedSampler(dataset, shuffle=True),
+                                            batch_size=batch_size, collate_fn=collate_fn, generator=generator,
+                                            **train_kwargs)
+        elif split == 'train':
+            dataloaders[split] = DataLoader(dataset, shuffle=storage != 'shards', batch_size=batch_size,
+                                            collate_fn=collate_fn, generator=generator, **train_kwargs)
         else:
-            dataloaders[split] = DataLoader(dataset, shuffle=False, batch_size=batch_size)
+            dataloaders[split] = DataLoader(dataset, shuffle=False, batch_size=batch_size,
+                                            **loader_tuning.loader_kwargs(loader_options))
+
+    loader_tuning.apply_thread_options(loader_options)
 
     return dataloaders
 
@@ -0,0 +1,273 @@
+"""Module for the near-duplicate index of the Cholec80 frames and for the sampler over its clusters.
+
+The frames are extracted at 1 fps and the scene is often almost static for tens of seconds, so most of the frames of a
+pretraining epoch are near copies of their neighbours. The index assigns to each frame a perceptual hash (dHash: the
+frame is reduced to a (hash_size, hash_size + 1) grayscale thumbnail and each bit tells if a pixel is brighter than its
+right neighbour) and groups the consecutive frames of a video whose hash differs by at most max_distance bits from the
+first frame of the group. The clusters depend only on the hashes, since the index is used by the self-supervised
+pretraining; with split_on_labels (--split_on_labels) a cluster is also cut at each change of phase, so all its frames
+have the same label, but the ground-truth annotations are then used by the sampler. The index is saved in an
+uncompressed .npz file in the dedup_index folder of data_root, with the video, the frame index, the hash and the
+cluster of each frame, and it is invalidated, as the index cache, when the frames folders or the annotation files
+change.
+
+With the ClusterSampler an epoch draws samples_per_cluster random frames from each cluster instead of every frame, so
+its length is the number of clusters and the redundant frames are seen only across the epochs. The index of a split
+can be created, with a process for each core, running
+
+    python data/dedup.py --data_root cholec80 --split train --max_distance 10
+
+be sure to have your terminal running in the endossl-main folder.
+"""
+
+import os
+import sys
+import hashlib
+import argparse
+import multiprocessing
+
+import numpy as np
+import torch
+import torchvision
+from torch.utils.data import Sampler
+from tqdm import tqdm
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data import index_cache
+
+
+def dedup_index_path(data_root: str, video_ids) -> str:
+    """Return the path of the near-duplicate index for the list of video ids in input."""
+    key = hashlib.sha1(','.join(video_ids).encode()).hexdigest()[:16]
+    return os.path.join(data_root, 'dedup_index', f'dedup_{key}.npz')
+
+
+def dhash(images: torch.Tensor, hash_size: int = 8) -> np.ndarray:
+    """Compute the difference hash of a batch of uint8 images (B, C, H, W).
+
+    Args:
+        images (torch.Tensor): Batch of RGB or grayscale images.
+        hash_size (int): Side of the hash, the hash has hash_size * hash_size bits.
+    Returns:
+        np.ndarray: The hashes as packed bits, an uint8 array of shape (B, hash_size * hash_size / 8).
+    """
+    images = images.float()
+    if images.shape[1] == 3:
+        images = (images * torch.tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)).sum(dim=1, keepdim=True)
+    thumbnails = torch.nn.functional.interpolate(images, size=(hash_size, hash_size + 1), mode='bilinear',
+                                                 antialias=True, align_corners=False)[:, 0]
+    bits = (thumbnails[:, :, 1:] > thumbnails[:, :, :-1]).flatten(1).numpy()
+    return np.packbits(bits, axis=1)
+
+
+def hamming_distance(hashes: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """Return the number of different bits between each hash of hashes (N, num_bytes) and the reference hash."""
+    return np.unpackbits(np.bitwise_xor(hashes, reference), axis=-1).sum(axis=-1)
+
+
+def hash_frames(paths, hash_size: int = 8) -> np.ndarray:
+    """Decode the PNG frames in input and return their hashes."""
+    return np.concatenate([dhash(torchvision.io.decode_png(torchvision.io.read_file(str(p))).unsqueeze(0), hash_size)
+                           for p in paths])
+
+
+def _hash_video(args) -> (str, np.ndarray):
+    video_id, paths, hash_size = args
+    torch.set_num_threads(1)
+    return video_id, hash_frames(paths, hash_size)
+
+
+def temporal_clusters(hashes: np.ndarray, labels: np.ndarray = None, max_distance: int = 10,
+                      max_length: int = None) -> np.ndarray:
+    """Group the frames of a video, in temporal order, in clusters of consecutive near-duplicates. A new cluster is
+    started when the hash of a frame differs by more than max_distance bits from the first frame of the current
+    cluster, when the label changes or when the cluster already has max_length frames.
+
+    Args:
+        hashes (np.ndarray): Hashes of the frames of the video, ordered by frame index.
+        labels (np.ndarray): Labels of the frames, None for ignoring them.
+        max_distance (int): Maximum Hamming distance from the first frame of the cluster.
+        max_length (int): Maximum number of frames of a cluster, None for no limit.
+    Returns:
+        np.ndarray: The cluster of each frame, numbered from 0 in temporal order.
+    """
+    clusters = np.zeros(len(hashes), dtype=np.int64)
+    if len(hashes) == 0:
+        return clusters
+    distances_to_start = hamming_distance(hashes, hashes[0])
+    current, start = 0, 0
+    for i in range(1, len(hashes)):
+        if distances_to_start[i] > max_distance or (labels is not None and labels[i] != labels[start]) or \
+                (max_length is not None and i - start >= max_length):
+            current, start = current + 1, i
+            distances_to_start = hamming_distance(hashes, hashes[start])
+        clusters[i] = current
+    return clusters
+
+
+def build_dedup_index(dataset, num_workers: int = None, hash_size: int = 8, max_distance: int = 10,
+                      max_length: int = None, split_on_labels: bool = False) -> str:
+    """Hash all the frames of the dataset, with a process for each video at a time, cluster the near-duplicates of each
+    video and save the index in the dedup_index folder of dataset.data_root.
+
+    Args:
+        dataset (CustomCholec80Dataset): Dataset over the PNG frames of the videos to index.
+        num_workers (int): Number of processes, default is the number of cores.
+        hash_size (int): Side of the hash, see dhash.
+        max_distance (int): Maximum Hamming distance inside a cluster, see temporal_clusters.
+        max_length (int): Maximum number of frames of a cluster, None for no limit.
+        split_on_labels (bool): If True a cluster is also cut at each change of the phase label.
+    Returns:
+        str: The path of the index.
+    """
+    video_ids = list(dataset.video_ids)
+    videos = np.asarray(dataset.all_videos)
+    frame_indices = np.asarray(dataset.all_frame_indices)
+    labels = np.asarray(dataset.all_labels) if split_on_labels else None
+
+    rows = {}
+    for video_id in video_ids:
+        video_rows = np.flatnonzero(videos == video_id)
+        rows[video_id] = video_rows[np.argsort(frame_indices[video_rows], kind='stable')]
+    tasks = [(v, [dataset.all_frame_names[r] for r in rows[v]], hash_size) for v in video_ids]
+
+    hashes = {}
+    num_workers = min(num_workers or os.cpu_count() or 1, len(tasks))
+    with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+        for video_id, video_hashes in tqdm(pool.imap_unordered(_hash_video, tasks), total=len(tasks),
+                                           desc='Hashing videos', ncols=100):
+            hashes[video_id] = video_hashes
+
+    table = {'videos': [], 'frame_indices': [], 'hashes': [], 'clusters': []}
+    num_clusters = 0
+    for pos, video_id in enumerate(video_ids):
+        video_labels = labels[rows[video_id]] if labels is not None else None
+        clusters = temporal_clusters(hashes[video_id], video_labels, max_distance, max_length)
+        table['videos'].append(np.full(len(clusters), pos, dtype=np.int16))
+        table['frame_indices'].append(frame_indices[rows[video_id]].astype(np.int32))
+        table['hashes'].append(hashes[video_id])
+        table['clusters'].append(clusters + num_clusters)
+        num_clusters += int(clusters[-1]) + 1 if len(clusters) else 0
+    table = {key: np.concatenate(columns) for key, columns in table.items()}
+
+    frames_dir = os.path.join(dataset.data_root, 'frames')
+    annos_dir = os.path.join(dataset.data_root, 'phase_annotations')
+    path = dedup_index_path(dataset.data_root, video_ids)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    signature = index_cache.index_signature(frames_dir, annos_dir, video_ids)
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, video_ids=np.asarray(video_ids), signature=signature, hash_size=hash_size,
+                 max_distance=max_distance, split_on_labels=split_on_labels, **table)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_dedup_index(data_root: str, video_ids) -> dict:
+    """Load the near-duplicate index of the videos. Return None if it does not exist or if the frames folders or the
+    annotation files have changed since it was built."""
+    path = dedup_index_path(data_root, video_ids)
+    if not os.path.exists(path):
+        return None
+    signature = index_cache.index_signature(os.path.join(data_root, 'frames'),
+                                            os.path.join(data_root, 'phase_annotations'), video_ids)
+    with np.load(path) as index:
+        if list(index['video_ids']) != list(video_ids) or not np.array_equal(index['signature'], signature):
+            return None
+        return {key: index[key] for key in index.files}
+
+
+def dataset_clusters(dataset, index: dict) -> np.ndarray:
+    """Return the cluster of each frame of the dataset, in the order of the dataset, matching the frames by video and
+    frame index, so it works for every dataset with the all_videos and all_frame_indices attributes."""
+    video_ids = list(index['video_ids'])
+    keys = index['videos'].astype(np.int64) * 10 ** 7 + index['frame_indices']
+    position = {video_id: pos for pos, video_id in enumerate(video_ids)}
+    dataset_keys = np.array([position[v] for v in dataset.all_videos], dtype=np.int64) * 10 ** 7 + \
+        np.asarray(dataset.all_frame_indices)
+
+    order = np.argsort(keys)
+    found = np.searchsorted(keys, dataset_keys, sorter=order)
+    found = order[np.minimum(found, len(keys) - 1)]
+    if not np.array_equal(keys[found], dataset_keys):
+        raise ValueError('Some frames of the dataset are not in the near-duplicate index, rebuild it with '
+                         'data/dedup.py')
+    return index['clusters'][found]
+
+
+class ClusterSampler(Sampler):
+    """Sampler drawing, at each epoch, samples_per_cluster random frames from each cluster of near-duplicates, so an
+    epoch has num_clusters * samples_per_cluster samples. Different frames of the same cluster are drawn at different
+    epochs. Call set_epoch at each epoch for changing the frames and the order.
+
+    In the distributed training every process draws the same frames with the same seed and takes a different part of
+    them, as DistributedSampler.
+
+    Args:
+        clusters (np.ndarray): The cluster of each frame of the dataset, see dataset_clusters.
+        samples_per_cluster (int): Number of frames drawn from each cluster, with replacement.
+        shuffle (bool): If True the frames are returned in random order, otherwise ordered by cluster.
+        seed (int): Seed of the random draws, the same on all the processes.
+        num_replicas (int): Number of processes of the distributed training, None for a single process.
+        rank (int): Rank of this process.
+    """
+    def __init__(self, clusters: np.ndarray, samples_per_cluster: int = 1, shuffle: bool = True, seed: int = 0,
+                 num_replicas: int = None, rank: int = None):
+        clusters = np.asarray(clusters)
+        self._order = np.argsort(clusters, kind='stable')
+        sorted_clusters = clusters[self._order]
+        self._starts = np.flatnonzero(np.r_[True, sorted_clusters[1:] != sorted_clusters[:-1]]) if len(clusters) \
+            else np.zeros(0, dtype=np.int64)
+        self._sizes = np.diff(np.r_[self._starts, len(clusters)])
+        self.samples_per_cluster = samples_per_cluster
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas or 1
+        self.rank = rank or 0
+        self.epoch = 0
+
+    @property
+    def num_clusters(self) -> int:
+        return len(self._starts)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return -(-self.num_clusters * self.samples_per_cluster // self.num_replicas)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        offsets = (rng.random((self.num_clusters, self.samples_per_cluster)) * self._sizes[:, None]).astype(np.int64)
+        indices = self._order[self._starts[:, None] + offsets].ravel()
+        if self.shuffle:
+            rng.shuffle(indices)
+        if self.num_replicas > 1:
+            # padded with the first frames, so every process has the same number of samples
+            indices = np.resize(indices, len(self) * self.num_replicas)[self.rank::self.num_replicas]
+        return iter(indices.tolist())
+
+
+if __name__ == '__main__':
+
+    from data import cholec80_images
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', default=os.path.join('cholec80'))
+    parser.add_argument('--split', default='train', choices=list(cholec80_images._CHOLEC80_SPLIT.keys()))
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--hash_size', type=int, default=8)
+    parser.add_argument('--max_distance', type=int, default=10)
+    parser.add_argument('--max_length', type=int, default=None)
+    parser.add_argument('--split_on_labels', action='store_true', help='cut the clusters also at the phase changes')
+    args = parser.parse_args()
+
+    dataset = cholec80_images.CustomCholec80Dataset(
+        args.data_root, [f'video{i:02}' for i in cholec80_images._CHOLEC80_SPLIT[args.split]])
+    path = build_dedup_index(dataset, args.num_workers, args.hash_size, args.max_distance, args.max_length,
+                             args.split_on_labels)
+    clusters = load_dedup_index(args.data_root, dataset.video_ids)['clusters']
+    num_clusters = len(np.unique(clusters))
+    print(f'{len(clusters)} frames in {num_clusters} clusters ({num_clusters / max(1, len(clusters)):.1%} of the '
+          f'frames per epoch), index saved to {path}')
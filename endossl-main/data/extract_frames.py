@@ -0,0 +1,277 @@
+"""Module for extracting the frames of the Cholec80 videos directly in the storage format used for training.
+
+The videos, e.g. cholec80/videos/video01.mp4, are decoded with PyAV (pip install av) in a pool of processes, one video
+at a time for each process. Only one frame over _SUBSAMPLE_RATE is converted to RGB and resized, the frame number n of
+the 25 fps video (the Frame column of the annotation files) becomes the frame index n // _SUBSAMPLE_RATE + 1, so the
+frames are aligned with the labels as in CustomCholec80Dataset, and the frames after the last annotation are not
+decoded. The frames are resized only once and written in one of the formats:
+
+    png      the frames/videoXX/videoXX_000001.png tree read by CustomCholec80Dataset
+    memmap   the memory-mapped store of data/frame_store.py, without writing any PNG
+    shards   the tar shards of data/shards.py, with a <videoXX>.shards.json index for each video
+
+The extraction is resumable: each video is written with temporary names and renamed only when complete, and the
+videos already present in the output are skipped. At the end the number of frames per second is printed. The frames
+of a split can be extracted running
+
+    python data/extract_frames.py --data_root cholec80 --format memmap --split train
+
+be sure to have your terminal running in the endossl-main folder.
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import importlib.util
+import multiprocessing
+
+import numpy as np
+import torch
+import torchvision
+from torchvision import transforms
+from tqdm import tqdm
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data.cholec80_images import _LABEL_NUM_MAPPING, _SUBSAMPLE_RATE, _CHOLEC80_SPLIT
+from data.frame_store import _video_paths
+from data.shards import ShardWriter
+
+FORMATS = ('png', 'memmap', 'shards')
+
+_VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov')
+
+
+def find_video(videos_dir: str, video_id: str) -> str:
+    """Return the path of the video file of video_id in videos_dir."""
+    for ext in _VIDEO_EXTENSIONS:
+        path = os.path.join(videos_dir, video_id + ext)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f'Video {video_id} not found in {videos_dir}')
+
+
+def read_subsampled_labels(annos_dir: str, video_id: str, rate: int = _SUBSAMPLE_RATE) -> np.ndarray:
+    """Read the annotation file of the video and return the labels of the frames that are kept, the one of frame index
+    k in position k - 1."""
+    with open(os.path.join(annos_dir, video_id + '-phase.txt'), 'r') as f:
+        video_labels = f.readlines()[1:][::rate]
+    return np.array([_LABEL_NUM_MAPPING[l.split('\t')[1].strip()] for l in video_labels], dtype=np.uint8)
+
+
+def decode_subsampled(path: str, rate: int = _SUBSAMPLE_RATE, max_frames: int = None, threads: int = 0):
+    """Decode the video and yield (frame_index, image) for one frame over rate, with the image as a (3, H, W) uint8
+    tensor. The frames are counted in decoding order, as in the annotation files, and only the kept frames are converted
+    to RGB. The decoding stops after max_frames kept frames.
+
+    Args:
+        path (str): Path of the video.
+        rate (int): One frame over rate is kept.
+        max_frames (int): Maximum number of frames to yield, None for all the frames of the video.
+        threads (int): Decoding threads of the codec, 0 for letting the codec choose.
+    """
+    import av
+
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = 'AUTO'
+        stream.codec_context.thread_count = threads
+        kept = 0
+        for n, frame in enumerate(container.decode(stream)):
+            if n % rate:
+                continue
+            if max_frames is not None and kept >= max_frames:
+                break
+            yield n // rate + 1, torch.from_numpy(frame.to_ndarray(format='rgb24')).permute(2, 0, 1)
+            kept += 1
+
+
+class PngVideoWriter:
+    """Writer of the frames of a video as PNG files in output_dir/frames/<video_id>, the folder is written with a
+    temporary name and renamed when complete."""
+
+    def __init__(self, output_dir: str, video_id: str, num_frames: int, **kwargs):
+        self.video_dir = os.path.join(output_dir, 'frames', video_id)
+        self.video_id = video_id
+        self.tmp_dir = self.video_dir + '.tmp'
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    @staticmethod
+    def done(output_dir: str, video_id: str) -> bool:
+        return os.path.isdir(os.path.join(output_dir, 'frames', video_id))
+
+    def write(self, frame_index: int, img: torch.Tensor, label: int):
+        name = f'{self.video_id}_{frame_index:06d}.png'
+        torchvision.io.write_png(img, os.path.join(self.tmp_dir, name))
+
+    def close(self):
+        os.replace(self.tmp_dir, self.video_dir)
+
+
+class MemmapVideoWriter:
+    """Writer of the frames of a video in the memory-mapped store of data/frame_store.py. The array is allocated for
+    num_frames frames and shrunk if the video ends before, the sidecar is saved only when the array is complete."""
+
+    def __init__(self, output_dir: str, video_id: str, num_frames: int, **kwargs):
+        os.makedirs(output_dir, exist_ok=True)
+        self.frames_path, self.sidecar_path = _video_paths(output_dir, video_id)
+        self.video_id = video_id
+        self.num_frames = num_frames
+        self.frames = None
+        self.frame_indices, self.labels = [], []
+
+    @staticmethod
+    def done(output_dir: str, video_id: str) -> bool:
+        return os.path.exists(_video_paths(output_dir, video_id)[1])
+
+    def write(self, frame_index: int, img: torch.Tensor, label: int):
+        if self.frames is None:
+            self.frames = np.lib.format.open_memmap(self.frames_path + '.tmp', mode='w+', dtype=np.uint8,
+                                                    shape=(self.num_frames, *img.shape))
+        self.frames[len(self.labels)] = img.numpy()
+        self.frame_indices.append(frame_index)
+        self.labels.append(label)
+
+    def close(self):
+        count = len(self.labels)
+        if self.frames is None:
+            raise ValueError(f'No frame decoded for video {self.video_id}')
+        if count < self.num_frames:
+            shrunk = np.lib.format.open_memmap(self.frames_path + '.tmp2', mode='w+', dtype=np.uint8,
+                                               shape=(count, *self.frames.shape[1:]))
+            shrunk[:] = self.frames[:count]
+            shrunk.flush()
+            del shrunk
+            os.replace(self.frames_path + '.tmp2', self.frames_path + '.tmp')
+        else:
+            self.frames.flush()
+        self.frames = None
+        os.replace(self.frames_path + '.tmp', self.frames_path)
+
+        frame_indices = np.asarray(self.frame_indices, dtype=np.int32)
+        np.savez(self.sidecar_path,
+                 labels=np.asarray(self.labels, dtype=np.uint8),
+                 videos=np.full(count, self.video_id),
+                 frame_indices=frame_indices,
+                 paths=np.array([os.path.join(self.video_id, f'{self.video_id}_{k:06d}.png') for k in frame_indices]))
+
+
+class ShardsVideoWriter:
+    """Writer of the frames of a video, encoded as PNG, in the tar shards of data/shards.py with prefix video_id, so
+    the <video_id>.shards.json index, saved when the video is complete, marks the video as done."""
+
+    def __init__(self, output_dir: str, video_id: str, num_frames: int, shard_size: int = 1000, **kwargs):
+        self.writer = ShardWriter(output_dir, prefix=video_id, max_count=shard_size)
+        self.video_id = video_id
+
+    @staticmethod
+    def done(output_dir: str, video_id: str) -> bool:
+        return os.path.exists(os.path.join(output_dir, video_id + '.shards.json'))
+
+    def write(self, frame_index: int, img: torch.Tensor, label: int):
+        png_bytes = torchvision.io.encode_png(img).numpy().tobytes()
+        self.writer.write(f'{self.video_id}_{frame_index:06d}', png_bytes, label, self.video_id)
+
+    def close(self):
+        self.writer.close()
+
+
+_WRITERS = {'png': PngVideoWriter, 'memmap': MemmapVideoWriter, 'shards': ShardsVideoWriter}
+
+
+def _extract_video(args) -> dict:
+    video_path, annos_dir, video_id, output_format, output_dir, size, shard_size, threads = args
+    torch.set_num_threads(1)
+    start = time.perf_counter()
+    labels = read_subsampled_labels(annos_dir, video_id)
+    resize = transforms.Resize(size) if size is not None else None
+    writer = _WRITERS[output_format](output_dir, video_id, len(labels), shard_size=shard_size)
+    count = 0
+    for frame_index, img in decode_subsampled(video_path, _SUBSAMPLE_RATE, len(labels), threads):
+        if resize is not None:
+            img = resize(img)
+        writer.write(frame_index, img.contiguous(), int(labels[frame_index - 1]))
+        count += 1
+    writer.close()
+    return {'video_id': video_id, 'frames': count, 'seconds': time.perf_counter() - start}
+
+
+def extract_frames(data_root: str, video_ids, output_format: str = 'png', output_dir: str = None, size=(224, 224),
+                   num_workers: int = None, shard_size: int = 1000, overwrite: bool = False) -> dict:
+    """Extract the frames of the videos in data_root/videos, with the labels of data_root/phase_annotations, in the
+    output format, with a process for each video at a time.
+
+    Args:
+        data_root (str): Path to the Cholec80 folder, with the videos and phase_annotations folders.
+        video_ids (list): List of the video ids to extract.
+        output_format (str): One of 'png', 'memmap' or 'shards'.
+        output_dir (str): Where to write the frames, default data_root for 'png' (the frames are written in its
+        frames folder), data_root/frame_store for 'memmap' and data_root/shards for 'shards'.
+        size (tuple): (height, width) of the saved frames, None for keeping the size of the video.
+        num_workers (int): Number of processes, default is the number of cores. With a single process the codec
+        decodes with multiple threads.
+        shard_size (int): Number of samples in each shard, used with 'shards'.
+        overwrite (bool): If True, the videos already present in the output are extracted again.
+    Returns:
+        dict: The number of extracted videos and frames, the seconds and the frames per second.
+    """
+    if output_format not in _WRITERS:
+        raise ValueError(f'Unknown output format {output_format}, it must be one of {FORMATS}')
+    if importlib.util.find_spec('av') is None:
+        raise ImportError('The extraction of the frames requires PyAV, install it with pip install av')
+    if output_dir is None:
+        output_dir = {'png': data_root, 'memmap': os.path.join(data_root, 'frame_store'),
+                      'shards': os.path.join(data_root, 'shards')}[output_format]
+    writer_cls = _WRITERS[output_format]
+    videos_dir = os.path.join(data_root, 'videos')
+    annos_dir = os.path.join(data_root, 'phase_annotations')
+
+    tasks = []
+    for video_id in video_ids:
+        if writer_cls.done(output_dir, video_id):
+            if not overwrite:
+                continue
+            if output_format == 'png':
+                shutil.rmtree(os.path.join(output_dir, 'frames', video_id))
+        tasks.append((find_video(videos_dir, video_id), annos_dir, video_id, output_format, output_dir,
+                      tuple(size) if size is not None else None, shard_size, 0))
+
+    num_workers = min(num_workers or os.cpu_count() or 1, max(1, len(tasks)))
+    if num_workers > 1:
+        # one decoding thread for each process, the parallelism is over the videos
+        tasks = [task[:-1] + (1,) for task in tasks]
+    start = time.perf_counter()
+    frames = 0
+    with multiprocessing.get_context('spawn').Pool(num_workers) as pool:
+        progress = tqdm(pool.imap_unordered(_extract_video, tasks), total=len(tasks), desc='Extracting videos',
+                        ncols=100)
+        for result in progress:
+            frames += result['frames']
+            progress.set_postfix(video=result['video_id'], fps=f"{result['frames'] / result['seconds']:.1f}")
+    seconds = time.perf_counter() - start
+    return {'videos': len(tasks), 'skipped': len(video_ids) - len(tasks), 'frames': frames, 'seconds': seconds,
+            'frames_per_sec': frames / seconds if frames else 0.}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', default=os.path.join('cholec80'))
+    parser.add_argument('--format', default='png', choices=FORMATS)
+    parser.add_argument('--output_dir', default=None, help='default data_root, data_root/frame_store or '
+                                                           'data_root/shards according to the format')
+    parser.add_argument('--split', default='train', choices=list(_CHOLEC80_SPLIT.keys()))
+    parser.add_argument('--videos', type=int, nargs='+', default=None, help='video numbers, instead of a split')
+    parser.add_argument('--size', type=int, nargs=2, default=[224, 224], help='height and width, 0 0 for no resize')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--shard_size', type=int, default=1000)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    video_numbers = args.videos if args.videos is not None else _CHOLEC80_SPLIT[args.split]
+    stats = extract_frames(args.data_root, [f'video{i:02}' for i in video_numbers], args.format, args.output_dir,
+                           args.size if all(args.size) else None, args.num_workers, args.shard_size, args.overwrite)
+    print(f"{stats['frames']} frames of {stats['videos']} videos extracted in {stats['seconds']:.1f} s "
+          f"({stats['frames_per_sec']:.1f} frames/s), {stats['skipped']} videos already extracted")
@@ -0,0 +1,140 @@
+"""Module for the memory-mapped frame store of the Cholec80 dataset.
+
+The frames of each video are decoded and resized only once, and saved as a raw uint8 array of shape
+(num_frames, channels, height, width) in a .npy file, together with a sidecar .npz file containing, for each row of the
+array, the label, the video id, the frame index and the path of the original PNG. During training the arrays are opened
+as memory maps, so the dataset can serve the frames as zero-copy slices without decoding any PNG.
+
+The store can be created running
+
+    python data/frame_store.py --data_root cholec80 --store_dir cholec80/frame_store --split train
+
+be sure to have your terminal running in the endossl-main folder.
+"""
+
+import os
+import sys
+import argparse
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+def _video_paths(store_dir: str, video_id: str) -> (str, str):
+    return os.path.join(store_dir, video_id + '.npy'), os.path.join(store_dir, video_id + '.npz')
+
+
+def write_frame_store(dataset, store_dir: str, overwrite: bool = False) -> str:
+    """Decode all the frames of the dataset in input and write them in the memory-mapped store, one array for each video.
+
+    The frames are obtained with dataset.parse_image, so the store will contain exactly the same tensors that the
+    dataset would return, bit by bit. For this reason the dataset should use the 'resize' transformation, random
+    augmentations must be applied when reading from the store. The conversion is resumable: the videos that are
+    already present in the store are skipped, unless overwrite is set to True.
+
+    Args:
+        dataset (CustomCholec80Dataset): Dataset over the PNG frames, with a deterministic transformation.
+        store_dir (str): Directory where to save the store.
+        overwrite (bool): If True, the videos already present in the store will be written again.
+    Returns:
+        str: The path of the store directory.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+
+    videos = np.asarray(dataset.all_videos)
+    labels = np.asarray(dataset.all_labels, dtype=np.uint8)
+
+    for video_id in dataset.video_ids:
+        frames_path, sidecar_path = _video_paths(store_dir, video_id)
+        if os.path.exists(sidecar_path) and not overwrite:
+            continue
+
+        rows = np.flatnonzero(videos == video_id)
+        paths = [dataset.all_frame_names[r] for r in rows]
+        first = dataset.parse_image(paths[0])
+
+        # the array is written in a temporary file, the sidecar is saved only when all the frames have been written,
+        # so an interrupted conversion will never leave a partial video in the store
+        tmp_path = frames_path + '.tmp'
+        frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(len(paths), *first.shape))
+        for j, path in enumerate(tqdm(paths, desc=f'Writing {video_id}', ncols=100)):
+            img = first if j == 0 else dataset.parse_image(path)
+            frames[j] = img.numpy()
+        frames.flush()
+        del frames
+        os.replace(tmp_path, frames_path)
+
+        np.savez(sidecar_path,
+                 labels=labels[rows],
+                 videos=np.full(len(rows), video_id),
+                 frame_indices=np.asarray(dataset.all_frame_indices[rows], dtype=np.int32),
+                 paths=np.array(paths))
+
+    return store_dir
+
+
+class FrameStore:
+    """Reader of the memory-mapped frame store written by write_frame_store. The arrays of the videos in input are
+    opened as copy-on-write memory maps, so that the frames can be wrapped in tensors without copies and without the
+    risk of modifying the files on disk.
+
+    Args:
+        store_dir (str): Directory of the store.
+        video_ids (list): List of the video ids to open, they must be all present in the store.
+    """
+    def __init__(self, store_dir: str, video_ids):
+        self.store_dir = store_dir
+        self.video_ids = list(video_ids)
+
+        self.frames = []
+        labels, videos, frame_indices, paths, video_pos, rows = [], [], [], [], [], []
+        for pos, video_id in enumerate(self.video_ids):
+            frames_path, sidecar_path = _video_paths(store_dir, video_id)
+            if not os.path.exists(sidecar_path):
+                raise FileNotFoundError(f'Video {video_id} is not present in the frame store {store_dir}')
+
+            frames = np.load(frames_path, mmap_mode='c')
+            sidecar = np.load(sidecar_path)
+            self.frames.append(frames)
+            labels.append(sidecar['labels'])
+            videos.append(sidecar['videos'])
+            frame_indices.append(sidecar['frame_indices'])
+            paths.append(sidecar['paths'])
+            video_pos.append(np.full(len(frames), pos, dtype=np.int32))
+            rows.append(np.arange(len(frames), dtype=np.int32))
+
+        self.labels = np.concatenate(labels)
+        self.videos = np.concatenate(videos)
+        self.frame_indices = np.concatenate(frame_indices)
+        self.paths = np.concatenate(paths)
+        self._video_pos = np.concatenate(video_pos)
+        self._rows = np.concatenate(rows)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def frame(self, idx: int) -> torch.Tensor:
+        """Return the frame in position idx as a uint8 tensor sharing the memory with the memory map."""
+        return torch.from_numpy(self.frames[self._video_pos[idx]][self._rows[idx]])
+
+
+if __name__ == '__main__':
+
+    sys.path.append(os.path.realpath(__file__ + '/../../'))
+    from data import cholec80_images
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', default=os.path.join('cholec80'))
+    parser.add_argument('--store_dir', default=os.path.join('cholec80', 'frame_store'))
+    parser.add_argument('--split', default='train', choices=list(cholec80_images._CHOLEC80_SPLIT.keys()))
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    dataset = cholec80_images.CustomCholec80Dataset(
+        args.data_root,
+        [f'video{i:02}' for i in cholec80_images._CHOLEC80_SPLIT[args.split]],
+        transform=cholec80_images.resize
+    )
+    write_frame_store(dataset, args.store_dir, overwrite=args.overwrite)
+    print(f'Frame store for the {args.split} split saved to {args.store_dir}')
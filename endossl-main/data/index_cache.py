@@ -0,0 +1,53 @@
+"""Module for the persistent cache of the index built by CustomCholec80Dataset.prebuild.
+
+The index of a list of videos is a table with a row for each frame, saved column by column in an uncompressed .npz
+file: the name of the frame relative to the frames folder, the position of its video in the list of video ids, the
+frame index and the label, all as compact integer arrays. The cache is invalidated when the modification time of a
+video frames folder, or the modification time or the size of an annotation file, changes.
+"""
+
+import os
+import hashlib
+
+import numpy as np
+
+
+def index_cache_path(cache_dir: str, video_ids) -> str:
+    """Return the path of the cache file for the list of video ids in input."""
+    key = hashlib.sha1(','.join(video_ids).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'index_{key}.npz')
+
+
+def index_signature(frames_dir: str, annos_dir: str, video_ids) -> np.ndarray:
+    """Return, for each video, the modification time of the frames folder and the modification time and the size of
+    the annotation file. Only a stat call for each of them is needed, without listing the folders."""
+    signature = np.zeros((len(video_ids), 3), dtype=np.int64)
+    for i, video_id in enumerate(video_ids):
+        frames_stat = os.stat(os.path.join(frames_dir, video_id))
+        annos_stat = os.stat(os.path.join(annos_dir, video_id + '-phase.txt'))
+        signature[i] = (frames_stat.st_mtime_ns, annos_stat.st_mtime_ns, annos_stat.st_size)
+    return signature
+
+
+def load_index_cache(path: str, video_ids, signature: np.ndarray):
+    """Load the index table from the cache file. Return None if the file does not exist or if it was built for other
+    videos or with a different signature."""
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cache:
+        if list(cache['video_ids']) != list(video_ids) or not np.array_equal(cache['signature'], signature):
+            return None
+        return {key: cache[key] for key in ('frame_names', 'videos', 'frame_indices', 'labels')}
+
+
+def save_index_cache(path: str, video_ids, signature: np.ndarray, table: dict):
+    """Save the index table in the cache file. The file is first written with a temporary name and then renamed, so
+    that concurrent launches never read a partial cache. If the folder is not writable the cache is just skipped."""
+    tmp_path = path + f'.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, video_ids=np.asarray(video_ids), signature=signature, **table)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f'Index cache not saved in {path}: {e}')
@@ -0,0 +1,134 @@
+"""Module for the tuning of the DataLoader options (workers, pinned memory, prefetch) used by get_pytorch_dataloaders.
+
+The options are stored in a dictionary like DEFAULT_LOADER_OPTIONS, that can be written and read as a json file so that
+the configuration found by the auto-tuning probe can be reused by the following runs on the same machine.
+"""
+
+import os
+import json
+import time
+import itertools
+
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+
+DEFAULT_LOADER_OPTIONS = {
+    'num_workers': 0,
+    'pin_memory': False,
+    'persistent_workers': False,
+    'prefetch_factor': None,
+    'num_threads': None
+}
+
+
+def loader_kwargs(options: dict) -> dict:
+    """Convert the loader options in the keyword arguments of the DataLoader, dropping the ones that are not valid for
+    the number of workers and disabling the pinned memory when CUDA is not available."""
+    options = {**DEFAULT_LOADER_OPTIONS, **(options or {})}
+    kwargs = {
+        'num_workers': options['num_workers'],
+        'pin_memory': options['pin_memory'] and torch.cuda.is_available()
+    }
+    if options['num_workers'] > 0:
+        kwargs['persistent_workers'] = options['persistent_workers']
+        kwargs['prefetch_factor'] = options['prefetch_factor']
+    return kwargs
+
+
+def apply_thread_options(options: dict):
+    """Set the number of torch intra-op threads of the main process, if it is present in the options."""
+    if options and options.get('num_threads'):
+        torch.set_num_threads(options['num_threads'])
+
+
+def save_loader_options(options: dict, path: str):
+    """Save the loader options in a json file."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(options, f, indent=2, sort_keys=True)
+
+
+def load_loader_options(path: str) -> dict:
+    """Load the loader options saved with save_loader_options."""
+    with open(path, 'r') as f:
+        return {**DEFAULT_LOADER_OPTIONS, **json.load(f)}
+
+
+def candidate_loader_options(cpu_count: int = None) -> list:
+    """Return the grid of options tried by the auto-tuning: number of workers, prefetch factor and number of intra-op
+    threads left to the main process, that will share the cores with the workers."""
+    cpu_count = cpu_count or os.cpu_count() or 1
+    workers = sorted({0, *[w for w in (1, 2, 4, 8, 12, 16) if w <= cpu_count]})
+
+    candidates = []
+    for num_workers, prefetch_factor in itertools.product(workers, (2, 4)):
+        if num_workers == 0 and prefetch_factor != 2:
+            continue
+        for num_threads in sorted({cpu_count, max(1, cpu_count - num_workers)}):
+            candidates.append({
+                'num_workers': num_workers,
+                'pin_memory': True,
+                # not persistent, so the training workers are seeded again at each epoch and a resume is exact
+                'persistent_workers': False,
+                'prefetch_factor': prefetch_factor if num_workers > 0 else None,
+                'num_threads': num_threads
+            })
+    return candidates
+
+
+def measure_loader_options(dataset, batch_size: int, options: dict, collate_fn=None, num_batches: int = 10,
+                           warmup: int = 2) -> float:
+    """Return the samples per second of a DataLoader over the dataset with the options in input. The first warmup
+    batches, that include the start of the workers, are not considered; the warmup is shortened so that at least one
+    batch is measured, and 0.0 is returned if the dataset has no batch at all."""
+    previous_threads = torch.get_num_threads()
+    apply_thread_options(options)
+    loader = DataLoader(dataset, shuffle=not isinstance(dataset, IterableDataset), batch_size=batch_size,
+                        collate_fn=collate_fn, **loader_kwargs(options))
+    try:
+        iterator = iter(loader)
+        for _ in itertools.islice(iterator, max(0, min(warmup, len(loader) - 1))):
+            pass
+        samples = 0
+        start = time.perf_counter()
+        for batch in itertools.islice(iterator, num_batches):
+            samples += len(batch[-1])
+        if samples == 0:
+            return 0.0
+        return samples / (time.perf_counter() - start)
+    finally:
+        del loader
+        torch.set_num_threads(previous_threads)
+
+
+def autotune_loader_options(dataset, batch_size: int, collate_fn=None, num_batches: int = 10, candidates=None) -> dict:
+    """Run a short probe over the dataset for each candidate configuration and return the one with the highest number
+    of samples per second. The measured throughput is saved in the 'samples_per_sec' field of the returned options.
+    If no batch can be measured, e.g. when the dataset is smaller than a batch, DEFAULT_LOADER_OPTIONS are returned,
+    without the 'samples_per_sec' field.
+
+    Args:
+        dataset (Dataset): Dataset used for the probe, it should be the real training dataset.
+        batch_size (int): Batch size of the probe.
+        collate_fn (function): Collate function of the dataloader.
+        num_batches (int): Number of batches measured for each configuration.
+        candidates (list): List of options to try, default is candidate_loader_options().
+    Returns:
+        dict: The best loader options.
+    """
+    candidates = candidates or candidate_loader_options()
+    num_batches = max(1, min(num_batches, len(dataset) // batch_size - 2))
+
+    best = None
+    for options in candidates if len(dataset) > 0 else []:
+        samples_per_sec = measure_loader_options(dataset, batch_size, options, collate_fn, num_batches)
+        print(f'Loader probe {options}: {samples_per_sec:.1f} samples/sec')
+        if best is None or samples_per_sec > best['samples_per_sec']:
+            best = {**options, 'samples_per_sec': samples_per_sec}
+
+    if best is None or best['samples_per_sec'] <= 0:
+        print(f'Loader probe: no batch measured with {len(dataset)} samples and batch size {batch_size}, using the '
+              f'default loader options')
+        return dict(DEFAULT_LOADER_OPTIONS)
+    print(f'Selected loader options: {best}')
+    return best
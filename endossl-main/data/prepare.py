@@ -3,10 +3,14 @@ Author: Tong Yu
 Copyright (c) University of Strasbourg. All Rights Reserved.
 '''
 
+import io
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import argparse
 import requests
+import urllib3
 import hashlib
 import tarfile
 import os
@@ -15,63 +19,358 @@ import os
 URL = "https://s3.unistra.fr/camma_public/datasets/cholec80/cholec80.tar.gz"
 CHUNK_SIZE = 2 ** 20
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--data_rootdir", default='/home/royhirsch/research-il-lapmsn/cholec80')
-parser.add_argument("--verify_checksum", action="store_true")
-parser.add_argument("--keep_archive", action="store_true")
-args = parser.parse_args()
 
-outfile = os.path.join(args.data_rootdir, "cholec80.tar.gz")
-outdir = os.path.join(args.data_rootdir, "cholec80")
-curr_dir = os.path.dirname(os.path.realpath(__file__))
-config_path = os.path.join(curr_dir, 'config.json')
+class ResumableStream(io.RawIOBase):
+  """Readable stream of the bytes [start, end) of a url. When the connection drops it reconnects with a Range request
+  from the current position, at most retries times without progress, and every byte read updates the hash.
 
-# Download
-print("Downloading archive to {}".format(outfile))
-with requests.get(URL, stream=True) as r:
-  r.raise_for_status()
-  total_length = int(float(r.headers.get("content-length")) / 10 ** 6)
-  progress_bar = tqdm(unit="MB", total=total_length, ncols=150)
-  with open(outfile, "wb") as f:
-    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
-      progress_bar.update(len(chunk) / 10 ** 6)
-      f.write(chunk)
-
-# Optional checksum verification
-if args.verify_checksum:
-  print("Verifying checksum")
+  Args:
+    url: url of the file.
+    start: first byte.
+    end: end of the range (excluded), None for the end of the file.
+    md5: hashlib object updated with the bytes read, or None.
+    progress_bar: tqdm bar updated with the bytes read, or None.
+    retries: reconnections allowed without receiving any byte.
+    timeout: seconds of the connection and read timeouts.
+  """
+
+  def __init__(self, url, start=0, end=None, md5=None, progress_bar=None, retries=5, timeout=60):
+    self.url = url
+    self.position = start
+    self.end = end
+    self.md5 = md5
+    self.progress_bar = progress_bar
+    self.retries = retries
+    self.timeout = timeout
+    self.size = None
+    self._response = None
+
+  def readable(self):
+    return True
+
+  def _connect(self):
+    """Open the response from self.position; a server ignoring the Range header sends the whole file, whose first
+    self.position bytes are skipped."""
+    headers = {}
+    if self.position > 0 or self.end is not None:
+      last = '' if self.end is None else self.end - 1
+      headers['Range'] = 'bytes={}-{}'.format(self.position, last)
+    response = requests.get(self.url, headers=headers, stream=True, timeout=self.timeout)
+    if response.status_code == 416:
+      # Range past the end of the file: nothing left to read
+      response.close()
+      self.size = self.position
+      self.end = self.position
+      return
+    response.raise_for_status()
+    if response.status_code == 206:
+      self.size = int(response.headers['Content-Range'].split('/')[-1])
+    else:
+      self.size = int(response.headers.get('Content-Length', 0)) or None
+      skip = self.position
+      while skip > 0:
+        data = response.raw.read(min(skip, CHUNK_SIZE))
+        if not data:
+          raise ConnectionError('connection closed while skipping to byte {}'.format(self.position))
+        skip -= len(data)
+    if self.end is None and self.size is not None:
+      self.end = self.size
+    self._response = response
+
+  def _close_response(self):
+    if self._response is not None:
+      self._response.close()
+      self._response = None
+
+  def readinto(self, b):
+    failures = 0
+    while True:
+      if self.end is not None and self.position >= self.end:
+        self._close_response()
+        return 0
+      try:
+        if self._response is None:
+          self._connect()
+          continue
+        size = len(b) if self.end is None else min(len(b), self.end - self.position)
+        data = self._response.raw.read(size, decode_content=False)
+        if not data:
+          if self.end is None:
+            return 0
+          raise ConnectionError('connection closed at byte {} of {}'.format(self.position, self.end))
+      except (requests.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+        self._close_response()
+        failures += 1
+        if failures > self.retries:
+          raise
+        print("Connection error at byte {} ({}), resuming".format(self.position, e))
+        continue
+      n = len(data)
+      b[:n] = data
+      self.position += n
+      if self.md5 is not None:
+        self.md5.update(data)
+      if self.progress_bar is not None:
+        self.progress_bar.update(n)
+      return n
+
+  def close(self):
+    self._close_response()
+    super().close()
+
+
+def read_checksum(path):
+  """Return the md5 digest in the checksum file, in the format of md5sum or just the digest."""
+  with open(path) as f:
+    return f.read().split()[0].lower()
+
+
+def check_md5(digest, expected_md5):
+  if expected_md5 is not None and digest != expected_md5.lower():
+    raise ValueError("Checksum mismatch: got {}, expected {}".format(digest, expected_md5))
+  print("Checksum: {}".format(digest))
+
+
+def file_md5(path):
+  """Return the hashlib md5 object of the bytes of the file."""
   m = hashlib.md5()
-  with open(outfile, 'rb') as f:
+  with open(path, 'rb') as f:
     while True:
       data = f.read(CHUNK_SIZE)
       if not data:
         break
       m.update(data)
-  chk = m.hexdigest()
-  with open("checksum.txt") as f:
-    true_chk = f.read()
-  print("Checksum: {}".format(chk))
-  assert(m.hexdigest() == chk)
-
-# Extraction
-print("Extracting files to {}".format(outdir))
-with tarfile.open(outfile, "r") as t:
-  t.extractall(outdir)
-
-# Cleanup
-if not args.keep_archive:
-  os.remove(outfile)
-
-# Config setup
-with open(config_path, "r") as f:
-  config = json.loads(f.read())
-
-config["cholec80_dir"] = outdir
-json_string = json.dumps(config, indent=2, sort_keys=True)
-
-with open(config_path, "w") as f:
-  f.write(json_string)
-
-print("All done - config saved to {}".format(
-  os.path.join(os.getcwd(), "config.json"))
-)
\ No newline at end of file
+  return m
+
+
+def remote_size(url, timeout=60):
+  """Return the size of the file and whether the server accepts Range requests."""
+  r = requests.head(url, allow_redirects=True, timeout=timeout)
+  r.raise_for_status()
+  size = int(r.headers.get('Content-Length', 0)) or None
+  return size, r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+
+
+def download(url, outfile, expected_md5=None, retries=5):
+  """Download url to outfile, hashing the bytes while they are written. The bytes are written to outfile.part, so an
+  interrupted download is resumed from where it stopped, hashing again only the bytes already on disk; the part file is
+  renamed to outfile when it is complete and the checksum, if given, matches.
+
+  Returns:
+    the md5 digest of the file.
+  """
+  if os.path.exists(outfile):
+    print("Archive {} already downloaded".format(outfile))
+    digest = file_md5(outfile).hexdigest()
+    check_md5(digest, expected_md5)
+    return digest
+
+  part = outfile + '.part'
+  if os.path.exists(outfile + '.ranges.json'):
+    # the part file of a parallel download is preallocated, its size is not the bytes downloaded
+    raise ValueError("{} is a parallel download, resume it with --connections 2 or more".format(part))
+  offset = os.path.getsize(part) if os.path.exists(part) else 0
+  m = file_md5(part) if offset else hashlib.md5()
+  print("Downloading archive to {}{}".format(outfile, " from byte {}".format(offset) if offset else ""))
+  progress_bar = tqdm(unit="B", unit_scale=True, unit_divisor=1024, initial=offset, ncols=150)
+  with ResumableStream(url, offset, md5=m, progress_bar=progress_bar, retries=retries) as stream, \
+       open(part, "ab") as f:
+    while True:
+      data = stream.read(CHUNK_SIZE)
+      if not data:
+        break
+      if progress_bar.total is None:
+        progress_bar.total = stream.size
+      f.write(data)
+  progress_bar.close()
+
+  digest = m.hexdigest()
+  try:
+    check_md5(digest, expected_md5)
+  except ValueError:
+    os.remove(part)
+    raise
+  os.replace(part, outfile)
+  return digest
+
+
+def download_parallel(url, outfile, connections=4, expected_md5=None, retries=5):
+  """Download url to outfile with connections ranged requests in parallel, each resumed on its own. The progress of
+  the ranges is saved in outfile.ranges.json, so also an interrupted parallel download is resumed, with any number of
+  connections, and the part file of an interrupted sequential download is continued from its end. The bytes do not
+  arrive in order, so the archive is hashed with a read of the file at the end. Falls back to download() when the
+  server does not accept Range requests.
+
+  Returns:
+    the md5 digest of the file.
+  """
+  size, accept_ranges = remote_size(url)
+  if os.path.exists(outfile) or not accept_ranges or size is None or connections < 2:
+    return download(url, outfile, expected_md5, retries)
+
+  part = outfile + '.part'
+  ranges_path = outfile + '.ranges.json'
+  if os.path.exists(part) and os.path.exists(ranges_path):
+    with open(ranges_path) as f:
+      ranges = json.load(f)
+  else:
+    # the bytes of an interrupted sequential download are kept as a first, completed range
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > size:
+      print("Discarding {}, larger than the remote file".format(part))
+      offset = 0
+    elif offset:
+      print("Resuming the download of {} from byte {}".format(part, offset))
+    bounds = [offset + (size - offset) * i // connections for i in range(connections + 1)]
+    ranges = [[0, offset, offset]] if offset else []
+    ranges += [[bounds[i], bounds[i], bounds[i + 1]] for i in range(connections) if bounds[i] < bounds[i + 1]]
+    # the ranges are saved before the part file is extended, so its size is never taken for the bytes downloaded
+    with open(ranges_path, "w") as f:
+      json.dump(ranges, f)
+    with open(part, "r+b" if offset else "wb") as f:
+      f.truncate(size)
+  lock = threading.Lock()
+  done = sum(position - start for start, position, _ in ranges)
+  print("Downloading archive to {} with {} connections".format(outfile, sum(p < e for _, p, e in ranges)))
+  progress_bar = tqdm(unit="B", unit_scale=True, unit_divisor=1024, total=size, initial=done, ncols=150)
+
+  def save_ranges():
+    with open(ranges_path + '.tmp', "w") as f:
+      json.dump(ranges, f)
+    os.replace(ranges_path + '.tmp', ranges_path)
+
+  def fetch(i, fd):
+    _, position, end = ranges[i]
+    with ResumableStream(url, position, end, progress_bar=progress_bar, retries=retries) as stream:
+      while True:
+        data = stream.read(CHUNK_SIZE)
+        if not data:
+          break
+        os.pwrite(fd, data, ranges[i][1])
+        with lock:
+          ranges[i][1] += len(data)
+          save_ranges()
+
+  fd = os.open(part, os.O_WRONLY)
+  try:
+    with ThreadPoolExecutor(max(1, len(ranges))) as executor:
+      for future in [executor.submit(fetch, i, fd) for i in range(len(ranges))]:
+        future.result()
+  finally:
+    os.close(fd)
+    progress_bar.close()
+
+  digest = file_md5(part).hexdigest()
+  try:
+    check_md5(digest, expected_md5)
+  except ValueError:
+    os.remove(part)
+    raise
+  finally:
+    os.remove(ranges_path)
+  os.replace(part, outfile)
+  return digest
+
+
+def _extract_member(t, member, outdir):
+  # the 'data' filter rejects absolute paths, links outside outdir and device files, where available
+  if hasattr(tarfile, 'data_filter'):
+    t.extract(member, outdir, filter='data')
+  else:
+    t.extract(member, outdir)
+
+
+def extract(archive, outdir):
+  """Extract the archive in outdir reading it sequentially, in a single pass."""
+  print("Extracting files to {}".format(outdir))
+  with tarfile.open(archive, "r|*") as t:
+    for member in t:
+      _extract_member(t, member, outdir)
+
+
+def stream_extract(url, outdir, expected_md5=None, retries=5):
+  """Extract the archive at url in outdir while it is downloaded, without writing it to disk, hashing it at the same
+  time. Dropped connections are resumed with Range requests, but an interrupted run restarts the download from the
+  beginning, since the decompression cannot be resumed.
+
+  Returns:
+    the md5 digest of the archive.
+  """
+  m = hashlib.md5()
+  print("Downloading and extracting files to {}".format(outdir))
+  progress_bar = tqdm(unit="B", unit_scale=True, unit_divisor=1024, ncols=150)
+  with ResumableStream(url, md5=m, progress_bar=progress_bar, retries=retries) as stream:
+    with tarfile.open(fileobj=io.BufferedReader(stream, CHUNK_SIZE), mode="r|*") as t:
+      for member in t:
+        if progress_bar.total is None:
+          progress_bar.total = stream.size
+        _extract_member(t, member, outdir)
+    # the bytes after the end of the tar archive are needed for the checksum
+    while stream.read(CHUNK_SIZE):
+      pass
+  progress_bar.close()
+  digest = m.hexdigest()
+  try:
+    check_md5(digest, expected_md5)
+  except ValueError as e:
+    raise ValueError("{}, the files extracted in {} are not reliable".format(e, outdir))
+  return digest
+
+
+def update_config(config_path, outdir):
+  config = {}
+  if os.path.exists(config_path):
+    with open(config_path, "r") as f:
+      config = json.loads(f.read())
+
+  config["cholec80_dir"] = outdir
+  json_string = json.dumps(config, indent=2, sort_keys=True)
+
+  with open(config_path, "w") as f:
+    f.write(json_string)
+
+
+def main():
+  curr_dir = os.path.dirname(os.path.realpath(__file__))
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--data_rootdir", default='/home/royhirsch/research-il-lapmsn/cholec80')
+  parser.add_argument("--url", default=URL)
+  parser.add_argument("--verify_checksum", action="store_true")
+  parser.add_argument("--checksum_file", default=os.path.join(curr_dir, "checksum.txt"),
+                      help="file with the md5 digest of the archive")
+  parser.add_argument("--keep_archive", action="store_true")
+  parser.add_argument("--stream", action="store_true",
+                      help="extract while downloading, without writing the archive to disk")
+  parser.add_argument("--connections", type=int, default=1, help="parallel ranged requests of the download")
+  parser.add_argument("--retries", type=int, default=5, help="reconnections without progress before giving up")
+  parser.add_argument("--config_path", default=os.path.join(curr_dir, 'config.json'))
+  args = parser.parse_args()
+  if args.verify_checksum and not os.path.isfile(args.checksum_file):
+    parser.error(f"--verify_checksum: checksum file {args.checksum_file} not found, pass the file with the md5 digest "
+                 "of the archive with --checksum_file")
+
+  outfile = os.path.join(args.data_rootdir, "cholec80.tar.gz")
+  outdir = os.path.join(args.data_rootdir, "cholec80")
+  os.makedirs(args.data_rootdir, exist_ok=True)
+  expected_md5 = read_checksum(args.checksum_file) if args.verify_checksum else None
+
+  if args.stream:
+    if args.keep_archive:
+      parser.error("--keep_archive can not be used with --stream")
+    stream_extract(args.url, outdir, expected_md5, args.retries)
+  else:
+    if args.connections > 1:
+      download_parallel(args.url, outfile, args.connections, expected_md5, args.retries)
+    else:
+      download(args.url, outfile, expected_md5, args.retries)
+    extract(outfile, outdir)
+    # Cleanup
+    if not args.keep_archive:
+      os.remove(outfile)
+
+  update_config(args.config_path, outdir)
+  print("All done - config saved to {}".format(args.config_path))
+
+
+if __name__ == '__main__':
+  main()
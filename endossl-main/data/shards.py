@@ -0,0 +1,237 @@
+"""Module for the sharded streaming format of the Cholec80 dataset.
+
+The frames are packed, with their labels, in large tar files (shards), so that the training reads a few big files
+sequentially instead of tens of thousands of small PNG files in random order. Each sample is saved as two members of
+the tar file with the same key, e.g. video01_000042.png with the original PNG bytes and video01_000042.cls with the
+label. Each writer saves also a <prefix>.shards.json file with the name, the number of samples and the videos of each
+of its shards, used by the reader for knowing the length of the dataset and for selecting the shards of a split.
+
+The shards of a split can be created running
+
+    python data/shards.py --data_root cholec80 --shards_dir cholec80/shards --split train
+
+be sure to have your terminal running in the endossl-main folder.
+"""
+
+import os
+import io
+import sys
+import glob
+import json
+import random
+import tarfile
+import argparse
+
+import numpy as np
+import torch
+import torchvision
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+
+
+class ShardWriter:
+    """Writer of tar shards with at most max_count samples each. The shards are written with a temporary name and
+    renamed only when complete, and the <prefix>.shards.json index is saved when the writer is closed.
+
+    Args:
+        shards_dir (str): Directory where to save the shards.
+        prefix (str): Prefix of the shard names, the shards are named <prefix>-000000.tar, <prefix>-000001.tar, ...
+        max_count (int): Maximum number of samples in each shard.
+    """
+    def __init__(self, shards_dir: str, prefix: str = 'shard', max_count: int = 1000):
+        self.shards_dir = shards_dir
+        self.prefix = prefix
+        self.max_count = max_count
+        self.shards = []
+        self._tar = None
+        os.makedirs(shards_dir, exist_ok=True)
+
+    def _add_member(self, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def _close_shard(self):
+        if self._tar is None:
+            return
+        self._tar.close()
+        shard = self.shards[-1]
+        path = os.path.join(self.shards_dir, shard['name'])
+        os.replace(path + '.tmp', path)
+        shard['videos'] = sorted(shard['videos'])
+        self._tar = None
+
+    def write(self, key: str, png_bytes: bytes, label: int, video_id: str):
+        """Add a sample to the current shard, opening a new shard when the current one is full."""
+        if self._tar is None or self.shards[-1]['count'] == self.max_count:
+            self._close_shard()
+            name = f'{self.prefix}-{len(self.shards):06d}.tar'
+            self._tar = tarfile.open(os.path.join(self.shards_dir, name + '.tmp'), 'w')
+            self.shards.append({'name': name, 'count': 0, 'videos': set()})
+
+        self._add_member(key + '.png', png_bytes)
+        self._add_member(key + '.cls', str(int(label)).encode())
+        self.shards[-1]['count'] += 1
+        self.shards[-1]['videos'].add(video_id)
+
+    def close(self) -> list:
+        """Close the last shard and save the index of the shards of this writer."""
+        self._close_shard()
+        with open(os.path.join(self.shards_dir, self.prefix + '.shards.json'), 'w') as f:
+            json.dump({'shards': self.shards}, f, indent=2)
+        return self.shards
+
+
+def write_shards(dataset, shards_dir: str, shard_size: int = 1000, shuffle: bool = True, seed: int = 0,
+                 prefix: str = 'shard') -> list:
+    """Pack the frames of a CustomCholec80Dataset in tar shards. The PNG files are copied as they are, without decoding
+    them, so the reader returns exactly the same images of the dataset.
+
+    Args:
+        dataset (CustomCholec80Dataset): Dataset over the PNG frames.
+        shards_dir (str): Directory where to save the shards.
+        shard_size (int): Number of samples in each shard.
+        shuffle (bool): If True the frames are written in random order, so that each shard contains frames from
+        different videos and the reader shuffle buffer only needs to mix close samples.
+        seed (int): Seed of the random order.
+        prefix (str): Prefix of the shard names.
+    Returns:
+        list: The index of the written shards.
+    """
+    order = np.arange(len(dataset))
+    if shuffle:
+        np.random.default_rng(seed).shuffle(order)
+
+    writer = ShardWriter(shards_dir, prefix, shard_size)
+    for idx in tqdm(order, desc='Writing shards', ncols=100):
+        path = dataset.all_frame_names[idx]
+        with open(path, 'rb') as f:
+            png_bytes = f.read()
+        key = os.path.splitext(os.path.basename(path))[0]
+        writer.write(key, png_bytes, dataset.all_labels[idx], str(dataset.all_videos[idx]))
+    return writer.close()
+
+
+def read_shard_index(shards_dir: str, video_ids=None) -> list:
+    """Read the .shards.json files of the directory and return the shards containing only frames of the videos in
+    video_ids, or all the shards if video_ids is None."""
+    shards = []
+    for index_path in sorted(glob.glob(os.path.join(shards_dir, '*.shards.json'))):
+        with open(index_path, 'r') as f:
+            shards += json.load(f)['shards']
+
+    if video_ids is not None:
+        video_ids = set(video_ids)
+        shards = [s for s in shards if set(s['videos']) <= video_ids]
+        missing = video_ids - set(v for s in shards for v in s['videos'])
+        if missing:
+            raise FileNotFoundError(f'Videos {sorted(missing)} are not present in the shards of {shards_dir}')
+    return shards
+
+
+def iterate_shard(path: str):
+    """Read a shard sequentially, yielding (key, png_bytes, label) for each sample."""
+    with tarfile.open(path, mode='r|') as tar:
+        key, png_bytes, label = None, None, None
+        for member in tar:
+            member_key, ext = os.path.splitext(member.name)
+            data = tar.extractfile(member).read()
+            if member_key != key:
+                key, png_bytes, label = member_key, None, None
+            if ext == '.png':
+                png_bytes = data
+            elif ext == '.cls':
+                label = int(data)
+            if png_bytes is not None and label is not None:
+                yield key, png_bytes, label
+                key, png_bytes, label = None, None, None
+
+
+class ShardedCholec80Dataset(IterableDataset):
+    """Iterable dataset that streams the Cholec80 frames from the tar shards written by write_shards. The shards are
+    split among the DataLoader workers, each worker reads its shards sequentially and, if shuffle_buffer is greater than
+    0, returns the samples in random order using a buffer of that size.
+
+    The order of the shards is shuffled with a seed that is the same for all the workers of an epoch (it is derived from
+    the base seed of the DataLoader), and changes at every epoch as the shuffle of a map-style dataset.
+
+    Args:
+        shards_dir (str): Directory of the shards.
+        video_ids (list): List of the video ids to use, only the shards of these videos are read.
+        transform (function): Transformation function to apply to the images.
+        double_img (bool): If True, the dataset returns two transformations of the same decoded image.
+        shuffle_buffer (int): Size of the shuffle buffer, 0 for reading the samples in the order of the shards.
+        shuffle_shards (bool): If True the order of the shards is shuffled at each epoch.
+    """
+    def __init__(self, shards_dir, video_ids=None, transform=None, double_img=False, shuffle_buffer=0,
+                 shuffle_shards=False):
+        super(ShardedCholec80Dataset, self).__init__()
+        self.shards_dir = shards_dir
+        self.video_ids = video_ids
+        self.transform = transform
+        self.double_img = double_img
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle_shards = shuffle_shards
+        self.shards = read_shard_index(shards_dir, video_ids)
+
+    def __len__(self):
+        return sum(shard['count'] for shard in self.shards)
+
+    def worker_shards(self) -> (list, random.Random):
+        """Return the shards assigned to the current worker and a random generator for its shuffle buffer."""
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            epoch_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            epoch_seed = worker_info.seed - worker_info.id
+
+        shards = list(self.shards)
+        if self.shuffle_shards:
+            random.Random(epoch_seed).shuffle(shards)
+        return shards[worker_id::num_workers], random.Random(epoch_seed + worker_id)
+
+    def parse_sample(self, png_bytes: bytes, label: int):
+        """Decode the image and apply the transformation, returning the same tuple of CustomCholec80Dataset."""
+        img = torchvision.io.decode_png(torch.frombuffer(bytearray(png_bytes), dtype=torch.uint8))
+        if self.double_img:
+            return self.transform(img), self.transform(img), label
+        return self.transform(img), label
+
+    def __iter__(self):
+        shards, rng = self.worker_shards()
+        buffer = []
+        for shard in shards:
+            for _, png_bytes, label in iterate_shard(os.path.join(self.shards_dir, shard['name'])):
+                sample = self.parse_sample(png_bytes, label)
+                if self.shuffle_buffer <= 0:
+                    yield sample
+                    continue
+                buffer.append(sample)
+                if len(buffer) >= self.shuffle_buffer:
+                    i = rng.randrange(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield buffer.pop()
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+if __name__ == '__main__':
+
+    sys.path.append(os.path.realpath(__file__ + '/../../'))
+    from data import cholec80_images
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', default=os.path.join('cholec80'))
+    parser.add_argument('--shards_dir', default=os.path.join('cholec80', 'shards'))
+    parser.add_argument('--split', default='train', choices=list(cholec80_images._CHOLEC80_SPLIT.keys()))
+    parser.add_argument('--shard_size', type=int, default=1000)
+    args = parser.parse_args()
+
+    dataset = cholec80_images.CustomCholec80Dataset(
+        args.data_root,
+        [f'video{i:02}' for i in cholec80_images._CHOLEC80_SPLIT[args.split]]
+    )
+    write_shards(dataset, args.shards_dir, args.shard_size, shuffle=args.split == 'train', prefix=args.split)
+    print(f'Shards of the {args.split} split saved to {args.shards_dir}')
@@ -0,0 +1,132 @@
+"""Module for generating a synthetic dataset with the structure of Cholec80, for running and benchmarking the training
+scripts without the real videos.
+
+The generated tree has the same layout read by CustomCholec80Dataset:
+
+    data_root
+    ├── frames
+    │   ├── video01
+    │   │   ├── video01_000001.png
+    │   │   └── ...
+    │   └── ...
+    └── phase_annotations
+        ├── video01-phase.txt
+        └── ...
+
+The frames of a video are smooth random images that change slowly from one frame to the next, with some pixel noise,
+so the PNG files have a size and a decoding cost closer to the real frames than uniform noise. The annotation files
+contain a label for each frame of the original 25 fps video, i.e. _SUBSAMPLE_RATE labels for each extracted frame, with
+the seven phases in their surgical order and random durations. The dataset can be created running
+
+    python data/synthetic.py --data_root synthetic_cholec80 --num_videos 20 --frames_per_video 100
+
+be sure to have your terminal running in the endossl-main folder.
+"""
+
+import os
+import sys
+import argparse
+
+import numpy as np
+import torch
+import torchvision
+from tqdm import tqdm
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data.cholec80_images import _LABEL_NUM_MAPPING, _SUBSAMPLE_RATE
+
+# phases of the cholecystectomy in the order in which they are performed
+_PHASE_ORDER = ['Preparation', 'CalotTriangleDissection', 'ClippingCutting', 'GallbladderDissection',
+                'GallbladderPackaging', 'CleaningCoagulation', 'GallbladderRetraction']
+
+assert set(_PHASE_ORDER) == set(_LABEL_NUM_MAPPING)
+
+
+def synthetic_frames(num_frames: int, height: int = 480, width: int = 854, keyframe_every: int = 10,
+                     noise_std: float = 4., generator: torch.Generator = None):
+    """Yield num_frames uint8 images (3, height, width). The images are low resolution random keyframes, linearly
+    interpolated in time and upsampled, plus gaussian noise."""
+    latent_size = (max(2, height // 32), max(2, width // 32))
+    previous = torch.rand((1, 3) + latent_size, generator=generator) * 255
+    following = torch.rand((1, 3) + latent_size, generator=generator) * 255
+    for k in range(num_frames):
+        if k > 0 and k % keyframe_every == 0:
+            previous, following = following, torch.rand((1, 3) + latent_size, generator=generator) * 255
+        alpha = (k % keyframe_every) / keyframe_every
+        latent = torch.lerp(previous, following, alpha)
+        image = torch.nn.functional.interpolate(latent, size=(height, width), mode='bilinear', align_corners=False)[0]
+        image = image + torch.randn(image.shape, generator=generator) * noise_std
+        yield image.round().clamp(0, 255).to(torch.uint8)
+
+
+def synthetic_phase_labels(num_labels: int, rng: np.random.Generator) -> list:
+    """Return the phase names of num_labels consecutive frames, with the phases in surgical order and random lengths,
+    each phase lasting at least one frame when there are enough frames."""
+    proportions = rng.dirichlet(np.full(len(_PHASE_ORDER), 2.))
+    ends = np.round(np.cumsum(proportions) * num_labels).astype(int)
+    ends[-1] = num_labels
+    if num_labels >= len(_PHASE_ORDER):
+        num_phases = len(_PHASE_ORDER)
+        for i in range(num_phases):
+            ends[i] = min(max(ends[i], ends[i - 1] + 1 if i > 0 else 1), num_labels - (num_phases - 1 - i))
+    labels, start = [], 0
+    for phase, end in zip(_PHASE_ORDER, ends):
+        labels += [phase] * max(0, end - start)
+        start = max(start, end)
+    return labels
+
+
+def write_synthetic_video(data_root: str, video_id: str, num_frames: int, height: int = 480, width: int = 854,
+                          seed: int = 0):
+    """Write the frames and the annotation file of a synthetic video."""
+    frames_dir = os.path.join(data_root, 'frames', video_id)
+    annos_dir = os.path.join(data_root, 'phase_annotations')
+    os.makedirs(frames_dir, exist_ok=True)
+    os.makedirs(annos_dir, exist_ok=True)
+
+    generator = torch.Generator().manual_seed(seed)
+    for k, image in enumerate(synthetic_frames(num_frames, height, width, generator=generator), 1):
+        torchvision.io.write_png(image, os.path.join(frames_dir, f'{video_id}_{k:06d}.png'))
+
+    labels = synthetic_phase_labels(num_frames * _SUBSAMPLE_RATE, np.random.default_rng(seed))
+    with open(os.path.join(annos_dir, video_id + '-phase.txt'), 'w') as f:
+        f.write('Frame\tPhase\n')
+        f.writelines(f'{i}\t{phase}\n' for i, phase in enumerate(labels))
+
+
+def generate_synthetic_cholec80(data_root: str, num_videos: int = 20, frames_per_video: int = 100,
+                                height: int = 480, width: int = 854, seed: int = 0) -> list:
+    """Write a synthetic Cholec80 tree in data_root with the videos video01 ... videoN.
+
+    Args:
+        data_root (str): Root folder of the dataset, it will contain the frames and phase_annotations folders.
+        num_videos (int): Number of videos, numbered from 01 as the real ones, so the splits of cholec80_images.py
+        select the same video ids.
+        frames_per_video (int): Number of extracted frames of each video.
+        height (int): Height of the frames, the real ones are 480x854.
+        width (int): Width of the frames.
+        seed (int): Seed of the generation, each video uses seed + its number.
+    Returns:
+        list: The ids of the generated videos.
+    """
+    video_ids = [f'video{i:02}' for i in range(1, num_videos + 1)]
+    for i, video_id in enumerate(tqdm(video_ids, desc='Synthetic videos', ncols=100), 1):
+        write_synthetic_video(data_root, video_id, frames_per_video, height, width, seed + i)
+    return video_ids
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_root', default=os.path.join('synthetic_cholec80'))
+    parser.add_argument('--num_videos', type=int, default=20)
+    parser.add_argument('--frames_per_video', type=int, default=100)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--width', type=int, default=854)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_synthetic_cholec80(args.data_root, args.num_videos, args.frames_per_video, args.height, args.width,
+                                args.seed)
+    print(f'Synthetic Cholec80 dataset saved to {args.data_root}')
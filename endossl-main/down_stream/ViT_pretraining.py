@@ -1,17 +1,27 @@
 import sys
 import os
-import math
+import argparse
+import functools
+import contextlib
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 sys.path.append(os.path.realpath(__file__ + '/../../'))
 
 from data import cholec80_images
+from down_stream import precision
+from down_stream import distributed
+from down_stream import memory_budget
+from down_stream import checkpointing
+from down_stream.instrumentation import StepTimer
+from down_stream.scalar_writer import BufferedScalarWriter
 from models.MyViTMSN_pretraining import MyViTMSNModel_pretraining
+from models.msn_loss import MSNLoss
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -24,9 +34,30 @@ class Config:
     dataset_name = 'cholec80'
     data_root = os.path.join('cholec80')
 
-    # metrics
+    # dataloaders, if autotune_loader is True the options are measured on this machine and saved in loader_options_path;
+    # the training workers are started again at each epoch with a seed of the epoch, so a resumed training is exact
+    loader_options = {'num_workers': min(4, os.cpu_count() or 1), 'pin_memory': True,
+                      'persistent_workers': False, 'prefetch_factor': 2}
+    autotune_loader = False
+    loader_options_path = os.path.join(exp_dir, 'loader_options.json')
+    storage = 'png'
+    batched_augment = True
+
+    # near-duplicate sampling: each epoch draws samples_per_cluster frames from each cluster of consecutive
+    # near-duplicate frames of a video, instead of every frame; the index must be built first with data/dedup.py
+    cluster_sampling = False
+    samples_per_cluster = 1
+
+    # metrics, the best checkpoint is the one with the lowest training loss
     task_type = 'multi_class'
-    monitor_metric = 'val_macro_f1'
+    monitor_metric = 'train_loss'
+    monitor_mode = 'min'
+
+    # number of most recent checkpoints kept in addition to the best one, see checkpointing.py
+    keep_checkpoints = 3
+
+    # number of step losses buffered before writing them to tensorboard, see down_stream/scalar_writer.py
+    log_every = 50
 
     # optimization
     optimize_name = 'adamw'
@@ -34,107 +65,339 @@ class Config:
     weight_decay = 0.01
     lambda_val = 1
 
+    # loss, see models/msn_loss.py: weights of the regularizations and temperature sharpening the target probabilities
+    me_max_weight = 5.
+    entropy_weight = 1.
+    target_sharpening = 0.25
+
+    # masking of the anchor images, see MyViTMSNModel_pretraining.mask_generator
+    mask_ratio = 0.5
+    mask_strategy = 'random'
+    drop_masked_patches = True
+
+    # multi-crop: number of global anchor views and of low resolution focal anchor views of each image, all sharing the
+    # same target view; with more than one anchor view the loss is averaged over all of them
+    num_global_views = 1
+    num_focal_views = 0
+    focal_size = 96
+
     # training
     num_epochs = 30
     batch_size = 200
 
-
-def me_max_regularization(anchor: torch.Tensor):
-    """Function that calculate the ME-MAX value for the regularization term
+    # memory budget: with micro_batch_size smaller than batch_size each batch is split in micro-batches and the
+    # gradients are accumulated, keeping the same loss of the whole batch, ME-MAX included. With 'auto' it is used the
+    # largest micro-batch whose step fits in memory_budget_mb, see memory_budget.py; with memory_budget_mb None it is
+    # the total memory of the GPU, on the CPU the budget must be set. With gradient_checkpointing the
+    # activations of the anchor encoder layers are recomputed in the backward instead of being kept in memory
+    micro_batch_size = None
+    memory_budget_mb = None
+    gradient_checkpointing = False
+
+    # precision of the forward: 'fp32', 'bf16' or 'fp16', see down_stream/precision.py
+    precision = 'fp32'
+    channels_last = False
+
+    # distributed data-parallel: number of processes spawned on this machine when the script is not started by
+    # torchrun, and backend of the process group (None for nccl with CUDA and gloo otherwise), see distributed.py
+    world_size = 1
+    dist_backend = None
+    seed = 0
+
+    # per-step timing of the phases (data, forward, backward, optimizer, EMA, logging, checkpoint) of the main process,
+    # exported at the end of the training in exp_dir/instrumentation, see instrumentation.py. With profile_steps =
+    # (first_step, num_steps) that window of steps is also recorded with torch.profiler. With instrument_sync the timer
+    # waits for the GPU at the phase boundaries, for the real GPU time of each phase at the cost of some throughput
+    instrument = False
+    instrument_sync = False
+    profile_steps = None
+
+
+def accumulate_gradients(model, msn_model, criterion: MSNLoss, inputs_anchor, inputs_target, micro_batch_size: int,
+                         scaler, device) -> torch.Tensor:
+
+    """Compute the gradients of the loss of a whole batch, splitting it in micro-batches and accumulating their
+    gradients, so that only the activations of a micro-batch are kept in memory.
+
+    The cross entropy and the entropy are means over the anchors, so each micro-batch contributes with its mean scaled
+    by its share of the anchors. The ME-MAX instead depends on the average anchor of the whole batch: it is first
+    computed with a forward of the anchor branch without gradients over all the micro-batches, then each micro-batch
+    adds the linear term sum(p * g) / N, where g = log(avg_anchor) + 1 is the gradient of the ME-MAX with respect to
+    the average anchor, that gives exactly the gradient of the ME-MAX of the whole batch, see
+    MSNLoss.micro_batch_loss. The state of the random generator is restored before each micro-batch, so the two passes
+    use the same masks.
 
     Parameters:
-        anchor (torch.Tensor): The anchor output tensor of shape (batch_size, num_classes)
+        model: The model, optionally wrapped in DistributedDataParallel, used for the forward with gradients
+        msn_model (MyViTMSNModel_pretraining): The model without the wrapper
+        criterion (MSNLoss): The loss
+        inputs_anchor: The anchor images of the batch, or the list of the anchor views
+        inputs_target (torch.Tensor): The target images of the batch
+        micro_batch_size (int): The number of images of each micro-batch
+        scaler (torch.amp.GradScaler): The gradient scaler of the precision
+        device: The device of the model
     Returns:
-        the value of the ME-MAX regularization term
-
+        the loss of the whole batch, detached
     """
 
-    avg_anchor = torch.mean(anchor, dim=0)
-    me_max_loss = - torch.sum(torch.log(avg_anchor**(-avg_anchor))) + math.log(float(len(avg_anchor)))
-    return me_max_loss
+    micro_batches = memory_budget.split_micro_batches(inputs_anchor, inputs_target, micro_batch_size)
+
+    rng_states, anchor_sum, num_anchors = [], 0., 0
+    with torch.inference_mode():
+        for anchor, _ in micro_batches:
+            rng_states.append(memory_budget.get_rng_state(device))
+            with precision.autocast(Config.precision, device):
+                output_anchor = msn_model.anchor_logits(anchor)
+            anchor_sum = anchor_sum + nn.functional.softmax(output_anchor.float(), dim=1).sum(dim=0)
+            num_anchors += output_anchor.shape[0]
+        avg_anchor = distributed.reduce_mean(anchor_sum / num_anchors)
+        me_max_value, me_max_grad = criterion.me_max_linearization(avg_anchor)
+    me_max_grad = me_max_grad.clone()
+
+    loss_value = criterion.me_max_weight * me_max_value.clone()
+    for j, ((anchor, target), rng_state) in enumerate(zip(micro_batches, rng_states)):
+        memory_budget.set_rng_state(rng_state, device)
+        # the gradients are all-reduced by DistributedDataParallel only in the backward of the last micro-batch
+        last = j == len(micro_batches) - 1
+        sync = model.no_sync() if isinstance(model, DistributedDataParallel) and not last else contextlib.nullcontext()
+        with sync:
+            with precision.autocast(Config.precision, device):
+                output_anchor, output_target = model(anchor, target)
+            loss, micro_loss = criterion.micro_batch_loss(output_anchor, output_target, me_max_grad, num_anchors)
+            scaler.scale(loss).backward()
+        loss_value = loss_value + micro_loss.detach()
+
+    return loss_value
+
+
+def probe_micro_batch_size(msn_model, criterion: MSNLoss, trainable_parameters: list, device,
+                           memory_budget_mb: float) -> int:
+
+    """Find the largest micro-batch size that fits in memory_budget_mb, running forward and backward steps of
+    the model on random images with the same shapes of the training batches. The memory of the AdamW state, two
+    tensors for each trainable parameter, is reserved since it is allocated only at the first optimizer step."""
+
+    def step(batch_size):
+        target = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8, device=device)
+        if Config.num_global_views != 1 or Config.num_focal_views > 0:
+            focal = (batch_size, 3, Config.focal_size, Config.focal_size)
+            anchor = [torch.randint_like(target, 256) for _ in range(Config.num_global_views)]
+            anchor += [torch.randint(0, 256, focal, dtype=torch.uint8, device=device) for _ in range(Config.num_focal_views)]
+        else:
+            anchor = torch.randint_like(target, 256)
+        with precision.autocast(Config.precision, device):
+            output_anchor, output_target = msn_model(anchor, target)
+        # without the ME-MAX, that in the distributed training would synchronize the processes probing different sizes
+        log_probs = nn.functional.log_softmax(output_anchor.float(), dim=1)
+        loss = criterion.cross_entropy_and_entropy(log_probs, output_target)
+        loss.backward()
+        msn_model.zero_grad(set_to_none=True)
+
+    reserved_mb = 2 * sum(p.numel() * p.element_size() for p in trainable_parameters) / 2 ** 20
+    micro_batch_size, _ = memory_budget.probe_micro_batch_size(step, memory_budget_mb, Config.batch_size, reserved_mb)
+    print(f'Micro-batch size for a memory budget of {memory_budget_mb:.0f} MB: {micro_batch_size}')
+    return micro_batch_size
+
+
+def training_loop(resume: str = None):
 
-def entropy_regularization(anchor: torch.Tensor):
+    """The training loop for the pretraining of the ViTMSN model. Following the original code, since it is a SSL model,
+    it is only applied the training part, without the validation that it can be tricky to implement in this case.
 
-    """Function that calculate the entropy value for the regularization term
+    The dataloader is created with the double_img parameter set to True, so it will return the anchor and target images,
+    same image with different augmentations, to be used in the model. With Config.batched_augment the image is decoded
+    only once and the two views are generated for the whole batch at once in the collate function. With
+    Config.num_global_views and Config.num_focal_views the batch contains a list of anchor views instead of a single
+    anchor, the target is repeated for each of them so the cross entropy is averaged over all the anchor views, while
+    the regularization terms are computed on the anchor probabilities of all the views. With Config.cluster_sampling
+    an epoch draws only Config.samples_per_cluster frames from each cluster of near-duplicate frames, see
+    data/dedup.py, so it is shorter and the momentum schedule is computed on its number of steps.
 
-    Parameters:
-        anchor (torch.Tensor): The anchor output tensor of shape (batch_size, num_classes)
-    Returns:
-        the value of the entropy regularization term
-    """
+    The loss is computed by MSNLoss from the anchor logits and the target probabilities sharpened by
+    Config.target_sharpening, that the model computes in inference mode, see models/msn_loss.py.
 
-    return torch.mean(torch.sum(torch.log(anchor**(-anchor)), dim=1))
+    The forward can be executed in mixed precision setting Config.precision to 'bf16' or 'fp16', in this case the losses
+    are still computed in fp32 and the EMA target and the prototypes are kept in fp32.
 
+    With Config.micro_batch_size smaller than the batch size the gradients are accumulated over micro-batches, see
+    accumulate_gradients, so the effective batch size and the ME-MAX statistics are the ones of Config.batch_size.
 
+    In the distributed training, see distributed.launch, every process reads a different part of the training set with
+    a DistributedSampler and the model is wrapped in DistributedDataParallel, so the gradients of the anchor ViT and of
+    the prototypes are averaged over the processes. All the processes start from the same weights and apply the same
+    updates, so the EMA target is identical on every rank. The checkpoints and the logs are written only by the rank 0.
 
-def training_loop():
+    The loss is updated with the regularizations terms and after the backpropagation is applied also the exponential moving
+    average for updating the target network. To each epoch, the model is saved and the loss is saved in the models_details.txt
+    file that contains all the information for each epoch. It is also updated the tensorboard logs with the loss values,
+    buffered on the device and written every Config.log_every steps, so the loop does not wait for the device at each step.
 
-    """The training loop for the pretraining of the ViTMSN model. Following the original code, since it is a SSL model,
-    it is only applied the training part, without the validation that it can be tricky to implement in this case.
+    The checkpoints are written in background by an AsyncCheckpointer and contain also the optimizer, the gradient
+    scaler, the position in the momentum schedule and the random state of every process, so that the training can be
+    resumed from one of them. Only the last Config.keep_checkpoints checkpoints and the best one are kept.
 
-    The dataloader is created with the double_img parameter set to True, so it will return the anchor and target images,
-    same image with different augmentations, to be used in the model.
+    With Config.instrument or Config.profile_steps the main process measures the time of each phase of the steps with a
+    StepTimer, that at the end of the training writes a summary and a Chrome trace in exp_dir/instrumentation.
 
-    The loss is updated with the regularizations terms and after the backpropagation is applied also the exponential moving
-    average for updating the target network. To each epoch, the model is saved and the loss is saved in the models_details.txt
-    file that contains all the information for each epoch. It is also updated the tensorboard logs with the loss values.
+    Parameters:
+        resume (str): Path of the checkpoint from which to resume the training, None for starting a new training
     """
 
+    device = distributed.local_device()
+    main_process = distributed.is_main_process()
+
+    # checked before building the model, the probe of the 'auto' micro-batch needs a memory budget
+    memory_budget_mb = Config.memory_budget_mb
+    if Config.micro_batch_size == 'auto' and memory_budget_mb is None:
+        if device.type != 'cuda':
+            raise ValueError("Config.micro_batch_size = 'auto' requires Config.memory_budget_mb on the CPU")
+        memory_budget_mb = torch.cuda.get_device_properties(device).total_memory / 2 ** 20
+
+    loader_generator = torch.Generator()
     datasets = cholec80_images.get_pytorch_dataloaders(
         data_root=Config.data_root,
         batch_size=Config.batch_size,
-        double_img=True
+        double_img=True,
+        storage=Config.storage,
+        batched_augment=Config.batched_augment,
+        loader_options=Config.loader_options,
+        autotune_loader=Config.autotune_loader,
+        loader_options_path=Config.loader_options_path,
+        num_global_views=Config.num_global_views,
+        num_focal_views=Config.num_focal_views,
+        focal_size=Config.focal_size,
+        distributed=distributed.is_distributed(),
+        cluster_sampling=Config.cluster_sampling,
+        samples_per_cluster=Config.samples_per_cluster,
+        generator=loader_generator
     )
 
-    model = MyViTMSNModel_pretraining(ipe=len(datasets['train']), num_epochs=Config.num_epochs, device=device)
+    # the same seed on every process for the same initial weights, then a different seed for masks and augmentations
+    torch.manual_seed(Config.seed)
+
+    model = MyViTMSNModel_pretraining(ipe=len(datasets['train']), num_epochs=Config.num_epochs, device=device,
+                                      mask_ratio=Config.mask_ratio, mask_strategy=Config.mask_strategy,
+                                      drop_masked_patches=Config.drop_masked_patches,
+                                      gradient_checkpointing=Config.gradient_checkpointing,
+                                      target_sharpening=Config.target_sharpening)
     model.to(device)
+    if Config.channels_last:
+        model.to(memory_format=torch.channels_last)
+    msn_model = model
+    if distributed.is_distributed():
+        model = DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None)
+    torch.manual_seed(Config.seed + distributed.get_rank())
 
-    trainable_parameters = filter(lambda p: p.requires_grad, model.parameters())
+    trainable_parameters = [p for p in model.parameters() if p.requires_grad]
+    criterion = MSNLoss(Config.me_max_weight, Config.entropy_weight,
+                        distributed.all_reduce_mean if distributed.is_distributed() else None)
 
-    optimizer = optim.AdamW(trainable_parameters, lr=Config.learning_rate, weight_decay=Config.weight_decay)
-    cross_entropy_criterion = nn.CrossEntropyLoss()
-    writer = SummaryWriter(log_dir=os.path.join(Config.exp_dir, 'tb_logs'))
+    micro_batch_size = Config.micro_batch_size or Config.batch_size
+    if micro_batch_size == 'auto':
+        micro_batch_size = probe_micro_batch_size(msn_model, criterion, trainable_parameters, device, memory_budget_mb)
 
-    for epoch in range(Config.num_epochs):
+    optimizer = optim.AdamW(trainable_parameters, lr=Config.learning_rate, weight_decay=Config.weight_decay)
+    scaler = precision.grad_scaler(Config.precision, device)
+    writer = SummaryWriter(log_dir=os.path.join(Config.exp_dir, 'tb_logs')) if main_process else None
+    step_writer = BufferedScalarWriter(writer, Config.log_every) if main_process else None
+    checkpointer = checkpointing.AsyncCheckpointer(os.path.join(Config.exp_dir, 'checkpoints'), Config.keep_checkpoints,
+                                                   Config.monitor_metric, Config.monitor_mode) if main_process else None
+
+    instrumentation_dir = os.path.join(Config.exp_dir, 'instrumentation')
+    timer = StepTimer(main_process and Config.instrument, Config.instrument_sync,
+                      Config.profile_steps if main_process else None, instrumentation_dir)
+    timer.time_module(msn_model.preprocess, 'preprocess')
+    timer.time_module(msn_model.vitMsn_anchor.encoder, 'anchor_encoder')
+    timer.time_module(msn_model.vitMsn_target, 'target_vit')
+
+    start_epoch, step = 0, 0
+    if resume is not None:
+        checkpoint = checkpointing.resume(resume, msn_model, optimizer, scaler, checkpointer, distributed.get_rank())
+        start_epoch, step = checkpoint['epoch'] + 1, checkpoint['step']
+
+    for epoch in range(start_epoch, Config.num_epochs):
 
         '''Train loop'''
         running_train_loss = 0.0
-        bar = tqdm(total=len(datasets['train']), desc=f'Train of epoch {epoch+1}', ncols=100)
+        bar = tqdm(total=len(datasets['train']), desc=f'Train of epoch {epoch+1}', ncols=100, disable=not main_process)
         model.train()
-        model.train_phase = True
-
-        for i, (inputs_anchor, inputs_target, _) in enumerate(datasets['train'], 0):
-
-            inputs_anchor, inputs_target = inputs_anchor.to(device), inputs_target.to(device)
+        msn_model.train_phase = True
+        if hasattr(datasets['train'].sampler, 'set_epoch'):
+            datasets['train'].sampler.set_epoch(epoch)
+        checkpointing.seed_loader_generator(loader_generator, Config.seed, epoch, distributed.get_rank())
+
+        for i, (inputs_anchor, inputs_target, _) in enumerate(timer.iterate(datasets['train']), 0):
+
+            with timer.phase('to_device'):
+                if isinstance(inputs_anchor, list):
+                    inputs_anchor = [precision.to_channels_last(view.to(device, non_blocking=True), Config.channels_last)
+                                     for view in inputs_anchor]
+                else:
+                    inputs_anchor = precision.to_channels_last(inputs_anchor.to(device, non_blocking=True), Config.channels_last)
+                inputs_target = inputs_target.to(device, non_blocking=True)
+                inputs_target = precision.to_channels_last(inputs_target, Config.channels_last)
             optimizer.zero_grad()
 
-            output_anchor, output_target = model(inputs_anchor, inputs_target)
-
-            loss_value = cross_entropy_criterion(output_anchor, output_target) + 5 * me_max_regularization(output_anchor) + entropy_regularization(output_anchor)
+            if micro_batch_size < len(inputs_target):
+                with timer.phase('forward_backward'):
+                    loss_value = accumulate_gradients(model, msn_model, criterion, inputs_anchor, inputs_target,
+                                                      micro_batch_size, scaler, device)
+            else:
+                with timer.phase('forward'):
+                    with precision.autocast(Config.precision, device):
+                        output_anchor, output_target = model(inputs_anchor, inputs_target)
+                    loss_value = criterion(output_anchor, output_target)
+                with timer.phase('backward'):
+                    scaler.scale(loss_value).backward()
             running_train_loss += loss_value.detach()
-            loss_value.backward()
 
-            optimizer.step()
-            model.exponential_moving_average()
-
-            writer.add_scalar(f'TrainLoop/epoch_{epoch}_loss', loss_value.item(),i)
-            bar.set_postfix(loss=f'{loss_value.item()}')
-            bar.update(1)
+            with timer.phase('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+            with timer.phase('ema'):
+                msn_model.exponential_moving_average()
+            step += 1
+
+            with timer.phase('logging'):
+                if main_process:
+                    logged = step_writer.add_scalar(f'TrainLoop/epoch_{epoch}_loss', loss_value, i)
+                    if logged:
+                        bar.set_postfix(loss=f'{logged[f"TrainLoop/epoch_{epoch}_loss"]}')
+                bar.update(1)
+            timer.step()
 
         bar.close()
-        epoch_train_loss = running_train_loss / len(datasets['train'])
+        if main_process:
+            step_writer.flush()
+        epoch_train_loss = distributed.reduce_mean(running_train_loss / len(datasets['train']))
 
         '''Saving model and info'''
-        writer.add_scalar(f'Averaged losses for epoch/train', epoch_train_loss, epoch)
-        torch.save(model.state_dict(), os.path.join(Config.exp_dir, 'checkpoints', f'model_{epoch}.pth'))
-        filename = os.path.join(Config.exp_dir, 'checkpoints', 'models_details.txt')
-        with open(filename, 'a') as file:
-            concatenated_string = f'Epoch: {epoch} - Train loss: {epoch_train_loss}\n'
-            file.write(concatenated_string)
-
-    writer.flush()
-    writer.close()
+        # the random state of every process is saved, for resuming each of them exactly
+        rng_states = distributed.all_gather_object(checkpointing.get_rng_state())
+        if main_process:
+            writer.add_scalar(f'Averaged losses for epoch/train', epoch_train_loss, epoch)
+            state = {'model': msn_model.state_dict(), 'optimizer': optimizer.state_dict(),
+                     'scaler': scaler.state_dict(), 'step': step, 'rng_state': rng_states}
+            with timer.phase('checkpoint'):
+                checkpointer.save(state, epoch, {'train_loss': float(epoch_train_loss)})
+            filename = os.path.join(Config.exp_dir, 'checkpoints', 'models_details.txt')
+            with open(filename, 'a') as file:
+                concatenated_string = f'Epoch: {epoch} - Train loss: {epoch_train_loss}\n'
+                file.write(concatenated_string)
+
+    timer.close()
+    if main_process:
+        timer.export(instrumentation_dir)
+        checkpointer.close()
+        step_writer.close()
+        writer.flush()
+        writer.close()
 
 
 if __name__ == '__main__':
-    training_loop()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', default=None, help='path of the checkpoint from which to resume the training')
+    args = parser.parse_args()
+
+    distributed.launch(functools.partial(training_loop, resume=args.resume), Config.world_size, Config.dist_backend)
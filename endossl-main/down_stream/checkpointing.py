@@ -0,0 +1,213 @@
+"""Module for the asynchronous and resumable checkpoints of the two training scripts.
+
+At the end of each epoch the training state (model, optimizer, gradient scaler, epoch, number of optimizer steps and
+the state of the random generators) is copied to the CPU, which is the only part executed by the training thread, and
+then written to disk by a background thread, with a temporary name renamed only when the file is complete. Only the
+last keep_last checkpoints are kept, together with the best one according to the monitored metric.
+
+The checkpoints are saved as model_<epoch>.pth as before, but they contain the full training state: use
+load_model_state_dict for reading the model weights from both the new checkpoints and the old ones, that contain only
+the state dict of the model.
+
+The training is resumed at the beginning of the epoch following the checkpoint, with resume. The generator of the
+training dataloader is reseeded at each epoch from the seed and the epoch with seed_loader_generator, and its workers are
+started again at each epoch, so the shuffle and the random augmentations of the workers of the resumed run are identical
+to the ones of the uninterrupted run.
+"""
+
+import os
+import re
+import glob
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def get_rng_state() -> dict:
+    """Return the state of the Python, numpy, torch and CUDA random generators."""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        'python': random.getstate(),
+        # the numpy keys are saved as a tensor, so the checkpoint can be loaded with weights_only
+        'numpy': (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+    }
+
+
+def set_rng_state(state: dict):
+    """Restore the random generators from a state returned by get_rng_state."""
+    random.setstate(state['python'])
+    name, keys, pos, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def seed_loader_generator(generator: torch.Generator, seed: int, epoch: int, rank: int = 0) -> torch.Generator:
+    """Reseed the generator of the training dataloader for the epoch, with a seed derived from (seed, epoch, rank). The
+    generator draws the shuffle and the base seed of the workers, so the random operations of an epoch do not depend on
+    the previous epochs."""
+    generator.manual_seed(int(np.random.SeedSequence([seed, epoch, rank]).generate_state(1, np.uint64)[0]))
+    return generator
+
+
+def to_cpu(obj):
+    """Return a copy of obj where all the tensors, also inside dictionaries, lists and tuples, are copied to the CPU, so
+    that the training can continue to modify the original ones while the copy is written."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def load_checkpoint(path: str) -> dict:
+    return torch.load(path, map_location='cpu', weights_only=True)
+
+
+def load_model_state_dict(path: str) -> dict:
+    """Return the state dict of the model saved in path, either a full checkpoint of AsyncCheckpointer or a file with
+    only the state dict of the model."""
+    checkpoint = load_checkpoint(path)
+    if isinstance(checkpoint, dict) and 'model' in checkpoint and 'optimizer' in checkpoint:
+        return checkpoint['model']
+    return checkpoint
+
+
+def load_submodule_state_dict(path: str, prefix: str) -> dict:
+    """Return the state dict of the submodule prefix of the model saved in path, e.g. of the anchor ViT of a
+    pretraining checkpoint with prefix 'vitMsn_anchor', without building the whole model."""
+    prefix = prefix + '.'
+    return {k[len(prefix):]: v for k, v in load_model_state_dict(path).items() if k.startswith(prefix)}
+
+
+class AsyncCheckpointer:
+    """Writer of the training checkpoints in a background thread.
+
+    Args:
+        checkpoint_dir (str): Directory of the checkpoints.
+        keep_last (int): Number of most recent checkpoints to keep, the best one is always kept in addition.
+        monitor_metric (str): Name of the metric, among the ones passed to save, used for selecting the best checkpoint.
+        monitor_mode (str): 'max' if higher values of the metric are better, 'min' otherwise.
+    """
+    def __init__(self, checkpoint_dir: str, keep_last: int = 3, monitor_metric: str = None, monitor_mode: str = 'max'):
+        if monitor_mode not in ('max', 'min'):
+            raise ValueError('Invalid monitor mode: {}'.format(monitor_mode))
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.monitor_metric = monitor_metric
+        self.monitor_mode = monitor_mode
+        self.best_value = None
+        self.best_epoch = None
+        self._error = None
+        # at most one checkpoint waits while another one is written, so save blocks instead of filling the memory
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def checkpoint_path(self, epoch: int) -> str:
+        return os.path.join(self.checkpoint_dir, f'model_{epoch}.pth')
+
+    def state_dict(self) -> dict:
+        return {'best_value': self.best_value, 'best_epoch': self.best_epoch}
+
+    def load_state_dict(self, state: dict):
+        self.best_value = state['best_value']
+        self.best_epoch = state['best_epoch']
+
+    def _is_better(self, value: float) -> bool:
+        if self.best_value is None:
+            return True
+        return value > self.best_value if self.monitor_mode == 'max' else value < self.best_value
+
+    def save(self, state: dict, epoch: int, metrics: dict = None):
+        """Copy the state to the CPU and schedule its writing as the checkpoint of the epoch. The metrics are saved in
+        the checkpoint and used for updating the best checkpoint."""
+        self._raise_error()
+        metrics = dict(metrics or {})
+        if self.monitor_metric in metrics and self._is_better(metrics[self.monitor_metric]):
+            self.best_value, self.best_epoch = metrics[self.monitor_metric], epoch
+        snapshot = to_cpu({**state, 'epoch': epoch, 'metrics': metrics, 'checkpointer': self.state_dict()})
+        self._queue.put((epoch, snapshot))
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                epoch, snapshot = item
+                path = self.checkpoint_path(epoch)
+                torch.save(snapshot, path + '.tmp')
+                os.replace(path + '.tmp', path)
+                self._remove_old(epoch, snapshot['checkpointer']['best_epoch'])
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _remove_old(self, last_epoch: int, best_epoch: int):
+        epochs = []
+        for path in glob.glob(os.path.join(self.checkpoint_dir, 'model_*.pth')):
+            match = re.fullmatch(r'model_(\d+)\.pth', os.path.basename(path))
+            if match:
+                epochs.append(int(match.group(1)))
+        previous = sorted(e for e in epochs if e <= last_epoch)
+        keep = set(previous[-self.keep_last:]) if self.keep_last > 0 else set()
+        keep.add(best_epoch)
+        for epoch in epochs:
+            if epoch not in keep and epoch <= last_epoch:
+                os.remove(self.checkpoint_path(epoch))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('Error while writing a checkpoint') from error
+
+    def wait(self):
+        """Wait until all the scheduled checkpoints are written."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Write the scheduled checkpoints and stop the background thread."""
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+
+def resume(path: str, model: torch.nn.Module, optimizer, scaler=None, checkpointer: AsyncCheckpointer = None,
+           rank: int = 0) -> dict:
+    """Restore the training state saved in a checkpoint: the model, the optimizer, the gradient scaler, the best
+    checkpoint of the checkpointer and the random generators of this process. It must be called after the creation
+    of the model, of the optimizer and of the dataloaders, right before the first epoch.
+
+    Args:
+        path (str): Path of the checkpoint.
+        model (nn.Module): Model, without the DistributedDataParallel wrapper.
+        optimizer (torch.optim.Optimizer): Optimizer of the model.
+        scaler (torch.amp.GradScaler): Gradient scaler of the mixed precision.
+        checkpointer (AsyncCheckpointer): Checkpointer of the training, None for the processes that do not write.
+        rank (int): Rank of the process, used for selecting its random state.
+    Returns:
+        dict: The checkpoint, the training continues from the epoch checkpoint['epoch'] + 1.
+    """
+    checkpoint = load_checkpoint(path)
+    model.load_state_dict(checkpoint['model'])
+    optimizer.load_state_dict(checkpoint['optimizer'])
+    if scaler is not None and checkpoint.get('scaler'):
+        scaler.load_state_dict(checkpoint['scaler'])
+    if checkpointer is not None:
+        checkpointer.load_state_dict(checkpoint['checkpointer'])
+    rng_states = checkpoint['rng_state']
+    set_rng_state(rng_states[rank] if rank < len(rng_states) else rng_states[0])
+    print(f'Resumed from {path}, epoch {checkpoint["epoch"]}, step {checkpoint["step"]}')
+    return checkpoint
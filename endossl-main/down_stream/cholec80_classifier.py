@@ -1,5 +1,6 @@
 import sys
 import os
+import argparse
 
 import torch
 import torch.nn as nn
@@ -13,8 +14,12 @@ from tqdm import tqdm
 sys.path.append(os.path.realpath(__file__ + '/../../'))
 
 from data import cholec80_images
+from down_stream import embedding_cache
+from down_stream import precision
+from down_stream import checkpointing
+from down_stream.instrumentation import StepTimer
+from down_stream.scalar_writer import BufferedScalarWriter
 from models.MyViTMSN import MyViTMSNModel
-from models.MyViTMSN_pretraining import MyViTMSNModel_pretraining
 
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -35,9 +40,21 @@ class Config:
     dataset_name = 'cholec80'
     data_root = os.path.join('cholec80')
 
+    # dataloaders, if autotune_loader is True the options are measured on this machine and saved in loader_options_path;
+    # the training workers are started again at each epoch with a seed of the epoch, so a resumed training is exact
+    loader_options = {'num_workers': min(4, os.cpu_count() or 1), 'pin_memory': True,
+                      'persistent_workers': False, 'prefetch_factor': 2}
+    seed = 0
+    autotune_loader = False
+    loader_options_path = os.path.join(exp_dir, 'loader_options.json')
+
     # metrics
     task_type = 'multi_class'
     monitor_metric = 'val_macro_f1'
+    monitor_mode = 'max'
+
+    # number of most recent checkpoints kept in addition to the best one, see checkpointing.py
+    keep_checkpoints = 3
 
     # optimization
     optimize_name = 'adam'
@@ -50,7 +67,25 @@ class Config:
     batch_size = 150
     validation_freq = 1
 
-def train_loop():
+    # number of step scalars buffered before writing them to tensorboard, see down_stream/scalar_writer.py
+    log_every = 50
+
+    # precision of the forward: 'fp32', 'bf16' or 'fp16', see down_stream/precision.py
+    precision = 'fp32'
+    channels_last = False
+
+    # cache of the embeddings of the frozen ViT, if True only the classifier is run during the epochs
+    cache_embeddings = False
+    cache_views = 1
+    cache_dir = os.path.join(exp_dir, 'embeddings')
+
+    # per-step timing of the phases of the training, exported in exp_dir/instrumentation, and optional torch.profiler
+    # window (first_step, num_steps), see down_stream/instrumentation.py
+    instrument = False
+    instrument_sync = False
+    profile_steps = None
+
+def train_loop(resume: str = None):
 
     """Function that implements the training loop, using the Cholec80 dataset. The model used is based on the Config
     class defined above, and for future tests it has been putted a if else statement for execute the training loop over
@@ -60,14 +95,37 @@ def train_loop():
     to set the Config.pretrained_path to the correct path of the pretrained model. If that flag is set to false is used
     a pretrained model from the Hugging Face library: 'facebook/vit-msn-small', trained over ImengeNet-1K.
 
+    If Config.cache_embeddings is True and the model used is ViT, the CLS embeddings of the frozen ViT are computed once
+    for each split (Config.cache_views augmented views for the training split) and saved in Config.cache_dir, then the
+    classifier is trained and validated directly on the cached embeddings, see down_stream/embedding_cache.py.
+
     The loop will save each model with a different name at the end of each epoch, in the training part is used
     the cross-entropy loss as metric, while the validation part uses the macro MultilabelF1Score metric. In the models directory is
     also saved a txt files with the corresponding losses and metrics for each epoch and each model.
+
+    The loop does not synchronize with the device at each step: the losses are summed on the device, the F1 score is
+    accumulated with the state of the torchmetrics metric and computed once per epoch over the whole validation split,
+    and the step losses are written to tensorboard by a BufferedScalarWriter every Config.log_every steps.
+
+    The checkpoints are written in background by an AsyncCheckpointer, with the optimizer, the gradient scaler and the
+    random state for resuming the training; only the last Config.keep_checkpoints ones and the best one according to
+    Config.monitor_metric are kept.
+
+    With Config.instrument or Config.profile_steps the time of each phase of the training steps, and of the validation
+    of each epoch, is measured by a StepTimer and exported in exp_dir/instrumentation at the end of the training.
+
+    Args:
+        resume: path of the checkpoint from which to resume the training, None for starting a new training
     """
 
+    loader_generator = torch.Generator()
     datasets = cholec80_images.get_pytorch_dataloaders(
         data_root=Config.data_root,
-        batch_size=Config.batch_size
+        batch_size=Config.batch_size,
+        loader_options=Config.loader_options,
+        autotune_loader=Config.autotune_loader,
+        loader_options_path=Config.loader_options_path,
+        generator=loader_generator
     )
 
     if Config.model == 'resnet50':
@@ -76,14 +134,12 @@ def train_loop():
             param.requires_grad = False
         model.fc = nn.Linear(model.fc.in_features, Config.num_classes)
     elif 'vit' == Config.model:
-        model = MyViTMSNModel(device=device)
+        # with a pretrained checkpoint the Hugging Face weights are not loaded, they are overwritten anyway
+        model = MyViTMSNModel(device=device, load_weights=not Config.pretrained)
 
         if Config.pretrained:
-            pretrained_model = MyViTMSNModel_pretraining(ipe=len(datasets['train']), num_epochs=Config.num_epochs, device=device)
             model_path = Config.pretrained_path
-            pretrained_model.load_state_dict(torch.load(model_path))
-
-            model.vitMsn.load_state_dict(pretrained_model.vitMsn_anchor.state_dict())
+            model.vitMsn.load_state_dict(checkpointing.load_submodule_state_dict(model_path, 'vitMsn_anchor'))
 
         model.classifier = nn.Linear(model.classifier.in_features, Config.num_classes)
         for param in model.vitMsn.parameters():
@@ -92,71 +148,116 @@ def train_loop():
         raise ValueError('Invalid model name: {}'.format(Config.model))
 
     model.to(device)
+    if Config.channels_last:
+        model.to(memory_format=torch.channels_last)
+
+    forward = model
+    if Config.cache_embeddings and Config.model == 'vit':
+        datasets = embedding_cache.cached_dataloaders(model, datasets, Config.cache_dir, Config.cache_views, device)
+        forward = model.classifier
+
     optimizer = optim.Adam(model.parameters(), lr=Config.learning_rate, weight_decay=Config.weight_decay)
     criterion = nn.CrossEntropyLoss()
+    scaler = precision.grad_scaler(Config.precision, device)
     metric_f1 = MulticlassF1Score(num_classes=Config.num_classes, average='macro').to(device)
     writer = SummaryWriter(log_dir=os.path.join(Config.exp_dir, 'tb_logs'))
+    step_writer = BufferedScalarWriter(writer, Config.log_every)
+    checkpointer = checkpointing.AsyncCheckpointer(os.path.join(Config.exp_dir, 'checkpoints'), Config.keep_checkpoints,
+                                                   Config.monitor_metric, Config.monitor_mode)
+
+    instrumentation_dir = os.path.join(Config.exp_dir, 'instrumentation')
+    timer = StepTimer(Config.instrument, Config.instrument_sync, Config.profile_steps, instrumentation_dir)
+    if forward is model and Config.model == 'vit':
+        timer.time_module(model.preprocess, 'preprocess')
+        timer.time_module(model.vitMsn, 'backbone')
 
-    for epoch in range(Config.num_epochs):
+    start_epoch, step = 0, 0
+    if resume is not None:
+        checkpoint = checkpointing.resume(resume, model, optimizer, scaler, checkpointer)
+        start_epoch, step = checkpoint['epoch'] + 1, checkpoint['step']
+
+    for epoch in range(start_epoch, Config.num_epochs):
 
         '''Train loop'''
-        running_train_loss = 0.0
+        running_train_loss = torch.zeros((), device=device)
         bar = tqdm(total=len(datasets['train']), desc=f'Train of epoch {epoch + 1}', ncols=100)
         model.train()
+        checkpointing.seed_loader_generator(loader_generator, Config.seed, epoch)
 
-        for i, (inputs, labels) in enumerate(datasets['train'], 0):
-            inputs, labels = inputs.to(device).to(torch.float), labels.to(device)
+        for i, (inputs, labels) in enumerate(timer.iterate(datasets['train']), 0):
+            with timer.phase('to_device'):
+                inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+                if Config.model == 'resnet50':
+                    # the ViT model preprocess the uint8 images by itself, the resnet needs them as float
+                    inputs = inputs.to(torch.float)
+                if inputs.dim() == 4:
+                    inputs = precision.to_channels_last(inputs, Config.channels_last)
 
             optimizer.zero_grad()
-            output = model(inputs)
-            output = softmax(output, dim=1)
-
-            loss_value = criterion(output, labels)
-            loss_value.backward()
-            optimizer.step()
-            running_train_loss += loss_value.item()
-
-            writer.add_scalar(f'TrainLoop/epoch_{epoch}_loss', loss_value.item(), i)
-            bar.set_postfix(loss=f'{loss_value.item()}')
-            bar.update(1)
+            with timer.phase('forward'):
+                with precision.autocast(Config.precision, device):
+                    output = forward(inputs)
+                output = softmax(output.float(), dim=1)
+
+                loss_value = criterion(output, labels)
+            with timer.phase('backward'):
+                scaler.scale(loss_value).backward()
+            with timer.phase('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+            step += 1
+            running_train_loss += loss_value.detach()
+
+            with timer.phase('logging'):
+                logged = step_writer.add_scalar(f'TrainLoop/epoch_{epoch}_loss', loss_value, i)
+                if logged:
+                    bar.set_postfix(loss=f'{logged[f"TrainLoop/epoch_{epoch}_loss"]}')
+                bar.update(1)
+            timer.step()
 
         bar.close()
-        epoch_train_loss = running_train_loss / len(datasets['train'])
+        step_writer.flush()
+        epoch_train_loss = (running_train_loss / len(datasets['train'])).item()
 
 
         '''Validation loop'''
-        running_macroF1_score = 0.0
+        metric_f1.reset()
         bar = tqdm(total=len(datasets['validation']), desc=f'Validation of epoch {epoch + 1}', ncols=100)
         model.eval()
 
-        with torch.no_grad():
+        with torch.no_grad(), timer.phase('validation'):
             for i, (inputs, labels) in enumerate(datasets['validation'], 0):
-                optimizer.zero_grad()
-                inputs, labels = inputs.to(device), labels.to(device)
-
-                output = softmax(model(inputs), dim=1)
+                inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
 
-                metric_value = metric_f1(output, labels)
-                running_macroF1_score += metric_value.item()
+                with precision.autocast(Config.precision, device):
+                    output = forward(inputs)
+                output = softmax(output.float(), dim=1)
 
-                writer.add_scalar(f'ValidationLoop/epoch_{epoch}_macrof1score', metric_value.item(), i)
-                bar.set_postfix(f1score=f'{metric_value.item()}')
+                metric_f1.update(output, labels)
                 bar.update(1)
 
             bar.close()
 
-        epoch_macroF1_score = running_macroF1_score / len(datasets['validation'])
+        # macro F1 score over all the frames of the validation split
+        epoch_macroF1_score = metric_f1.compute().item()
 
         writer.add_scalar(f'Averaged losses for epoch/train', epoch_train_loss, epoch)
         writer.add_scalar(f'Averaged macro f1 score for epoch/validation', epoch_macroF1_score, epoch)
 
-        torch.save(model.state_dict(), os.path.join(Config.exp_dir, 'checkpoints', f'model_{epoch}.pth'))
+        state = {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scaler': scaler.state_dict(),
+                 'step': step, 'rng_state': [checkpointing.get_rng_state()]}
+        with timer.phase('checkpoint'):
+            checkpointer.save(state, epoch, {'train_loss': epoch_train_loss, 'val_macro_f1': epoch_macroF1_score})
 
         filename = os.path.join(Config.exp_dir, 'checkpoints', 'models_details.txt')
         with open(filename, 'a') as file:
             concatenated_string = f'Epoch: {epoch} - Train loss: {epoch_train_loss} - Macro f1 score: {epoch_macroF1_score}\n'
             file.write(concatenated_string)
 
+    timer.close()
+    timer.export(instrumentation_dir)
+    checkpointer.close()
+    step_writer.close()
     writer.flush()
     writer.close()
 
@@ -166,52 +267,61 @@ def test_loop(model_path : str):
     The results will be saved in tensorflow in the experiment direcotry that can be found in the Config class at the
     top of the current file.
 
-    The metric that has been used and that it is monitored is the multiclass macro F1 score.
+    The metric that has been used and that it is monitored is the multiclass macro F1 score, computed over all the
+    frames of the test split.
 
     Args:
-        model_path: a string containing the path for the trained model over which execute the testing part
+        model_path: a string containing the path for the trained model over which execute the testing part, either a
+        checkpoint of the training loop or a file with only the state dict of the model
     """
 
     datasets = cholec80_images.get_pytorch_dataloaders(
         data_root=Config.data_root,
-        batch_size=Config.batch_size
+        batch_size=Config.batch_size,
+        loader_options=Config.loader_options,
+        loader_options_path=Config.loader_options_path
     )
 
-    model = MyViTMSNModel(device=device)
+    model = MyViTMSNModel(device=device, load_weights=False)
     model.classifier = nn.Linear(model.classifier.in_features, Config.num_classes)
-    model.load_state_dict(torch.load(model_path))
+    model.load_state_dict(checkpointing.load_model_state_dict(model_path))
     model.to(device)
+    if Config.channels_last:
+        model.to(memory_format=torch.channels_last)
     model.eval()
 
     metric_f1 = MulticlassF1Score(num_classes=Config.num_classes, average='macro').to(device)
     writer = SummaryWriter(log_dir=os.path.join(Config.exp_dir, 'tb_logs'))
 
-    running_test_mascrof1 = 0.0
     bar = tqdm(total=len(datasets['test']), desc=f'Test', ncols=100)
 
     with torch.no_grad():
         for i, (inputs, labels) in enumerate(datasets['test'], 0):
 
-            inputs, labels = inputs.to(device), labels.to(device)
-            outputs = softmax(model(inputs), dim=1)
+            inputs, labels = inputs.to(device, non_blocking=True), labels.to(device, non_blocking=True)
+            with precision.autocast(Config.precision, device):
+                outputs = model(precision.to_channels_last(inputs, Config.channels_last))
+            outputs = softmax(outputs.float(), dim=1)
 
-            f1score = metric_f1(outputs, labels)
-            running_test_mascrof1 += f1score.item()
-
-            writer.add_scalar(f'TestLoop/MacroF1score', f1score, i)
-            bar.set_postfix(loss=f1score.item())
+            metric_f1.update(outputs, labels)
             bar.update(1)
 
     bar.close()
-    writer.add_scalar(f'TestLoop/FinaMacroF1', running_test_mascrof1 / len(datasets["test"]), 1)
-    print(f'Average MacroF1 for test: {running_test_mascrof1 / len(datasets["test"])}')
+    test_macrof1 = metric_f1.compute().item()
+    writer.add_scalar(f'TestLoop/FinaMacroF1', test_macrof1, 1)
+    print(f'MacroF1 for test: {test_macrof1}')
 
     writer.flush()
     writer.close()
 
 
 if __name__ == '__main__':
-    train_loop()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', default=None, help='path of the checkpoint from which to resume the training')
+    args = parser.parse_args()
+
+    train_loop(resume=args.resume)
 
     # example of usage of the test loop function
     # test_loop('exps/cholec80_classifier/checkpoints/model_19.pth')
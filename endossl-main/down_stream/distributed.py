@@ -0,0 +1,130 @@
+"""Module with the helpers for the distributed data-parallel training of ViT_pretraining.py.
+
+The training can be launched in two ways: with torchrun, that starts the processes and sets the RANK, WORLD_SIZE and
+MASTER_ADDR/MASTER_PORT environment variables, or with launch, that spawns world_size processes on this machine. The
+default backend is nccl when CUDA is available and gloo otherwise, so the distributed training can also be run and
+tested with multiple CPU processes.
+
+    torchrun --nproc_per_node 4 down_stream/ViT_pretraining.py
+
+When the process group is not initialized all the helpers behave as in a single process training.
+"""
+
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.distributed.nn.functional as dist_fn
+import torch.multiprocessing as mp
+
+
+def is_distributed() -> bool:
+    """Return True if the default process group is initialized and contains more than one process."""
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def is_main_process() -> bool:
+    """Return True for the process that writes checkpoints and logs, i.e. the rank 0."""
+    return get_rank() == 0
+
+
+def local_device() -> torch.device:
+    """Return the device of this process: the GPU with the index of the local rank if CUDA is available, else the CPU."""
+    if torch.cuda.is_available():
+        return torch.device('cuda', int(os.environ.get('LOCAL_RANK', get_rank())) % torch.cuda.device_count())
+    return torch.device('cpu')
+
+
+def default_backend() -> str:
+    return 'nccl' if torch.cuda.is_available() else 'gloo'
+
+
+def init_distributed(backend: str = None) -> bool:
+    """Initialize the default process group from the environment variables set by torchrun or by launch. Return
+    False, doing nothing, if the variables are not set."""
+    if 'WORLD_SIZE' not in os.environ or dist.is_initialized():
+        return dist.is_initialized()
+    dist.init_process_group(backend=backend or default_backend())
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_device())
+    return True
+
+
+def cleanup():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def all_reduce_mean(tensor: torch.Tensor) -> torch.Tensor:
+    """Differentiable average of the tensor over all the processes. The gradient of each process is the sum of the
+    gradients of all the processes divided by the world size, so after the averaging of DDP the parameters get the
+    gradient of a loss computed on the global average."""
+    if not is_distributed():
+        return tensor
+    return dist_fn.all_reduce(tensor, op=dist.ReduceOp.SUM) / get_world_size()
+
+
+def reduce_mean(tensor: torch.Tensor) -> torch.Tensor:
+    """Not differentiable average of the tensor over all the processes, used for the logged values."""
+    if not is_distributed():
+        return tensor
+    tensor = tensor.detach().clone()
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor / get_world_size()
+
+
+def all_gather_object(obj) -> list:
+    """Return the list of the objects of all the processes, ordered by rank; a list with only obj when the training is
+    not distributed."""
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _spawned_worker(rank: int, fn, world_size: int, backend: str, port: int):
+    os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank), 'WORLD_SIZE': str(world_size),
+                       'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port)})
+    init_distributed(backend)
+    try:
+        fn()
+    finally:
+        cleanup()
+
+
+def launch(fn, world_size: int = 1, backend: str = None):
+    """Run fn in a distributed setting. If the process has been started by torchrun the process group is initialized
+    from its environment variables, otherwise if world_size is greater than 1 fn is run in world_size spawned
+    processes on this machine, and if it is 1 fn is simply called.
+
+    Args:
+        fn (function): Function without arguments to run in each process, it must be importable by the spawned
+        processes, e.g. a function defined at the top level of a module.
+        world_size (int): Number of processes to spawn when not started by torchrun.
+        backend (str): Backend of the process group, default is nccl with CUDA and gloo otherwise.
+    """
+    if 'WORLD_SIZE' in os.environ:
+        init_distributed(backend)
+        try:
+            return fn()
+        finally:
+            cleanup()
+    if world_size <= 1:
+        return fn()
+    mp.spawn(_spawned_worker, args=(fn, world_size, backend, _free_port()), nprocs=world_size, join=True)
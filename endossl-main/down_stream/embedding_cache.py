@@ -0,0 +1,137 @@
+"""Module for the cache of the embeddings of a frozen ViT backbone, used for training only the linear classifier.
+
+When the backbone is frozen its output for a frame does not change between epochs, so the CLS embeddings are computed
+once for each split and saved on disk as float32 .npy arrays, in files named with a fingerprint of the backbone
+weights and one of the data (folder, videos, storage and augmentations) of the split. The classifier is then trained
+and validated with dataloaders over the cached features, without decoding any frame and without running the ViT. For
+the training split it is possible to save a fixed number of augmented views of each frame, each one obtained with a
+full pass over the training dataloader.
+"""
+
+import os
+import hashlib
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, TensorDataset
+from tqdm import tqdm
+
+
+def backbone_fingerprint(module: nn.Module) -> str:
+    """Return the sha1 of the names and of the values of all the tensors in the state dict of the module."""
+    sha = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+def _describe(obj) -> str:
+    """Return a description of a transformation or of a collate function that does not depend on the memory address
+    of the objects: the qualified name of the functions, the class and the public attributes of the other objects."""
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return repr(obj)
+    if isinstance(obj, (list, tuple)):
+        return '[' + ', '.join(_describe(item) for item in obj) + ']'
+    if isinstance(obj, dict):
+        return '{' + ', '.join(f'{key}: {_describe(value)}' for key, value in sorted(obj.items())) + '}'
+    if hasattr(obj, '__qualname__'):
+        return f'{getattr(obj, "__module__", "")}.{obj.__qualname__}'
+    if not hasattr(obj, '__dict__'):
+        return repr(obj)
+    attributes = {key: value for key, value in vars(obj).items() if not key.startswith('_')}
+    if isinstance(obj, nn.Module):
+        attributes.update(obj.named_children())
+    return f'{type(obj).__qualname__}({_describe(attributes)})'
+
+
+def data_fingerprint(loader) -> str:
+    """Return the sha1 of the data read by the loader: the class of the dataset, i.e. the storage, its folder, its
+    video ids, its transformation and the collate function of the loader, that contains the batched augmentations."""
+    dataset = loader.dataset
+    description = {
+        'dataset': type(dataset).__qualname__,
+        'data_root': os.path.realpath(getattr(dataset, 'data_root', None) or getattr(dataset, 'shards_dir', '')),
+        'video_ids': [str(video_id) for video_id in getattr(dataset, 'video_ids', None) or []],
+        'transform': getattr(dataset, 'transform', None),
+        'double_img': getattr(dataset, 'double_img', None),
+        'collate_fn': loader.collate_fn
+    }
+    return hashlib.sha1(_describe(description).encode()).hexdigest()
+
+
+def extract_embeddings(model, loader, path: str, num_views: int = 1, device='cpu') -> str:
+    """Compute the CLS embeddings of all the frames of the loader, num_views times, and save them in path together with
+    the labels, saved in the file with the same name and the _labels suffix. If the files already exist nothing is
+    computed.
+
+    Args:
+        model (MyViTMSNModel): Model with the frozen backbone, the embeddings are computed with model.features.
+        loader (DataLoader): Dataloader returning (images, labels), with random augmentations if num_views > 1.
+        path (str): Path of the .npy file of the embeddings.
+        num_views (int): Number of passes over the loader, i.e. number of views of each frame.
+        device: Device where to run the backbone.
+    Returns:
+        str: The path of the embeddings.
+    """
+    labels_path = path[:-len('.npy')] + '_labels.npy'
+    if os.path.exists(path) and os.path.exists(labels_path):
+        return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    num_samples = len(loader.dataset)
+    hidden_size = model.vitMsn.config.hidden_size
+
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(num_views * num_samples, hidden_size))
+    labels = np.zeros(num_views * num_samples, dtype=np.int64)
+
+    model.eval()
+    row = 0
+    with torch.no_grad():
+        for view in range(num_views):
+            for inputs, batch_labels in tqdm(loader, desc=f'Embeddings of {os.path.basename(path)}, view {view + 1}', ncols=100):
+                output = model.features(inputs.to(device, non_blocking=True))
+                features[row:row + len(output)] = output.float().cpu().numpy()
+                labels[row:row + len(output)] = batch_labels.numpy()
+                row += len(output)
+
+    features.flush()
+    del features
+    np.save(labels_path, labels)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_embeddings(path: str) -> TensorDataset:
+    """Load the embeddings saved by extract_embeddings as a TensorDataset of (features, labels). The features are opened
+    as a copy-on-write memory map, so they are read from disk only when used."""
+    features = torch.from_numpy(np.load(path, mmap_mode='c'))
+    labels = torch.from_numpy(np.load(path[:-len('.npy')] + '_labels.npy'))
+    return TensorDataset(features, labels)
+
+
+def cached_dataloaders(model, dataloaders: dict, cache_dir: str, num_views: int = 1, device='cpu') -> dict:
+    """Replace the image dataloaders with dataloaders over the cached embeddings of the backbone of the model, computing
+    the embeddings that are not already in the cache. The training split will contain num_views augmented views of
+    each frame, the other splits a single view.
+
+    Args:
+        model (MyViTMSNModel): Model with the frozen backbone.
+        dataloaders (dict): Dataloaders returned by cholec80_images.get_pytorch_dataloaders.
+        cache_dir (str): Directory of the cache.
+        num_views (int): Number of augmented views of each training frame.
+        device: Device where to run the backbone.
+    Returns:
+        dict: Dataloaders returning (embeddings, labels), with the same batch size of the ones in input.
+    """
+    key = backbone_fingerprint(model.vitMsn)[:16]
+    cached = {}
+    for split, loader in dataloaders.items():
+        views = num_views if split == 'train' else 1
+        data_key = data_fingerprint(loader)[:12]
+        path = os.path.join(cache_dir, f'{key}_{split}_{data_key}_{len(loader.dataset)}x{views}.npy')
+        extract_embeddings(model, loader, path, views, device)
+        cached[split] = DataLoader(load_embeddings(path), batch_size=loader.batch_size, shuffle=split == 'train')
+    return cached
@@ -0,0 +1,212 @@
+"""Export of the phase classifier trained by cholec80_classifier.py for the CPU inference.
+
+The exported models are self-contained: they take the uint8 frames (B, 3, H, W) and return the probabilities of the
+phases, with the preprocessing (resize and normalization, see models/preprocessing.py), the ViT, the classifier and
+the softmax in the graph, so they can run without this repository and without transformers:
+
+- TorchScript, traced with frames of the original size, so the resize to 224x224 is part of the graph and the frames
+  can have any size;
+- ONNX, exported with 224x224 frames, as returned by the dataloaders, since the antialiased resize of the
+  preprocessing has no ONNX equivalent; it requires the onnx package, without it the ONNX export is skipped;
+- int8 TorchScript, with the nn.Linear layers of the ViT and of the classifier quantized with dynamic quantization:
+  the weights are stored as int8 and the activations are quantized at runtime, batch by batch, so no calibration is
+  needed.
+
+The export writes also a report with the latency with a single frame, the throughput with a batch of frames and the
+macro F1 score over the test split of each variant, compared with the fp32 model. Run it from the endossl-main folder
+with
+
+    python down_stream/export.py --model_path exps/cholec80_classifier_pretrained/checkpoints/model_19.pth
+"""
+
+import sys
+import os
+import copy
+import json
+import argparse
+import warnings
+import importlib.util
+
+import torch
+import torch.nn as nn
+from torch.nn.functional import softmax
+from torchmetrics.classification import MulticlassF1Score
+from tqdm import tqdm
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data import cholec80_images
+from down_stream import checkpointing
+from models.MyViTMSN import MyViTMSNModel
+from down_stream.instrumentation import time_fn
+
+
+class Config:
+
+    # classifier trained by cholec80_classifier.py and folder of the exported models and of the report
+    model_path = os.path.join('exps', 'cholec80_classifier_pretrained', 'checkpoints', 'model_19.pth')
+    export_dir = os.path.join('exps', 'export')
+    num_classes = 7
+
+    # dataset used for the macro F1 score of the report
+    data_root = os.path.join('cholec80')
+    split = 'test'
+    loader_options = {'num_workers': min(4, os.cpu_count() or 1)}
+
+    # size of the example frames used for tracing, the original size of the Cholec80 frames
+    trace_size = (480, 854)
+    onnx_opset = 17
+
+    # report: frames of the throughput batch and number of timed repetitions
+    batch_size = 32
+    repeats = 10
+
+
+class PhaseClassifier(nn.Module):
+    """Phase classifier returning the probabilities of the phases of uint8 frames, i.e. MyViTMSNModel followed by the
+    softmax applied in the training and test loops."""
+    def __init__(self, model: MyViTMSNModel):
+        super(PhaseClassifier, self).__init__()
+        self.model = model
+
+    def forward(self, frames: torch.Tensor) -> torch.Tensor:
+        return softmax(self.model(frames), dim=1)
+
+
+def load_classifier(model_path: str, num_classes: int = 7) -> PhaseClassifier:
+    """Build the classifier on the CPU and load its weights, without loading the Hugging Face ones."""
+    model = MyViTMSNModel(device='cpu', load_weights=False)
+    model.classifier = nn.Linear(model.classifier.in_features, num_classes)
+    model.load_state_dict(checkpointing.load_model_state_dict(model_path))
+    return PhaseClassifier(model).eval()
+
+
+def quantize_dynamic_int8(classifier: PhaseClassifier) -> PhaseClassifier:
+    """Return a copy of the classifier with all the nn.Linear layers (attention, MLP and classifier) quantized to
+    int8 with dynamic quantization. The patch embedding convolution and the layer norms stay in fp32."""
+    with warnings.catch_warnings():
+        # the eager quantization API is deprecated in favour of torchao, that is not a dependency of this project
+        warnings.simplefilter('ignore', DeprecationWarning)
+        from torch.ao.quantization import quantize_dynamic
+        return quantize_dynamic(copy.deepcopy(classifier), {nn.Linear}, dtype=torch.qint8).eval()
+
+
+def export_torchscript(classifier: nn.Module, path: str, example_size: tuple = (480, 854)) -> str:
+    """Trace the classifier with a batch of frames of example_size and save it as TorchScript. The traced model
+    resizes any frame to the input size of the ViT."""
+    example = torch.randint(0, 256, (2, 3) + tuple(example_size), dtype=torch.uint8)
+    with torch.no_grad(), warnings.catch_warnings():
+        # the branches on the input size in the preprocessing and in the ViT embeddings are fixed by the trace, and
+        # TorchScript is deprecated in favour of torch.export, that cannot save the dynamically quantized layers yet
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        warnings.simplefilter('ignore', FutureWarning)
+        traced = torch.jit.freeze(torch.jit.trace(classifier, example).eval())
+        torch.jit.save(traced, path)
+    return path
+
+
+def export_onnx(classifier: nn.Module, path: str, opset: int = 17) -> str:
+    """Export the classifier to ONNX, with a dynamic batch size and 224x224 uint8 frames as input."""
+    size = classifier.model.preprocess.size
+    example = torch.randint(0, 256, (2, 3) + tuple(size), dtype=torch.uint8)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        torch.onnx.export(classifier, (example,), path, input_names=['frames'], output_names=['probabilities'],
+                          dynamic_axes={'frames': {0: 'batch'}, 'probabilities': {0: 'batch'}},
+                          opset_version=opset, dynamo=False)
+    return path
+
+
+def evaluate_macro_f1(classifier, loader, num_classes: int = 7) -> dict:
+    """Return the macro F1 score over all the frames of the loader and the predicted phases."""
+    metric_f1 = MulticlassF1Score(num_classes=num_classes, average='macro')
+    predictions = []
+    with torch.inference_mode():
+        for inputs, labels in tqdm(loader, desc='Evaluation', ncols=100):
+            probabilities = classifier(inputs)
+            metric_f1.update(probabilities, labels)
+            predictions.append(probabilities.argmax(dim=1))
+    return {'macro_f1': metric_f1.compute().item(), 'predictions': torch.cat(predictions)}
+
+
+def measure_speed(classifier, batch_size: int = 32, repeats: int = 10, size: tuple = (224, 224)) -> dict:
+    """Return the latency in ms of a single frame and the frames per second with batches of batch_size frames."""
+    single = torch.randint(0, 256, (1, 3) + tuple(size), dtype=torch.uint8)
+    batch = torch.randint(0, 256, (batch_size, 3) + tuple(size), dtype=torch.uint8)
+    with torch.inference_mode():
+        latency = time_fn(lambda: classifier(single), repeats, warmup=2)
+        throughput = time_fn(lambda: classifier(batch), max(1, repeats // 2), warmup=1)
+    return {'latency_ms': latency['mean_s'] * 1e3, 'frames_per_sec': batch_size / throughput['mean_s']}
+
+
+def export_and_report(model_path: str = None, export_dir: str = None, onnx: bool = True,
+                      evaluate: bool = True) -> dict:
+    """Export the classifier in model_path as fp32 TorchScript, ONNX and int8 TorchScript, and write in export_dir
+    the report comparing the speed and the macro F1 score of the variants with the fp32 eager model."""
+    model_path = model_path or Config.model_path
+    export_dir = export_dir or Config.export_dir
+    os.makedirs(export_dir, exist_ok=True)
+
+    classifier = load_classifier(model_path, Config.num_classes)
+    quantized = quantize_dynamic_int8(classifier)
+
+    paths = {'fp32_torchscript': export_torchscript(classifier, os.path.join(export_dir, 'classifier_fp32.pt'),
+                                                    Config.trace_size),
+             'int8_torchscript': export_torchscript(quantized, os.path.join(export_dir, 'classifier_int8.pt'),
+                                                    Config.trace_size)}
+    if onnx and importlib.util.find_spec('onnx') is None:
+        print('The onnx package is not installed, the ONNX export is skipped')
+    elif onnx:
+        paths['fp32_onnx'] = export_onnx(classifier, os.path.join(export_dir, 'classifier_fp32.onnx'),
+                                         Config.onnx_opset)
+    for name, path in paths.items():
+        print(f'{name} saved to {path}')
+
+    variants = {'fp32_eager': classifier,
+                'fp32_torchscript': torch.jit.load(paths['fp32_torchscript']),
+                'int8_eager': quantized,
+                'int8_torchscript': torch.jit.load(paths['int8_torchscript'])}
+    report = {'model_path': model_path, 'threads': torch.get_num_threads(), 'batch_size': Config.batch_size,
+              'files': {name: {'path': path, 'size_mb': os.path.getsize(path) / 2 ** 20} for name, path in paths.items()},
+              'variants': {}}
+    for name, variant in variants.items():
+        report['variants'][name] = measure_speed(variant, Config.batch_size, Config.repeats)
+
+    if evaluate:
+        datasets = cholec80_images.get_pytorch_dataloaders(
+            data_root=Config.data_root,
+            batch_size=Config.batch_size,
+            loader_options=Config.loader_options
+        )
+        if Config.split not in datasets:
+            raise ValueError(f'Split {Config.split} not defined in cholec80_images._CHOLEC80_SPLIT')
+        reference = None
+        for name, variant in variants.items():
+            result = evaluate_macro_f1(variant, datasets[Config.split], Config.num_classes)
+            if reference is None:
+                reference = result['predictions']
+            report['variants'][name]['macro_f1'] = result['macro_f1']
+            report['variants'][name]['agreement_with_fp32'] = (result['predictions'] == reference).float().mean().item()
+
+    with open(os.path.join(export_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f'{"variant":<20}{"latency ms":>12}{"frames/s":>10}{"macro F1":>10}{"agreement":>11}')
+    for name, r in report['variants'].items():
+        print(f'{name:<20}{r["latency_ms"]:>12.1f}{r["frames_per_sec"]:>10.1f}'
+              f'{r.get("macro_f1", float("nan")):>10.4f}{r.get("agreement_with_fp32", float("nan")):>11.4f}')
+    return report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', default=Config.model_path)
+    parser.add_argument('--export_dir', default=Config.export_dir)
+    parser.add_argument('--data_root', default=Config.data_root)
+    parser.add_argument('--no_onnx', action='store_true', help='skip the ONNX export')
+    parser.add_argument('--no_eval', action='store_true', help='skip the macro F1 score on the test split')
+    args = parser.parse_args()
+
+    Config.data_root = args.data_root
+    export_and_report(args.model_path, args.export_dir, onnx=not args.no_onnx, evaluate=not args.no_eval)
@@ -0,0 +1,200 @@
+"""Module for measuring where the time of the training steps goes.
+
+The StepTimer records the wall time of the phases of each step (waiting for the data, copy to the device, forward,
+backward, optimizer step, EMA, logging, checkpoints), and optionally of the forward of some submodules, e.g. the
+preprocessing or the target ViT, with forward hooks. At the end of the training it exports a summary with the time of
+each phase and a Chrome trace, that can be opened in chrome://tracing or in https://ui.perfetto.dev. It can also run
+torch.profiler over a window of steps, writing its trace for tensorboard.
+
+When the timer is disabled, phase returns a shared null context, iterate returns the iterable itself and no hook is
+registered, so the instrumented loops run as without it.
+
+Since CUDA kernels are asynchronous, the phases on the GPU measure only the launch of the kernels, unless the timer is
+created with synchronize=True, that waits for the device at the boundaries of each phase (with some overhead).
+
+The module contains also time_fn, the timing of repeated calls of a function used by the export report and by the
+benchmarks.
+"""
+
+import os
+import json
+import time
+import contextlib
+
+import numpy as np
+import torch
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def time_fn(fn, repeats: int = 10, warmup: int = 2) -> dict:
+    """Execute fn warmup times without timing it, then repeats times, returning the mean and the minimum time in
+    seconds of a single call."""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'mean_s': sum(times) / len(times), 'min_s': min(times), 'repeats': repeats}
+
+
+class StepTimer:
+    """Recorder of the wall time of the phases of the training steps.
+
+    Args:
+        enabled (bool): If False the timer does nothing.
+        synchronize (bool): If True the timer waits for the CUDA device at the beginning and at the end of each phase.
+        profile_steps (tuple): (first_step, num_steps), window of steps profiled with torch.profiler, None for no
+        profiling.
+        profile_dir (str): Directory of the torch.profiler traces.
+        max_events (int): Maximum number of recorded events, the following ones are ignored.
+    """
+    def __init__(self, enabled: bool = False, synchronize: bool = False, profile_steps: tuple = None,
+                 profile_dir: str = None, max_events: int = 1000000):
+        self.enabled = enabled or profile_steps is not None
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.max_events = max_events
+        self.events = []
+        self.step_index = 0
+        self._origin = time.perf_counter_ns()
+        self._hooks = []
+        self._profiler = None
+
+        if profile_steps is not None:
+            first_step, num_steps = profile_steps
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=max(0, first_step - 1), warmup=min(1, first_step),
+                                                 active=num_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(profile_dir or 'profiler'),
+                profile_memory=True
+            )
+            self._profiler.start()
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def _record(self, name: str, start: int, duration: int):
+        if len(self.events) < self.max_events:
+            self.events.append((name, self.step_index, start - self._origin, duration))
+
+    def phase(self, name: str):
+        """Context manager measuring the phase name of the current step."""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._phase(name)
+
+    @contextlib.contextmanager
+    def _phase(self, name: str):
+        self._sync()
+        start = time.perf_counter_ns()
+        with torch.profiler.record_function(name) if self._profiler is not None else _NULL_CONTEXT:
+            yield
+        self._sync()
+        self._record(name, start, time.perf_counter_ns() - start)
+
+    def iterate(self, iterable, name: str = 'data'):
+        """Wrap the iterable, e.g. a dataloader, measuring the time spent waiting for each element in the phase name."""
+        if not self.enabled:
+            return iterable
+        return self._iterate(iterable, name)
+
+    def _iterate(self, iterable, name: str):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter_ns()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self._record(name, start, time.perf_counter_ns() - start)
+            yield item
+
+    def step(self):
+        """Mark the end of a training step."""
+        if not self.enabled:
+            return
+        self.step_index += 1
+        if self._profiler is not None:
+            self._profiler.step()
+
+    def time_module(self, module: torch.nn.Module, name: str):
+        """Measure each forward of the module in the phase name, with forward hooks."""
+        if not self.enabled:
+            return
+        starts = []
+
+        def pre_hook(*args):
+            self._sync()
+            starts.append(time.perf_counter_ns())
+
+        def hook(*args):
+            self._sync()
+            start = starts.pop()
+            self._record(name, start, time.perf_counter_ns() - start)
+
+        self._hooks.append(module.register_forward_pre_hook(pre_hook))
+        self._hooks.append(module.register_forward_hook(hook))
+
+    def summary(self) -> dict:
+        """Return, for each phase, the number of measures, the total time, the mean and percentiles in ms and the
+        share of the total time between the first and the last recorded event."""
+        if not self.events:
+            return {}
+        names = [e[0] for e in self.events]
+        starts = np.array([e[2] for e in self.events], dtype=np.int64)
+        durations = np.array([e[3] for e in self.events], dtype=np.int64)
+        wall_ns = max(1, int((starts + durations).max() - starts.min()))
+
+        summary = {}
+        for name in dict.fromkeys(names):
+            phase = durations[[n == name for n in names]] / 1e6
+            summary[name] = {
+                'count': int(len(phase)),
+                'total_s': float(phase.sum() / 1e3),
+                'mean_ms': float(phase.mean()),
+                'p50_ms': float(np.percentile(phase, 50)),
+                'p90_ms': float(np.percentile(phase, 90)),
+                'share': float(phase.sum() * 1e6 / wall_ns)
+            }
+        return summary
+
+    def chrome_trace(self) -> dict:
+        """Return the recorded events in the Chrome trace event format."""
+        pid = os.getpid()
+        return {'traceEvents': [
+            {'name': name, 'ph': 'X', 'ts': start / 1e3, 'dur': duration / 1e3, 'pid': pid, 'tid': 0,
+             'args': {'step': step}}
+            for name, step, start, duration in self.events
+        ]}
+
+    def export(self, output_dir: str, prefix: str = 'steps') -> dict:
+        """Save the summary and the Chrome trace in output_dir, print the summary and return it."""
+        if not self.enabled:
+            return {}
+        os.makedirs(output_dir, exist_ok=True)
+        summary = self.summary()
+        with open(os.path.join(output_dir, f'{prefix}_summary.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        with open(os.path.join(output_dir, f'{prefix}_trace.json'), 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+        print(f'{"phase":<20}{"count":>8}{"total s":>10}{"mean ms":>10}{"p90 ms":>10}{"share":>8}')
+        for name, s in summary.items():
+            print(f'{name:<20}{s["count"]:>8}{s["total_s"]:>10.2f}{s["mean_ms"]:>10.2f}{s["p90_ms"]:>10.2f}{s["share"]:>8.1%}')
+        return summary
+
+    def close(self):
+        """Stop the profiler and remove the hooks."""
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
+        for handle in self._hooks:
+            handle.remove()
+        self._hooks = []
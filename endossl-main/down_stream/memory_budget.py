@@ -0,0 +1,128 @@
+"""Module with the helpers for training ViT_pretraining.py with a memory budget: the split of the batches in
+micro-batches for the gradient accumulation and the probe of the largest micro-batch that fits in a given memory.
+
+The memory is the peak of the CUDA allocator when CUDA is available, otherwise the peak resident set size of the
+process, see reset_peak_memory and peak_memory_mb, that are also used by the benchmarks.
+"""
+
+import resource
+
+import torch
+
+
+def reset_peak_memory():
+    """Reset the peak memory counter: the CUDA allocator one if CUDA is available, otherwise the peak resident set size
+    of the process (Linux only, writing 5 in /proc/self/clear_refs)."""
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_mb() -> float:
+    """Return the peak memory in MB since the last reset_peak_memory call: the CUDA allocated memory if CUDA is
+    available, otherwise the peak resident set size of the process."""
+    if torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def split_micro_batches(inputs_anchor, inputs_target: torch.Tensor, micro_batch_size: int) -> list:
+    """Split a batch of anchor and target images in micro-batches of micro_batch_size images, the last one can be
+    smaller. The anchor can also be a list of views, in this case each micro-batch contains the list of the views of
+    its images."""
+    targets = torch.split(inputs_target, micro_batch_size)
+    if isinstance(inputs_anchor, (list, tuple)):
+        views = [torch.split(view, micro_batch_size) for view in inputs_anchor]
+        anchors = [list(chunk) for chunk in zip(*views)]
+    else:
+        anchors = torch.split(inputs_anchor, micro_batch_size)
+    return list(zip(anchors, targets))
+
+
+def get_rng_state(device) -> tuple:
+    """Return the state of the CPU random generator and, for a CUDA device, of the generator of the device."""
+    device = torch.device(device)
+    cuda_state = torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+    return torch.get_rng_state(), cuda_state
+
+
+def set_rng_state(state: tuple, device):
+    """Restore a state returned by get_rng_state, so the following random operations, e.g. the masks of the anchor
+    images, are repeated exactly."""
+    cpu_state, cuda_state = state
+    torch.set_rng_state(cpu_state)
+    if cuda_state is not None:
+        torch.cuda.set_rng_state(cuda_state, torch.device(device))
+
+
+def _predicted_memory_mb(measurements: dict, batch_size: int) -> float:
+    # linear extrapolation from the two largest measured micro-batches
+    if len(measurements) < 2:
+        return 0.
+    (b0, m0), (b1, m1) = sorted(measurements.items())[-2:]
+    return m1 + (m1 - m0) / (b1 - b0) * (batch_size - b1)
+
+
+def probe_micro_batch_size(step_fn, memory_budget_mb: float, max_batch_size: int, reserved_mb: float = 0.) -> (int, dict):
+    """Find the largest micro-batch size whose training step fits in the memory budget. The size is doubled until the
+    step does not fit and then searched with a bisection. The sizes whose memory, extrapolated linearly from the
+    previous measurements, exceeds the budget are not executed, since on the CPU going out of memory would kill the
+    process; on CUDA an out of memory error is considered as a step that does not fit.
+
+    Args:
+        step_fn (function): Function executing a forward and backward step with the micro-batch size in input.
+        memory_budget_mb (float): Memory budget in MB.
+        max_batch_size (int): Largest size to try, usually the batch size.
+        reserved_mb (float): Memory not used by the probe step but needed by the training, e.g. the optimizer state.
+    Returns:
+        (int, dict): The largest size that fits, at least 1, and the peak memory in MB measured for each size tried.
+    """
+    measurements = {}
+
+    def fits(batch_size):
+        if _predicted_memory_mb(measurements, batch_size) + reserved_mb > memory_budget_mb:
+            return False
+        reset_peak_memory()
+        try:
+            step_fn(batch_size)
+        except torch.cuda.OutOfMemoryError:
+            torch.cuda.empty_cache()
+            return False
+        measurements[batch_size] = peak_memory_mb()
+        print(f'Micro-batch {batch_size}: peak memory {measurements[batch_size]:.0f} MB')
+        return measurements[batch_size] + reserved_mb <= memory_budget_mb
+
+    low, high = 0, None
+    batch_size = 1
+    while batch_size < max_batch_size:
+        if not fits(batch_size):
+            high = batch_size
+            break
+        low = batch_size
+        batch_size *= 2
+    if high is None:
+        if fits(max_batch_size):
+            return max_batch_size, measurements
+        high = max_batch_size
+
+    while high - low > 1:
+        middle = (low + high) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle
+    if low == 0:
+        print(f'Warning: a micro-batch of 1 does not fit in the memory budget of {memory_budget_mb} MB')
+    return max(low, 1), measurements
@@ -0,0 +1,422 @@
+"""Online phase recognition server for several live video streams, e.g. one for each operating room.
+
+The server is a small HTTP/1.1 service written with asyncio streams, with keep-alive connections:
+
+    POST /predict?stream=<id>   body: a PNG or JPEG frame; returns the phase probabilities of the frame
+    POST /reset?stream=<id>     forgets the temporal state of the stream
+    GET  /stats                 latency percentiles, throughput and batching counters
+
+The frames of all the streams are put in a single queue and grouped in micro-batches by the MicroBatcher: a batch is
+run as soon as it has max_batch_size frames or when the oldest frame has waited max_delay_ms, and the batches are run
+one at a time in a thread, so the event loop keeps receiving frames during the forward. For each stream the server
+keeps an exponential moving average of the probabilities, returned as the smoothed phase, which is more stable than
+the prediction of a single frame. The streams that do not send frames for stream_timeout_s seconds are forgotten.
+
+The server can be started, and tested with a local client replaying the frames of some videos as live streams, from
+the endossl-main folder with
+
+    python down_stream/phase_server.py --model_path <checkpoint> --port 8765
+    python down_stream/phase_server.py --client --port 8765 --frames_dir cholec80/frames --streams 4 --fps 5
+"""
+
+import sys
+import os
+import json
+import time
+import asyncio
+import argparse
+import collections
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torchvision
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data import cholec80_images
+from down_stream import precision
+from down_stream.video_inference import load_model, list_video_frames, _PHASE_NAMES
+
+
+class Config:
+
+    # classifier trained by cholec80_classifier.py
+    model_path = os.path.join('exps', 'cholec80_classifier_pretrained', 'checkpoints', 'model_19.pth')
+    num_classes = 7
+
+    host = '127.0.0.1'
+    port = 8765
+
+    # micro-batching: maximum frames of a forward and maximum wait of a frame before its batch is started
+    max_batch_size = 32
+    max_delay_ms = 20.
+
+    # weight of the previous smoothed probabilities of a stream, 0 for no temporal smoothing
+    smoothing = 0.8
+    stream_timeout_s = 600.
+    # larger frames are refused with 413 before their body is read
+    max_frame_bytes = 16 * 1024 * 1024
+
+    # torch threads of the forward, None for the default, and threads decoding the frames
+    threads = None
+    decode_threads = 2
+    precision = 'fp32'
+
+
+class ServerStats:
+    """Counters of the server: latency of the last max_samples requests, from the arrival of the frame to the
+    response, processed frames and batches."""
+    def __init__(self, max_samples: int = 10000):
+        self.latencies = collections.deque(maxlen=max_samples)
+        self.start = time.perf_counter()
+        self.frames = 0
+        self.batches = 0
+        self.errors = 0
+
+    def record_batch(self, size: int):
+        self.batches += 1
+        self.frames += size
+
+    def record_latency(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def snapshot(self) -> dict:
+        elapsed = time.perf_counter() - self.start
+        latencies = np.array(self.latencies) * 1e3 if self.latencies else np.zeros(1)
+        return {'frames': self.frames, 'batches': self.batches, 'errors': self.errors,
+                'mean_batch_size': self.frames / max(1, self.batches), 'frames_per_sec': self.frames / elapsed,
+                'latency_p50_ms': float(np.percentile(latencies, 50)),
+                'latency_p99_ms': float(np.percentile(latencies, 99)),
+                'latency_mean_ms': float(latencies.mean()), 'uptime_s': elapsed}
+
+
+class MicroBatcher:
+    """Groups the frames submitted by all the streams in batches for predict_fn, that is run in a separate thread.
+
+    Args:
+        predict_fn (function): Function from a batch of frames (B, 3, H, W) to the probabilities (B, num_classes).
+        max_batch_size (int): Maximum number of frames of a batch.
+        max_delay_ms (float): Maximum time a frame waits for other frames before its batch is started.
+        stats (ServerStats): Counters updated with the size of each batch.
+    """
+    def __init__(self, predict_fn, max_batch_size: int = 32, max_delay_ms: float = 20., stats: ServerStats = None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1e3
+        self.stats = stats or ServerStats()
+        self._pending = []
+        self._event = asyncio.Event()
+        self._executor = ThreadPoolExecutor(1)
+
+    async def submit(self, frame: torch.Tensor) -> torch.Tensor:
+        """Add a frame to the next batch and return its probabilities."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((frame, future, asyncio.get_running_loop().time()))
+        self._event.set()
+        return await future
+
+    async def run(self):
+        """Loop forming and running the batches, to be run as a task."""
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._event.clear()
+                await self._event.wait()
+            # the deadline is set by the oldest frame, that may already be expired after a long forward
+            deadline = self._pending[0][2] + self.max_delay
+            while len(self._pending) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            try:
+                probabilities = await loop.run_in_executor(self._executor, self.predict_fn,
+                                                           torch.stack([frame for frame, _, _ in batch]))
+            except Exception as e:
+                self.stats.errors += len(batch)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats.record_batch(len(batch))
+            for i, (_, future, _) in enumerate(batch):
+                if not future.done():
+                    future.set_result(probabilities[i])
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class StreamState:
+    """Temporal state of a stream: exponential moving average of the probabilities of its frames."""
+    def __init__(self, smoothing: float = 0.8):
+        self.smoothing = smoothing
+        self.probabilities = None
+        self.frames = 0
+        self.last_seen = time.monotonic()
+
+    def update(self, probabilities: torch.Tensor) -> torch.Tensor:
+        if self.probabilities is None:
+            self.probabilities = probabilities
+        else:
+            self.probabilities = torch.lerp(probabilities, self.probabilities, self.smoothing)
+        self.frames += 1
+        self.last_seen = time.monotonic()
+        return self.probabilities
+
+
+class PhaseServer:
+    """HTTP server of the phase recognition, see the module documentation for the endpoints.
+
+    Args:
+        predict_fn (function): Function from a batch of uint8 frames (B, 3, 224, 224) to the phase probabilities.
+        max_batch_size (int): Maximum number of frames of a forward.
+        max_delay_ms (float): Maximum wait of a frame before its batch is started.
+        smoothing (float): Weight of the previous probabilities in the moving average of each stream.
+        stream_timeout_s (float): Time after which the state of an inactive stream is removed.
+        decode_threads (int): Threads decoding the frames.
+        max_frame_bytes (int): Maximum size of the body of a request.
+    """
+    def __init__(self, predict_fn, max_batch_size: int = 32, max_delay_ms: float = 20., smoothing: float = 0.8,
+                 stream_timeout_s: float = 600., decode_threads: int = 2, max_frame_bytes: int = 16 * 1024 * 1024):
+        self.stats = ServerStats()
+        self.batcher = MicroBatcher(predict_fn, max_batch_size, max_delay_ms, self.stats)
+        self.smoothing = smoothing
+        self.stream_timeout_s = stream_timeout_s
+        self.max_frame_bytes = max_frame_bytes
+        self.streams = {}
+        self._decoder = ThreadPoolExecutor(decode_threads)
+        self._tasks = []
+        self._server = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8765):
+        self._tasks = [asyncio.create_task(self.batcher.run()), asyncio.create_task(self._prune_streams())]
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        self.batcher.close()
+        self._decoder.shutdown(wait=False)
+
+    async def _prune_streams(self):
+        while True:
+            await asyncio.sleep(min(60., self.stream_timeout_s))
+            now = time.monotonic()
+            for stream_id in [s for s, state in self.streams.items() if now - state.last_seen > self.stream_timeout_s]:
+                del self.streams[stream_id]
+
+    @staticmethod
+    def decode_frame(data: bytes) -> torch.Tensor:
+        """Decode a PNG or JPEG frame and resize it as the frames of the test split."""
+        image = torchvision.io.decode_image(torch.frombuffer(bytearray(data), dtype=torch.uint8),
+                                            mode=torchvision.io.ImageReadMode.RGB)
+        return cholec80_images.resize(image)
+
+    async def predict(self, stream_id: str, data: bytes) -> dict:
+        arrival = time.perf_counter()
+        frame = await asyncio.get_running_loop().run_in_executor(self._decoder, self.decode_frame, data)
+        probabilities = await self.batcher.submit(frame)
+        state = self.streams.get(stream_id)
+        if state is None:
+            state = self.streams[stream_id] = StreamState(self.smoothing)
+        smoothed = state.update(probabilities)
+        latency = time.perf_counter() - arrival
+        self.stats.record_latency(latency)
+        return {'stream': stream_id, 'frame': state.frames,
+                'phase': _PHASE_NAMES[int(probabilities.argmax())],
+                'smoothed_phase': _PHASE_NAMES[int(smoothed.argmax())],
+                'probabilities': dict(zip(_PHASE_NAMES, probabilities.tolist())),
+                'latency_ms': latency * 1e3}
+
+    async def _route(self, method: str, target: str, body: bytes) -> (str, dict):
+        url = urllib.parse.urlsplit(target)
+        stream_id = urllib.parse.parse_qs(url.query).get('stream', ['default'])[0]
+        if method == 'POST' and url.path == '/predict':
+            try:
+                return '200 OK', await self.predict(stream_id, body)
+            except RuntimeError as e:
+                # frames that can not be decoded
+                return '400 Bad Request', {'error': str(e)}
+            except Exception as e:
+                return '500 Internal Server Error', {'error': f'{type(e).__name__}: {e}'}
+        if method == 'POST' and url.path == '/reset':
+            self.streams.pop(stream_id, None)
+            return '200 OK', {'stream': stream_id}
+        if method == 'GET' and url.path == '/stats':
+            return '200 OK', {**self.stats.snapshot(), 'streams': len(self.streams)}
+        return '404 Not Found', {'error': f'{method} {url.path} not found'}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                # the body of a refused request is not read, so the connection is closed after the response
+                if length < 0:
+                    await self._respond(writer, '400 Bad Request', {'error': 'invalid content-length'})
+                    break
+                if length > self.max_frame_bytes:
+                    await self._respond(writer, '413 Payload Too Large',
+                                        {'error': f'body of {length} bytes, the maximum is {self.max_frame_bytes}'})
+                    break
+                body = await reader.readexactly(length)
+
+                try:
+                    status, payload = await self._route(method, target, body)
+                except Exception as e:
+                    status, payload = '500 Internal Server Error', {'error': f'{type(e).__name__}: {e}'}
+                await self._respond(writer, status, payload)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+            # closed or malformed connections, and the connections still open when the server is closed
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: str, payload: dict):
+        data = json.dumps(payload).encode()
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(data)}\r\n\r\n'.encode('latin-1') + data)
+        await writer.drain()
+
+
+def make_predict_fn(model, device='cpu', precision_name: str = 'fp32'):
+    """Return the function computing the phase probabilities of a batch of frames with the model."""
+    def predict_fn(frames: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode(), precision.autocast(precision_name, device):
+            output = model(frames.to(device, non_blocking=True))
+        return torch.softmax(output.float(), dim=1).cpu()
+    return predict_fn
+
+
+async def serve(model_path: str = None, host: str = None, port: int = None):
+    """Load the model and run the server until it is interrupted."""
+    if Config.threads:
+        torch.set_num_threads(Config.threads)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = load_model(model_path or Config.model_path, Config.num_classes, device)
+    server = PhaseServer(make_predict_fn(model, device, Config.precision), Config.max_batch_size, Config.max_delay_ms,
+                         Config.smoothing, Config.stream_timeout_s, Config.decode_threads, Config.max_frame_bytes)
+    port = await server.start(host or Config.host, port or Config.port)
+    print(f'Phase server listening on {host or Config.host}:{port}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+class PhaseClient:
+    """Asynchronous client of the server, with a keep-alive connection."""
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765):
+        self.host, self.port = host, port
+        self._reader, self._writer = None, None
+
+    async def request(self, method: str, path: str, body: bytes = b'') -> dict:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._writer.write(f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Length: {len(body)}\r\n\r\n'
+                           .encode('latin-1') + body)
+        await self._writer.drain()
+        status = (await self._reader.readline()).decode('latin-1')
+        length = 0
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin-1').split(':', 1)
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        payload = json.loads(await self._reader.readexactly(length))
+        if not status.split(' ')[1].startswith('2'):
+            raise RuntimeError(f'{status.strip()}: {payload}')
+        return payload
+
+    async def predict(self, stream_id: str, frame: bytes) -> dict:
+        return await self.request('POST', f'/predict?stream={urllib.parse.quote(stream_id)}', frame)
+
+    async def stats(self) -> dict:
+        return await self.request('GET', '/stats')
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+async def replay_streams(video_dirs: list, host: str = '127.0.0.1', port: int = 8765, fps: float = 1.,
+                         max_frames: int = None) -> dict:
+    """Send the frames of each video folder to the server as a live stream of fps frames per second, all the
+    streams at the same time, and return the client latencies and the statistics of the server."""
+    latencies = []
+
+    async def stream(video_dir: str):
+        client = PhaseClient(host, port)
+        stream_id = os.path.basename(os.path.normpath(video_dir))
+        start = time.perf_counter()
+        for k, path in enumerate(list_video_frames(video_dir)[:max_frames]):
+            await asyncio.sleep(max(0., start + k / fps - time.perf_counter()))
+            with open(path, 'rb') as f:
+                frame = f.read()
+            sent = time.perf_counter()
+            await client.predict(stream_id, frame)
+            latencies.append(time.perf_counter() - sent)
+        await client.close()
+
+    await asyncio.gather(*(stream(v) for v in video_dirs))
+    client = PhaseClient(host, port)
+    server_stats = await client.stats()
+    await client.close()
+    latencies = np.array(latencies) * 1e3
+    return {'client_latency_p50_ms': float(np.percentile(latencies, 50)),
+            'client_latency_p99_ms': float(np.percentile(latencies, 99)), 'server': server_stats}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', default=Config.model_path)
+    parser.add_argument('--host', default=Config.host)
+    parser.add_argument('--port', type=int, default=Config.port)
+    parser.add_argument('--max_batch_size', type=int, default=Config.max_batch_size)
+    parser.add_argument('--max_delay_ms', type=float, default=Config.max_delay_ms)
+    parser.add_argument('--client', action='store_true', help='replay videos as live streams to a running server')
+    parser.add_argument('--frames_dir', default=None, help='folder with the frames folders of the replayed videos')
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--fps', type=float, default=1.)
+    parser.add_argument('--max_frames', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.client:
+        videos = sorted(os.path.join(args.frames_dir, v) for v in os.listdir(args.frames_dir))[:args.streams]
+        print(json.dumps(asyncio.run(replay_streams(videos, args.host, args.port, args.fps, args.max_frames)), indent=2))
+    else:
+        Config.max_batch_size, Config.max_delay_ms = args.max_batch_size, args.max_delay_ms
+        asyncio.run(serve(args.model_path, args.host, args.port))
@@ -0,0 +1,37 @@
+"""Module with the helpers for the mixed precision training of the two training scripts.
+
+The precision can be 'fp32', 'bf16' or 'fp16'. With the low precisions the forward is executed under torch.autocast,
+while the parameters, the optimizer state, the EMA target and the prototypes stay in fp32. With 'fp16' the loss is
+also scaled by a GradScaler, to avoid the underflow of the gradients; bf16 has the same exponent range of fp32 and
+doesn't need it.
+"""
+
+import contextlib
+
+import torch
+
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def _device_type(device) -> str:
+    return torch.device(device).type
+
+
+def autocast(precision: str, device):
+    """Return the autocast context for the precision in input, a null context for 'fp32'."""
+    if precision not in PRECISIONS:
+        raise ValueError('Invalid precision: {}'.format(precision))
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=_device_type(device), dtype=PRECISIONS[precision])
+
+
+def grad_scaler(precision: str, device) -> torch.amp.GradScaler:
+    """Return the gradient scaler, that is enabled only for 'fp16'. When it is disabled scale, step and update behave
+    as the plain backward and optimizer.step."""
+    return torch.amp.GradScaler(_device_type(device), enabled=precision == 'fp16')
+
+
+def to_channels_last(inputs: torch.Tensor, enabled: bool) -> torch.Tensor:
+    """Convert a batch of images to the channels_last memory format, if enabled."""
+    return inputs.contiguous(memory_format=torch.channels_last) if enabled else inputs
@@ -0,0 +1,52 @@
+"""Module with a buffered writer of the tensorboard scalars logged at each training step.
+
+Logging a loss with writer.add_scalar(tag, loss.item(), step) forces a synchronization with the device at every step.
+The BufferedScalarWriter keeps instead the values as tensors, on the device where they have been computed, and every
+flush_every scalars copies all of them to the CPU with a single transfer and writes them to the SummaryWriter.
+"""
+
+import torch
+
+
+class BufferedScalarWriter:
+    """Buffer of scalars written to a SummaryWriter every flush_every calls of add_scalar.
+
+    Args:
+        writer (SummaryWriter): The tensorboard writer.
+        flush_every (int): Number of scalars kept in the buffer before writing them.
+    """
+    def __init__(self, writer, flush_every: int = 50):
+        self.writer = writer
+        self.flush_every = max(1, flush_every)
+        self._buffer = []
+
+    def add_scalar(self, tag: str, value, step: int) -> dict:
+        """Add a scalar to the buffer, the value can be a tensor with a single element or a number. Return the last
+        value of each tag if the buffer has been flushed, otherwise an empty dictionary."""
+        if isinstance(value, torch.Tensor):
+            value = value.detach().reshape(())
+        self._buffer.append((tag, value, step))
+        if len(self._buffer) >= self.flush_every:
+            return self.flush()
+        return {}
+
+    def flush(self) -> dict:
+        """Write all the scalars of the buffer, copying the tensors to the CPU at once, and return the last value of
+        each tag."""
+        if not self._buffer:
+            return {}
+        tensors = [value for _, value, _ in self._buffer if isinstance(value, torch.Tensor)]
+        if tensors:
+            values = iter(torch.stack([t.to(tensors[0].device, torch.float32) for t in tensors]).cpu().tolist())
+
+        last = {}
+        for tag, value, step in self._buffer:
+            value = next(values) if isinstance(value, torch.Tensor) else float(value)
+            self.writer.add_scalar(tag, value, step)
+            last[tag] = value
+        self._buffer = []
+        return last
+
+    def close(self):
+        """Write the remaining scalars, the SummaryWriter is not closed."""
+        self.flush()
@@ -0,0 +1,229 @@
+"""Phase recognition over whole surgical videos with a trained classifier of cholec80_classifier.py.
+
+The frames of each video are read in temporal order from its frames folder (video01/video01_000001.png, ...), decoded
+and resized by a pool of threads that keeps a few batches ready in advance, and classified in batches. For each video
+it is written a <video_id>-phase.txt file in the format of the Cholec80 annotations, with the frame index of the 25 fps
+video and the predicted phase, followed by the probability of each phase:
+
+    Frame	Phase	GallbladderPackaging	CleaningCoagulation	...
+    0	Preparation	0.0012	0.0003	...
+    25	Preparation	0.0010	0.0004	...
+
+Several videos can be processed in parallel by worker processes, each one with its copy of the model and
+threads_per_worker torch threads, so the cores of the machine are split between them instead of being shared by a
+single process. Run it from the endossl-main folder with
+
+    python down_stream/video_inference.py --frames_dir cholec80/frames --model_path model_19.pth --num_workers 2
+    python down_stream/video_inference.py --videos cholec80/frames/video49 cholec80/frames/video50
+"""
+
+import sys
+import os
+import time
+import argparse
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+import torchvision
+from torch.nn.functional import softmax
+
+sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+from data import cholec80_images
+from down_stream import precision
+from down_stream import checkpointing
+from models.MyViTMSN import MyViTMSNModel
+
+
+class Config:
+
+    # classifier trained by cholec80_classifier.py, a checkpoint or a file with the state dict of the model
+    model_path = os.path.join('exps', 'cholec80_classifier_pretrained', 'checkpoints', 'model_19.pth')
+    num_classes = 7
+
+    # folder of the <video_id>-phase.txt files with the predictions
+    output_dir = os.path.join('exps', 'inference')
+
+    # batches: number of frames of each forward, threads decoding the frames and batches decoded in advance
+    batch_size = 64
+    decode_threads = 2
+    prefetch_batches = 2
+
+    # parallelism: number of processes, each one working on a different video, and torch threads of each process,
+    # None for splitting the cores of the machine between the processes
+    num_workers = 1
+    threads_per_worker = None
+
+    # precision of the forward: 'fp32', 'bf16' or 'fp16', see down_stream/precision.py
+    precision = 'fp32'
+
+
+_PHASE_NAMES = sorted(cholec80_images._LABEL_NUM_MAPPING, key=cholec80_images._LABEL_NUM_MAPPING.get)
+
+
+def list_video_frames(video_dir: str) -> list:
+    """Return the paths of the frames of the video folder, ordered by frame index."""
+    frames = [f for f in os.listdir(video_dir) if f.endswith('.png')]
+    frames.sort(key=lambda frame: int(frame[-10:-4]))
+    return [os.path.join(video_dir, f) for f in frames]
+
+
+def load_frame(path: str) -> torch.Tensor:
+    """Decode and resize a frame as in the validation and test splits."""
+    return cholec80_images.resize(torchvision.io.decode_png(torchvision.io.read_file(path)))
+
+
+def iterate_batches(paths: list, batch_size: int, executor: ThreadPoolExecutor, prefetch_batches: int = 2):
+    """Yield the batches of the decoded frames of paths, in order. The frames of the next prefetch_batches batches are
+    decoded by the executor while the current batch is processed."""
+    pending = collections.deque()
+    starts = iter(range(0, len(paths), batch_size))
+
+    def submit():
+        start = next(starts, None)
+        if start is not None:
+            pending.append([executor.submit(load_frame, p) for p in paths[start:start + batch_size]])
+
+    for _ in range(prefetch_batches + 1):
+        submit()
+    while pending:
+        futures = pending.popleft()
+        submit()
+        yield torch.stack([f.result() for f in futures])
+
+
+def load_model(model_path: str, num_classes: int = 7, device='cpu') -> MyViTMSNModel:
+    """Build the classifier and load its weights, the Hugging Face weights are not loaded since they are overwritten."""
+    model = MyViTMSNModel(device=device, load_weights=False)
+    model.classifier = nn.Linear(model.classifier.in_features, num_classes)
+    model.load_state_dict(checkpointing.load_model_state_dict(model_path))
+    model.to(device)
+    model.eval()
+    return model
+
+
+def predict_video(model: MyViTMSNModel, video_dir: str, batch_size: int = 64, decode_threads: int = 2,
+                  prefetch_batches: int = 2, device='cpu', precision_name: str = 'fp32') -> torch.Tensor:
+    """Return the phase probabilities (num_frames, num_classes) of all the frames of the video folder, in order."""
+    paths = list_video_frames(video_dir)
+    probabilities = []
+    with ThreadPoolExecutor(decode_threads) as executor, torch.inference_mode():
+        for inputs in iterate_batches(paths, batch_size, executor, prefetch_batches):
+            with precision.autocast(precision_name, device):
+                output = model(inputs.to(device, non_blocking=True))
+            probabilities.append(softmax(output.float(), dim=1).cpu())
+    if not probabilities:
+        return torch.zeros((0, model.classifier.out_features))
+    return torch.cat(probabilities)
+
+
+def write_predictions(path: str, probabilities: torch.Tensor, frame_indices: list):
+    """Write the predicted phases and the probabilities in the format of the Cholec80 annotation files. The frame
+    index of the extracted frame k (starting from 1) is the one of the 25 fps video, (k - 1) * _SUBSAMPLE_RATE."""
+    predictions = probabilities.argmax(dim=1).tolist()
+    with open(path, 'w') as f:
+        f.write('\t'.join(['Frame', 'Phase'] + _PHASE_NAMES) + '\n')
+        for k, label, probs in zip(frame_indices, predictions, probabilities.tolist()):
+            frame = (k - 1) * cholec80_images._SUBSAMPLE_RATE
+            f.write(f'{frame}\t{_PHASE_NAMES[label]}\t' + '\t'.join(f'{p:.4f}' for p in probs) + '\n')
+
+
+def infer_video(model: MyViTMSNModel, video_dir: str, output_dir: str, device='cpu') -> dict:
+    """Predict the phases of a video and write its -phase.txt file, returning the number of frames and the frames per
+    second."""
+    video_id = os.path.basename(os.path.normpath(video_dir))
+    start = time.perf_counter()
+    probabilities = predict_video(model, video_dir, Config.batch_size, Config.decode_threads, Config.prefetch_batches,
+                                  device, Config.precision)
+    seconds = time.perf_counter() - start
+    frame_indices = [int(p[-10:-4]) for p in list_video_frames(video_dir)]
+    write_predictions(os.path.join(output_dir, f'{video_id}-phase.txt'), probabilities, frame_indices)
+    return {'video': video_id, 'frames': len(frame_indices), 'seconds': seconds,
+            'frames_per_sec': len(frame_indices) / max(seconds, 1e-9)}
+
+
+_worker_model = None
+
+# options of the Config class sent to the worker processes, that import this module again with the default values
+_WORKER_OPTIONS = ('batch_size', 'decode_threads', 'prefetch_batches', 'precision')
+
+
+def _init_worker(model_path: str, num_classes: int, threads: int, options: dict):
+    global _worker_model
+    for name, value in options.items():
+        setattr(Config, name, value)
+    torch.set_num_threads(threads)
+    _worker_model = load_model(model_path, num_classes)
+
+
+def _infer_video_worker(args) -> dict:
+    video_dir, output_dir = args
+    return infer_video(_worker_model, video_dir, output_dir)
+
+
+def run_inference(video_dirs: list, output_dir: str = None, model_path: str = None, num_workers: int = None,
+                  threads_per_worker: int = None) -> list:
+    """Predict the phases of all the video folders, with num_workers processes on the CPU, or in this process on the
+    GPU if available. Print the frames per second of each video and of the whole run and return the statistics of
+    each video."""
+    output_dir = output_dir or Config.output_dir
+    model_path = model_path or Config.model_path
+    num_workers = min(num_workers or Config.num_workers, len(video_dirs))
+    os.makedirs(output_dir, exist_ok=True)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    start = time.perf_counter()
+    if num_workers <= 1 or device.type == 'cuda':
+        if threads_per_worker or Config.threads_per_worker:
+            torch.set_num_threads(threads_per_worker or Config.threads_per_worker)
+        model = load_model(model_path, Config.num_classes, device)
+        results = []
+        for video_dir in video_dirs:
+            results.append(infer_video(model, video_dir, output_dir, device))
+            print(f'{results[-1]["video"]}: {results[-1]["frames"]} frames, {results[-1]["frames_per_sec"]:.1f} frames/s')
+    else:
+        threads = threads_per_worker or Config.threads_per_worker or max(1, (os.cpu_count() or 1) // num_workers)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(num_workers, initializer=_init_worker,
+                          initargs=(model_path, Config.num_classes, threads,
+                                    {name: getattr(Config, name) for name in _WORKER_OPTIONS})) as pool:
+            results = []
+            # the longest videos are started first, so the workers finish at about the same time
+            video_dirs = sorted(video_dirs, key=lambda v: len(os.listdir(v)), reverse=True)
+            for result in pool.imap_unordered(_infer_video_worker, [(v, output_dir) for v in video_dirs]):
+                results.append(result)
+                print(f'{result["video"]}: {result["frames"]} frames, {result["frames_per_sec"]:.1f} frames/s')
+    seconds = time.perf_counter() - start
+
+    total_frames = sum(r['frames'] for r in results)
+    print(f'{len(results)} videos, {total_frames} frames in {seconds:.1f} s: {total_frames / seconds:.1f} frames/s '
+          f'(model loading included)')
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--videos', nargs='+', default=None, help='frames folders of the videos')
+    parser.add_argument('--frames_dir', default=None, help='folder with a frames folder for each video')
+    parser.add_argument('--model_path', default=Config.model_path)
+    parser.add_argument('--output_dir', default=Config.output_dir)
+    parser.add_argument('--batch_size', type=int, default=Config.batch_size)
+    parser.add_argument('--decode_threads', type=int, default=Config.decode_threads)
+    parser.add_argument('--num_workers', type=int, default=Config.num_workers)
+    parser.add_argument('--threads_per_worker', type=int, default=Config.threads_per_worker)
+    parser.add_argument('--precision', default=Config.precision, choices=['fp32', 'bf16', 'fp16'])
+    args = parser.parse_args()
+
+    video_dirs = list(args.videos or [])
+    if args.frames_dir is not None:
+        video_dirs += sorted(os.path.join(args.frames_dir, v) for v in os.listdir(args.frames_dir)
+                             if os.path.isdir(os.path.join(args.frames_dir, v)))
+    if not video_dirs:
+        parser.error('no video given, use --videos or --frames_dir')
+
+    Config.batch_size, Config.decode_threads, Config.precision = args.batch_size, args.decode_threads, args.precision
+    run_inference(video_dirs, args.output_dir, args.model_path, args.num_workers, args.threads_per_worker)
@@ -1,29 +1,51 @@
 import torch
 import torch.nn as nn
-from transformers import ViTMSNModel, AutoImageProcessor
+
+from models import model_cache
+from models.preprocessing import ViTImagePreprocessor
 
 class MyViTMSNModel(nn.Module):
     """This class implement the ViT-MSN model for the transfer learning part. It will upload the model from the Hugging Face
     model hub and add a classifier layer on top of the model. Default model is the 'facebook/vit-msn-small' model and
     the classifier layer is a linear layer with 1024 output neurons. This FC layer can be accessed by model.classifier
 
+    The model and its image processor are downloaded only the first time, then they are built from the local cache
+    without network access, see models/model_cache.py.
+
     Args:
         pretrained_model_name_or_path (str): The name or path of the model to be loaded. Default is 'facebook/vit-msn-small'
         device: a string that contain the device to be used. Default is 'cpu', but can be changed to 'cuda'
         if GPU is available
+        config (ViTConfig): if given the ViT is built from this configuration with random weights, instead of loading
+        the pretrained model, e.g. for the benchmarks without network access
+        image_processor: Hugging Face image processor used for the preprocessing, default is the one of
+        'facebook/vit-msn-small' from the model cache
+        load_weights (bool): if False only the configuration of the pretrained model is read and its weights are left
+        uninitialized, for when the state dict of the model is loaded from a checkpoint right after the construction
         """
-    def __init__(self, pretrained_model_name_or_path : str = 'facebook/vit-msn-small', device : str = 'cpu'):
+    def __init__(self, pretrained_model_name_or_path : str = 'facebook/vit-msn-small', device : str = 'cpu',
+                 config=None, image_processor=None, load_weights: bool = True):
         super(MyViTMSNModel, self).__init__()
-        self.image_processor = AutoImageProcessor.from_pretrained("facebook/vit-msn-small")
-        self.vitMsn = ViTMSNModel.from_pretrained(pretrained_model_name_or_path)
+        if image_processor is not None:
+            self.preprocess = ViTImagePreprocessor.from_image_processor(image_processor)
+        else:
+            self.preprocess = model_cache.load_preprocessor(model_cache.DEFAULT_MODEL)
+        if config is not None:
+            self.vitMsn = model_cache.build_vit(config)
+        else:
+            self.vitMsn = model_cache.load_vit(pretrained_model_name_or_path, load_weights)
         self.classifier = nn.Linear(self.vitMsn.config.hidden_size, 1024, bias=False)
         self.device = device
 
         if self.vitMsn.embeddings.mask_token is None:
             self.vitMsn.embeddings.mask_token = nn.Parameter(torch.zeros(1, 1, self.vitMsn.config.hidden_size))
 
-    def forward(self, inputs):
-        inputs = torch.Tensor(self.image_processor(inputs, do_rescale=False, return_tensors="np")['pixel_values']).to(self.device)
+    def features(self, inputs):
+        """Return the last hidden state of the CLS token, that is the input of the classifier layer."""
+        inputs = self.preprocess(inputs.to(self.device, non_blocking=True))
         output = self.vitMsn(inputs)[0]
-        output = self.classifier(output[:, 0, :])
-        return output
\ No newline at end of file
+        return output[:, 0, :]
+
+    def forward(self, inputs):
+        output = self.classifier(self.features(inputs))
+        return output
@@ -1,9 +1,8 @@
-from idlelib.pyshell import MyRPCClient
-from typing import Any, Generator
-
 import torch
 import torch.nn as nn
-from transformers import ViTMSNModel, AutoImageProcessor, ViTConfig
+
+from models import model_cache
+from models.preprocessing import ViTImagePreprocessor
 
 
 class MyViTMSNModel_pretraining(nn.Module):
@@ -12,29 +11,59 @@ class MyViTMSNModel_pretraining(nn.Module):
     6 attention heads and a intermediate size (fully connected after the attention) of 1536.
 
     Are then saved some parameters by default such as tau and then are initialized the learnable prototypes.
-    The momentum scheduler is also initialized for the exponential moving average for updating the target ViT during training,
+    The momentum schedule is also initialized for the exponential moving average for updating the target ViT during training,
     which parameter will not be trained using backpropagation.
 
     If necessary will be initialized also the embeddings mask token and is set the patch numbers for the generation of the
-    random masking.
+    random masking. By default the masked patches are dropped from the anchor branch, as in MSN, so the anchor ViT
+    processes only the kept patch tokens.
 
     Parameters:
         ipe (int): the number of iterations per epoch during training loop
         num_epochs (int): the total number of epochs in training loop
         device (str): a string that contain the device to be used. Default is 'cpu', but can be changed to 'cuda'
         if GPU is available
+        mask_ratio (float): the fraction of patches masked in the anchor image
+        mask_strategy (str): 'random' for masking random patches, 'block' for keeping a random rectangular block of
+        patches (focal masking)
+        drop_masked_patches (bool): if True the masked patches are removed before the transformer blocks of the anchor
+        ViT, otherwise they are replaced by the mask token
+        gradient_checkpointing (bool): if True the activations of the encoder layers of the anchor ViT are not kept for
+        the backward but recomputed, reducing the memory of the training at the cost of a second forward of the layers
+        config (ViTConfig): configuration of the two ViTs, default is the ViT-small one described above
+        image_processor: Hugging Face image processor used for the preprocessing, default is the one of
+        'facebook/vit-msn-small' from the model cache, see models/model_cache.py
+        target_sharpening (float): temperature applied to the target logits on top of tau, as in MSN; values lower
+        than 1 sharpen the target distribution, 1 leaves it unchanged
         """
-    def __init__(self, ipe, num_epochs, device : str = 'cpu'):
+    def __init__(self, ipe, num_epochs, device : str = 'cpu', mask_ratio: float = 0.5, mask_strategy: str = 'random',
+                 drop_masked_patches: bool = True, gradient_checkpointing: bool = False, config=None,
+                 image_processor=None, target_sharpening: float = 0.25):
         super(MyViTMSNModel_pretraining, self).__init__()
-        self.image_processor = AutoImageProcessor.from_pretrained("facebook/vit-msn-small")
-        config = ViTConfig(num_hidden_layers=12, hidden_size=384, num_attention_heads=6, intermediate_size=1536)
-        self.vitMsn_target = ViTMSNModel(config)
-        self.vitMsn_anchor = ViTMSNModel(config)
+        if image_processor is not None:
+            self.preprocess = ViTImagePreprocessor.from_image_processor(image_processor)
+        else:
+            self.preprocess = model_cache.load_preprocessor(model_cache.DEFAULT_MODEL)
+        if config is None:
+            from transformers import ViTConfig
+            config = ViTConfig(num_hidden_layers=12, hidden_size=384, num_attention_heads=6, intermediate_size=1536)
+        self.vitMsn_target = model_cache.build_vit(config)
+        self.vitMsn_anchor = model_cache.build_vit(config)
         self.device = device
         self.train_phase = True
         self.tau = 0.1
+        self.target_sharpening = target_sharpening
+        self.mask_ratio = mask_ratio
+        self.mask_strategy = mask_strategy
+        self.drop_masked_patches = drop_masked_patches
         self.prototypes = self.prototypes_init(1024, self.vitMsn_anchor.config.hidden_size)
-        self.momentum_scheduler = self.momentum_scheduler_init(ipe, num_epochs)
+        self.ipe = ipe
+        self.num_epochs = num_epochs
+        # position in the momentum schedule, saved in the state dict so that the schedule can be resumed
+        self.register_buffer('ema_step', torch.zeros((), dtype=torch.int64))
+        self._ema_step = 0
+        self._register_load_state_dict_pre_hook(self._ema_step_pre_hook)
+        self.register_load_state_dict_post_hook(self._ema_step_post_hook)
 
         if self.vitMsn_anchor.embeddings.mask_token is None:
             self.vitMsn_anchor.embeddings.mask_token = nn.Parameter(torch.zeros(1, 1, self.vitMsn_anchor.config.hidden_size))
@@ -43,6 +72,13 @@ class MyViTMSNModel_pretraining(nn.Module):
 
         for param in self.vitMsn_target.parameters():
             param.requires_grad = False
+        # when the masked patches are dropped the mask token of the anchor is never used, so it is not trained; this is
+        # also required by DistributedDataParallel, that expects a gradient for every trainable parameter
+        if drop_masked_patches:
+            self.vitMsn_anchor.embeddings.mask_token.requires_grad = False
+
+        if gradient_checkpointing:
+            self.vitMsn_anchor.gradient_checkpointing_enable(gradient_checkpointing_kwargs={'use_reentrant': False})
 
         patch_size = self.vitMsn_anchor.config.patch_size
         self.patch_numbers = (224 * 224) // (patch_size * patch_size)
@@ -52,55 +88,199 @@ class MyViTMSNModel_pretraining(nn.Module):
         """For the forward part the two inputs, that must be the same image with different random data augmentation operations
          will follow two different paths, one for the anchor image and one for the target image.
 
-         Both of them are first given in input to the image processor, that prepare the image for the ViT-MSN model applying
-         transformations such as resizing, normalization and tensor conversion, if necessary.
+         Both of them are first given in input to the preprocessing module, that prepare the image for the ViT-MSN model
+         applying the resizing and the normalization of the image processor directly on the tensors, on the model device.
 
          Then both images are given in inputs to the ViT-MSN models; remember that the anchor branch will use a random
-         mask that is previously computed. After the ViT is then computed the dot product with the prototypes matrix,
-         scaled by the tau value and applied the softmax for obtaining two probability distributions.
+         mask that is previously computed, see anchor_forward. After the ViT is then computed the dot product with the prototypes matrix,
+         scaled by the tau value. The anchor branch returns these logits, so the loss can work on their log_softmax,
+         see models/msn_loss.py, while the target branch returns the probabilities sharpened by target_sharpening.
+         The target branch runs in inference mode, since it receives no gradient: autograd does not record it and
+         does not keep its activations.
+
+         The anchor can also be a list of views of the same images, e.g. global and focal views of different resolutions
+         as returned by MultiCropAugmentCollate. In this case the views are not resized, the views with the same
+         resolution are processed by the anchor ViT in a single forward and the anchor logits of all the views
+         are returned concatenated in the order of the list, so the row j * batch_size + i is the view j of the image i.
 
         Parameters:
-            img_anchor (torch.Tensor) : containing the anchor image
+            img_anchor (torch.Tensor or list) : containing the anchor image, or a list with the anchor views
             img_target (torch.Tensor) : containing the target image
 
         Returns:
-            (torch.Tensor, torch.Tensor) : two tensors containing the probabilities of the anchor and target branches
+            (torch.Tensor, torch.Tensor) : two tensors containing the logits of the anchor branch and the
+            probabilities of the target branch
          """
 
-        bool_masked_pos = self.mask_generator(img_anchor.shape[0], self.patch_numbers)
+        return self.anchor_logits(img_anchor), self.target_output(img_target)
+
+
+    def anchor_logits(self, img_anchor) -> torch.Tensor:
+
+        """Anchor branch of the forward: masking, anchor ViT and logits over the prototypes.
 
-        img_anchor = torch.Tensor(self.image_processor(img_anchor, do_rescale=False, return_tensors="np")['pixel_values']).to(self.device)
-        img_target = torch.Tensor(self.image_processor(img_target, do_rescale=False, return_tensors="np")['pixel_values']).to(self.device)
+        Parameters:
+            img_anchor (torch.Tensor or list) : containing the anchor image, or a list with the anchor views
 
-        output_anchor = self.vitMsn_anchor(img_anchor, bool_masked_pos=bool_masked_pos)[0]
-        output_anchor = nn.functional.normalize(output_anchor[:, 0, :])
-        output_anchor = nn.functional.softmax(output_anchor @ self.prototypes.T / self.tau, dim=1)
+        Returns:
+            torch.Tensor: the logits of the anchor branch
+        """
 
-        output_target = self.vitMsn_target(img_target)[0]
-        output_target = nn.functional.normalize(output_target[:, 0, :])
-        output_target = nn.functional.softmax(output_target @ self.prototypes.T / self.tau, dim=1)
+        if isinstance(img_anchor, (list, tuple)):
+            output_anchor = self.multi_view_anchor_forward(img_anchor)
+        else:
+            bool_masked_pos = self.mask_generator(img_anchor.shape[0], self.patch_numbers)
+            img_anchor = self.preprocess(img_anchor.to(self.device, non_blocking=True))
+            output_anchor = self.anchor_forward(img_anchor, bool_masked_pos)
 
-        return output_anchor, output_target
+        output_anchor = nn.functional.normalize(output_anchor)
+        return output_anchor @ self.prototypes.T / self.tau
 
 
-    def mask_generator(self, batch_size: int, patch_numbers: int) -> torch.Tensor:
+    def anchor_output(self, img_anchor) -> torch.Tensor:
 
-        """ Generate a random mask for the input tensor, such that half of the patches will be masked.
+        """Probabilities over the prototypes of the anchor branch, the softmax of anchor_logits.
+
+        Parameters:
+            img_anchor (torch.Tensor or list) : containing the anchor image, or a list with the anchor views
+
+        Returns:
+            torch.Tensor: the probabilities of the anchor branch
+        """
+
+        return nn.functional.softmax(self.anchor_logits(img_anchor), dim=1)
+
+
+    def target_output(self, img_target) -> torch.Tensor:
+
+        """Target branch of the forward: target ViT, without masking, and probabilities over the prototypes sharpened
+        by target_sharpening. It runs in inference mode, the result is cloned out of it so it can be saved by the
+        autograd of the loss.
+
+        Parameters:
+            img_target (torch.Tensor) : containing the target image
+
+        Returns:
+            torch.Tensor: the probabilities of the target branch
+        """
+
+        with torch.inference_mode():
+            img_target = self.preprocess(img_target.to(self.device, non_blocking=True))
+            output_target = self.vitMsn_target(img_target)[0]
+            output_target = nn.functional.normalize(output_target[:, 0, :])
+            logits = output_target @ self.prototypes.T / (self.tau * self.target_sharpening)
+            probabilities = nn.functional.softmax(logits.float(), dim=1)
+        return probabilities.clone()
+
+
+    def multi_view_anchor_forward(self, views: list) -> torch.Tensor:
+
+        """Forward of the anchor ViT for a list of views of the same batch of images. The views are grouped by
+        resolution and each group is concatenated along the batch dimension, masked and processed with a single call
+        of anchor_forward, with the position embeddings interpolated to the resolution of the group.
+
+        Parameters:
+            views (list): list of the anchor views, each one a batch of images (batch_size, C, H, W)
+
+        Returns:
+            torch.Tensor: tensor of shape (len(views) * batch_size, hidden_size) with the CLS outputs of the views, in
+            the order of the list
+        """
+
+        patch_size = self.vitMsn_anchor.config.patch_size
+        groups = {}
+        for j, view in enumerate(views):
+            groups.setdefault(tuple(view.shape[-2:]), []).append(j)
+
+        outputs = [None] * len(views)
+        for (height, width), idx in groups.items():
+            pixel_values = torch.cat([views[j].to(self.device, non_blocking=True) for j in idx])
+            pixel_values = self.preprocess(pixel_values, resize=False)
+            bool_masked_pos = self.mask_generator(pixel_values.shape[0], (height // patch_size) * (width // patch_size))
+            output = self.anchor_forward(pixel_values, bool_masked_pos)
+            for j, out in zip(idx, output.chunk(len(idx))):
+                outputs[j] = out
+        return torch.cat(outputs)
+
+
+    def mask_generator(self, batch_size: int, patch_numbers: int, mask_ratio: float = None, strategy: str = None) -> torch.Tensor:
+
+        """ Generate a random mask for the anchor images of the batch, with the same number of masked patches for each
+        image, so that the kept patches can be gathered in a single tensor. The mask is generated for the whole batch
+        with a single topk over random noise for the 'random' strategy, while the 'block' strategy keeps a rectangular
+        block of patches, in a random position for each image, with an area that approximates the kept ratio.
 
         Parameters:
             batch_size (int): The size of the batch
             patch_numbers (int): The number of patches in the input tensor
+            mask_ratio (float): The fraction of masked patches, default is the one of the model
+            strategy (str): 'random' or 'block', default is the one of the model
 
         Returns:
-            torch.Tensor: A tensor of shape (batch_size, patch_numbers) containing the random mask, where each position that
-            contains a 1 will not mask the corresponding patch, if contains 0 it will.
+            torch.Tensor: A boolean tensor of shape (batch_size, patch_numbers) containing the random mask, where each
+            position that contains True will mask the corresponding patch, as the bool_masked_pos of ViTMSNModel.
         """
 
-        mask = torch.zeros(batch_size, patch_numbers)
-        for i in range(batch_size):
-            idx = torch.randperm(patch_numbers)[:patch_numbers  // 2]
-            mask[i, idx] = 1
-        return mask
+        mask_ratio = self.mask_ratio if mask_ratio is None else mask_ratio
+        strategy = self.mask_strategy if strategy is None else strategy
+
+        if strategy == 'random':
+            num_masked = int(patch_numbers * mask_ratio)
+            noise = torch.rand(batch_size, patch_numbers, device=self.device)
+            masked_idx = noise.topk(num_masked, dim=1).indices
+            mask = torch.zeros(batch_size, patch_numbers, dtype=torch.bool, device=self.device)
+            return mask.scatter_(1, masked_idx, True)
+        elif strategy == 'block':
+            side = int(round(patch_numbers ** 0.5))
+            num_kept = patch_numbers - int(patch_numbers * mask_ratio)
+            block_h = max(1, min(side, int(round(num_kept ** 0.5))))
+            block_w = max(1, min(side, int(round(num_kept / block_h))))
+
+            top = torch.randint(0, side - block_h + 1, (batch_size, 1), device=self.device)
+            left = torch.randint(0, side - block_w + 1, (batch_size, 1), device=self.device)
+            coords = torch.arange(side, device=self.device).unsqueeze(0)
+            in_rows = (coords >= top) & (coords < top + block_h)
+            in_cols = (coords >= left) & (coords < left + block_w)
+            return ~(in_rows.unsqueeze(2) & in_cols.unsqueeze(1)).view(batch_size, patch_numbers)
+        else:
+            raise ValueError('Invalid mask strategy: {}'.format(strategy))
+
+
+    def anchor_forward(self, pixel_values: torch.Tensor, bool_masked_pos: torch.Tensor) -> torch.Tensor:
+
+        """Forward of the anchor ViT, returning the output for the CLS token. If drop_masked_patches is True the patch
+        embeddings, with their position embeddings already added, are gathered keeping only the not masked patches, so
+        the transformer blocks process only them and the CLS token. Otherwise the masked patches are replaced by the mask
+        token inside the ViTMSNModel. Images with a resolution different from the one of the model, such as the focal
+        views, use the position embeddings interpolated to their number of patches.
+
+        Parameters:
+            pixel_values (torch.Tensor): the preprocessed anchor images
+            bool_masked_pos (torch.Tensor): the boolean mask generated by mask_generator
+
+        Returns:
+            torch.Tensor: tensor of shape (batch_size, hidden_size) with the last hidden state of the CLS token
+        """
+
+        vit = self.vitMsn_anchor
+        if not self.drop_masked_patches:
+            return vit(pixel_values, bool_masked_pos=bool_masked_pos, interpolate_pos_encoding=True)[0][:, 0, :]
+
+        batch_size, _, height, width = pixel_values.shape
+        embeddings = vit.embeddings
+
+        patches = embeddings.patch_embeddings(pixel_values, interpolate_pos_encoding=True)
+        tokens = torch.cat((embeddings.cls_token.expand(batch_size, -1, -1), patches), dim=1)
+        # the position embeddings are interpolated only if the resolution is different from the one of the model
+        tokens = tokens + embeddings.interpolate_pos_encoding(tokens, height, width)
+
+        # every row of the mask has the same number of kept patches, so nonzero returns them ordered by image
+        ids_keep = torch.nonzero(~bool_masked_pos)[:, 1].view(batch_size, -1)
+        patches = tokens[:, 1:, :].gather(1, ids_keep.unsqueeze(-1).expand(-1, -1, tokens.shape[-1]))
+
+        hidden_states = embeddings.dropout(torch.cat((tokens[:, :1, :], patches), dim=1))
+        hidden_states = vit.encoder(hidden_states)[0]
+        return vit.layernorm(hidden_states[:, 0, :])
 
 
     def prototypes_init(self, num_proto: int, output_dim: int) -> torch.Tensor:
@@ -123,32 +303,47 @@ class MyViTMSNModel_pretraining(nn.Module):
         return prototypes
 
 
-    def momentum_scheduler_init(self, ipe: int, num_epochs: int) -> Generator[float, Any, None]:
+    def momentum(self, step: int) -> float:
 
         """
-        Initializing the momentum scheduler that is needed for the exponential moving average for updating the
-        target ViT during training, using the learned parameters of the anchor ViT
+        Momentum schedule that is needed for the exponential moving average for updating the target ViT during training,
+        using the learned parameters of the anchor ViT. The momentum grows linearly from 0.996 to 1.0 over 1.25 times
+        the number of iterations of the training, and it is computed in closed form from the step, so that the schedule
+        can be saved, resumed and inspected.
         Parameters:
-              ipe (int): iterations per epoch during training loop
-              num_epochs  (int): total number of epochs in trianing loop
+              step (int): number of EMA updates already done
         Return:
-            momentum scheduler
+            the momentum for the EMA update number step
         """
 
         _start_m, _final_m = 0.996, 1.0
-        _increment = (_final_m - _start_m) / (ipe * num_epochs * 1.25)
-        momentum_scheduler = (_start_m + (_increment * i) for i in range(int(ipe * num_epochs * 1.25) + 1))
-        return momentum_scheduler
+        _increment = (_final_m - _start_m) / (self.ipe * self.num_epochs * 1.25)
+        return min(_start_m + _increment * step, _final_m)
+
+
+    @staticmethod
+    def _ema_step_pre_hook(state_dict, prefix, *args):
+        # the checkpoints saved before the ema_step buffer was added start the schedule from the beginning
+        state_dict.setdefault(prefix + 'ema_step', torch.zeros((), dtype=torch.int64))
+
+    @staticmethod
+    def _ema_step_post_hook(module, incompatible_keys):
+        module._ema_step = int(module.ema_step)
 
 
     def exponential_moving_average(self):
 
         """
         Function for updating the target visual transformer parameters during training based on the learned parameters
-        of the anchor visual transformer. This function uses the exponential moving average for doing this update.
+        of the anchor visual transformer. This function uses the exponential moving average for doing this update,
+        target = m * target + (1 - m) * anchor, written as a lerp of all the parameters with a single multi-tensor
+        foreach operation, without allocating temporary tensors for each parameter.
         """
 
         with torch.no_grad():
-            m = next(self.momentum_scheduler)
-            for param_q, param_k in zip(self.vitMsn_anchor.parameters(), self.vitMsn_target.parameters()):
-                param_k.data.mul_(m).add_((1. - m) * param_q.detach().data)
+            m = self.momentum(self._ema_step)
+            params_k = [param.detach() for param in self.vitMsn_target.parameters()]
+            params_q = [param.detach() for param in self.vitMsn_anchor.parameters()]
+            torch._foreach_lerp_(params_k, params_q, 1. - m)
+            self._ema_step += 1
+            self.ema_step.fill_(self._ema_step)
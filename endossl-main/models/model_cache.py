@@ -0,0 +1,143 @@
+"""Module for building the ViT-MSN models of this project from a local cache, without accessing the Hugging Face hub.
+
+The first time a model is requested its configuration, its image processor configuration and its weights are downloaded
+with transformers and saved in a folder of the cache:
+
+    <cache root>/facebook--vit-msn-small
+    ├── config.json
+    ├── preprocessor_config.json
+    └── model.safetensors
+
+then the models are always built from these files, with no network access: the preprocessing module directly from
+preprocessor_config.json, and the ViT with from_pretrained on the local folder, that reads the memory-mapped
+safetensors file and skips the random initialization of the weights. With load_weights=False only config.json is
+read and the weights are left uninitialized, for the models whose weights are overwritten right after the construction
+by a local checkpoint. The transformers package is imported only when a ViT is built, so importing the models is cheap.
+
+The cache root is the folder in the ENDOSSL_MODEL_CACHE environment variable, default ~/.cache/endossl/models. The
+cache of a model can also be filled in advance, on a machine with network access, running
+
+    python models/model_cache.py --model facebook/vit-msn-small
+
+and a folder with the same files, e.g. written by save_pretrained with safetensors, can be used in place of the name
+of the model.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+
+DEFAULT_MODEL = 'facebook/vit-msn-small'
+
+_CONFIG_NAME = 'config.json'
+_PREPROCESSOR_NAME = 'preprocessor_config.json'
+_WEIGHTS_NAME = 'model.safetensors'
+
+
+def cache_root() -> str:
+    return os.environ.get('ENDOSSL_MODEL_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'endossl', 'models'))
+
+
+def model_dir(model_name_or_path: str = DEFAULT_MODEL) -> str:
+    """Return the folder with the files of the model: the path itself if it is a folder, otherwise the folder of the
+    model in the cache, that may not exist yet."""
+    if os.path.isdir(model_name_or_path):
+        return model_name_or_path
+    return os.path.join(cache_root(), model_name_or_path.replace('/', '--'))
+
+
+def is_cached(model_name_or_path: str = DEFAULT_MODEL) -> bool:
+    directory = model_dir(model_name_or_path)
+    return all(os.path.exists(os.path.join(directory, name)) for name in (_CONFIG_NAME, _PREPROCESSOR_NAME, _WEIGHTS_NAME))
+
+
+def download(model_name: str = DEFAULT_MODEL) -> str:
+    """Download the model from the Hugging Face hub and save its files in the cache, writing them in a temporary
+    folder that is renamed only when complete. Return the folder of the model."""
+    from transformers import AutoImageProcessor, ViTMSNModel
+
+    directory = model_dir(model_name)
+    tmp_dir = directory + f'.{os.getpid()}.tmp'
+    print(f'Downloading {model_name} to {directory}')
+    ViTMSNModel.from_pretrained(model_name).save_pretrained(tmp_dir, safe_serialization=True)
+    AutoImageProcessor.from_pretrained(model_name).save_pretrained(tmp_dir)
+    # the processor may be saved with a different name by future versions of transformers, the files are checked
+    if not os.path.exists(os.path.join(tmp_dir, _WEIGHTS_NAME)) or not os.path.exists(os.path.join(tmp_dir, _PREPROCESSOR_NAME)):
+        raise RuntimeError(f'Unexpected files saved for {model_name}: {os.listdir(tmp_dir)}')
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.replace(tmp_dir, directory)
+    return directory
+
+
+def _cached_file(model_name_or_path: str, name: str) -> str:
+    """Return the path of a file of the model, downloading the model in the cache if it is not there."""
+    path = os.path.join(model_dir(model_name_or_path), name)
+    if not os.path.exists(path):
+        if os.path.isdir(model_name_or_path):
+            raise FileNotFoundError(f'{name} not found in {model_name_or_path}')
+        download(model_name_or_path)
+    return path
+
+
+def load_preprocessor_config(model_name_or_path: str = DEFAULT_MODEL) -> dict:
+    """Return the configuration of the image processor of the model, read from the cache."""
+    with open(_cached_file(model_name_or_path, _PREPROCESSOR_NAME)) as f:
+        return json.load(f)
+
+
+def load_preprocessor(model_name_or_path: str = DEFAULT_MODEL):
+    """Build the ViTImagePreprocessor of the model from the cached configuration of its image processor, without
+    transformers."""
+    from models.preprocessing import ViTImagePreprocessor
+    return ViTImagePreprocessor.from_config_dict(load_preprocessor_config(model_name_or_path))
+
+
+def load_vit_config(model_name_or_path: str = DEFAULT_MODEL):
+    """Return the ViTConfig of the model, read from the cache."""
+    from transformers import ViTConfig
+    return ViTConfig.from_json_file(_cached_file(model_name_or_path, _CONFIG_NAME))
+
+
+def build_vit(config, init_weights: bool = True):
+    """Build a ViTMSNModel from a ViTConfig, with random weights, or with uninitialized weights if init_weights is
+    False, that is much faster but requires loading the weights afterwards."""
+    from transformers import ViTMSNModel
+    if init_weights:
+        return ViTMSNModel(config)
+    from transformers.modeling_utils import no_init_weights
+    with no_init_weights():
+        return ViTMSNModel(config)
+
+
+def load_vit(model_name_or_path: str = DEFAULT_MODEL, load_weights: bool = True):
+    """Build the ViTMSNModel of the model from the cache.
+
+    Args:
+        model_name_or_path (str): Name of the model on the Hugging Face hub, or folder with its files.
+        load_weights (bool): If False the model is only built from its configuration, with uninitialized weights,
+        for when they are overwritten by a checkpoint.
+    Returns:
+        ViTMSNModel: The model.
+    """
+    if not load_weights:
+        return build_vit(load_vit_config(model_name_or_path), init_weights=False)
+    from transformers import ViTMSNModel
+    weights_path = _cached_file(model_name_or_path, _WEIGHTS_NAME)
+    return ViTMSNModel.from_pretrained(os.path.dirname(weights_path), local_files_only=True, use_safetensors=True)
+
+
+if __name__ == '__main__':
+
+    sys.path.append(os.path.realpath(__file__ + '/../../'))
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=DEFAULT_MODEL)
+    parser.add_argument('--force', action='store_true', help='download the model also if it is already cached')
+    args = parser.parse_args()
+
+    if args.force or not is_cached(args.model):
+        download(args.model)
+    print(f'{args.model} cached in {model_dir(args.model)}')
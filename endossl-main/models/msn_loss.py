@@ -0,0 +1,119 @@
+import math
+
+import torch
+import torch.nn as nn
+
+
+class MSNLoss(nn.Module):
+    """Loss of the MSN pretraining, computed from the logits of the anchor branch and the sharpened probabilities of
+    the target branch returned by MyViTMSNModel_pretraining:
+
+        cross_entropy(target, anchor) + me_max_weight * ME-MAX + entropy_weight * entropy(anchor)
+
+    All the terms are computed in fp32 from a single log_softmax of the anchor logits, without taking the logarithm of
+    the probabilities: the cross entropy and the entropy are one weighted sum over the log-probabilities, and the
+    average anchor of the ME-MAX is computed in log space with a logsumexp over the batch, so no term needs clamping
+    and all of them stay finite also with logits from a low precision forward.
+
+    With several anchor views for each target, i.e. more anchor rows than target rows, the target is tiled over the
+    views, whose rows are ordered by view as returned by MyViTMSNModel_pretraining.
+
+    Parameters:
+        me_max_weight (float): weight of the ME-MAX regularization, that keeps all the prototypes in use
+        entropy_weight (float): weight of the entropy of the anchor probabilities
+        reduce_fn (function): differentiable average over the processes of the distributed training, such as
+        distributed.all_reduce_mean, used for the average anchor of the ME-MAX; None for a single process
+    """
+    def __init__(self, me_max_weight: float = 5., entropy_weight: float = 1., reduce_fn=None):
+        super(MSNLoss, self).__init__()
+        self.me_max_weight = me_max_weight
+        self.entropy_weight = entropy_weight
+        self.reduce_fn = reduce_fn
+
+    def forward(self, anchor_logits: torch.Tensor, target_probabilities: torch.Tensor) -> torch.Tensor:
+
+        """Return the loss of a batch.
+
+        Parameters:
+            anchor_logits (torch.Tensor): logits of the anchor branch over the prototypes, (num_anchors, K)
+            target_probabilities (torch.Tensor): sharpened probabilities of the target branch, (batch_size, K)
+        Returns:
+            torch.Tensor: the loss
+        """
+
+        log_probs = nn.functional.log_softmax(anchor_logits.float(), dim=1)
+        return self.cross_entropy_and_entropy(log_probs, target_probabilities) + \
+            self.me_max_weight * self.me_max(log_probs)
+
+    def cross_entropy_and_entropy(self, log_probs: torch.Tensor, target_probabilities: torch.Tensor) -> torch.Tensor:
+
+        """Mean over the anchors of the cross entropy with the target plus entropy_weight times the entropy, computed
+        as a single sum -(target + entropy_weight * p) * log(p).
+
+        Parameters:
+            log_probs (torch.Tensor): log-probabilities of the anchor branch
+            target_probabilities (torch.Tensor): probabilities of the target branch
+        Returns:
+            torch.Tensor: the mean over the anchors
+        """
+
+        target = target_probabilities.float()
+        target = target.repeat(log_probs.shape[0] // target.shape[0], 1)
+        return -torch.sum((target + self.entropy_weight * log_probs.exp()) * log_probs, dim=1).mean()
+
+    def me_max(self, log_probs: torch.Tensor) -> torch.Tensor:
+
+        """ME-MAX regularization, sum(p_avg * log(p_avg)) + log(K), with p_avg the average anchor probabilities over
+        the batch, over the batches of all the processes with reduce_fn. The value is 0 when all the prototypes are
+        used equally.
+
+        Parameters:
+            log_probs (torch.Tensor): log-probabilities of the anchor branch
+        Returns:
+            torch.Tensor: the value of the ME-MAX regularization
+        """
+
+        log_avg = torch.logsumexp(log_probs, dim=0) - math.log(log_probs.shape[0])
+        if self.reduce_fn is not None:
+            # average of exp(log_avg) over the processes kept in log space: shifted by the average of log_avg over the
+            # processes, the average of the exponentials is at least 1 (Jensen), so the logarithm needs no clamping
+            shift = self.reduce_fn(log_avg.detach().double())
+            log_avg = (torch.log(self.reduce_fn((log_avg.double() - shift).exp())) + shift).float()
+        return torch.sum(log_avg.exp() * log_avg) + math.log(log_probs.shape[1])
+
+    def me_max_linearization(self, avg_anchor: torch.Tensor) -> (torch.Tensor, torch.Tensor):
+
+        """Value of the ME-MAX for the average anchor of a whole batch and its gradient with respect to the average
+        anchor, log(p_avg) + 1, used for accumulating the gradients over micro-batches, see micro_batch_loss.
+
+        Parameters:
+            avg_anchor (torch.Tensor): average anchor probabilities of the whole batch, over all the processes
+        Returns:
+            (torch.Tensor, torch.Tensor): the ME-MAX value and its gradient
+        """
+
+        log_avg = torch.log(avg_anchor.float().clamp_min(1e-12))
+        return torch.sum(avg_anchor * log_avg) + math.log(len(avg_anchor)), log_avg + 1.
+
+    def micro_batch_loss(self, anchor_logits: torch.Tensor, target_probabilities: torch.Tensor,
+                         me_max_grad: torch.Tensor, num_anchors: int) -> (torch.Tensor, torch.Tensor):
+
+        """Loss of a micro-batch of a batch of num_anchors anchors, whose gradients summed over the micro-batches are
+        the gradients of the loss of the whole batch. The cross entropy and the entropy are scaled by the share of the
+        anchors of the micro-batch, while the ME-MAX, that depends on the average anchor of the whole batch, is
+        replaced by its linear term sum(p * me_max_grad) / num_anchors.
+
+        Parameters:
+            anchor_logits (torch.Tensor): logits of the anchor branch of the micro-batch
+            target_probabilities (torch.Tensor): probabilities of the target branch of the micro-batch
+            me_max_grad (torch.Tensor): gradient of the ME-MAX returned by me_max_linearization
+            num_anchors (int): number of anchors of the whole batch
+        Returns:
+            (torch.Tensor, torch.Tensor): the loss for the backward and the part of the batch loss of the micro-batch,
+            i.e. without the ME-MAX
+        """
+
+        log_probs = nn.functional.log_softmax(anchor_logits.float(), dim=1)
+        micro_loss = log_probs.shape[0] / num_anchors * self.cross_entropy_and_entropy(log_probs, target_probabilities)
+        me_max_term = self.me_max_weight * torch.sum(log_probs.exp() * me_max_grad) / num_anchors
+        return micro_loss + me_max_term, micro_loss
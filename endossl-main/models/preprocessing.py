@@ -0,0 +1,104 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class ViTImagePreprocessor(nn.Module):
+    """Torch implementation of the resize and normalization applied by the Hugging Face ViT image processor. All the
+    operations are executed on tensors, on the same device of the module, so the batches never go back to the host and
+    through NumPy during the forward. The mean and the standard deviation are saved as non persistent buffers, in this
+    way they follow the model with .to(device) without changing its state dict.
+
+    Args:
+        image_mean (list): Mean of each channel used for the normalization.
+        image_std (list): Standard deviation of each channel used for the normalization.
+        size (tuple): Height and width of the output images.
+        do_resize (bool): If True, the images with a different size are resized with an antialiased bilinear
+        interpolation, as the PIL resize of the image processor.
+        do_rescale (bool): If True, the images are multiplied by rescale_factor before the normalization.
+        rescale_factor (float): Rescale factor, default is 1/255.
+        do_normalize (bool): If True, the images are normalized with image_mean and image_std.
+    """
+    def __init__(self, image_mean, image_std, size=(224, 224), do_resize=True, do_rescale=False,
+                 rescale_factor=1 / 255, do_normalize=True):
+        super(ViTImagePreprocessor, self).__init__()
+        self.size = tuple(size)
+        self.do_resize = do_resize
+        self.do_rescale = do_rescale
+        self.rescale_factor = rescale_factor
+        self.do_normalize = do_normalize
+        self.register_buffer('image_mean', torch.tensor(image_mean, dtype=torch.float32).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('image_std', torch.tensor(image_std, dtype=torch.float32).view(1, -1, 1, 1), persistent=False)
+
+    @classmethod
+    def from_image_processor(cls, image_processor, do_rescale: bool = False):
+        """Build the module with the parameters of a Hugging Face image processor. As in the models of this project
+        the default is to not rescale the images, that is the processor called with do_rescale=False."""
+        size = image_processor.size
+        return cls(image_mean=image_processor.image_mean,
+                   image_std=image_processor.image_std,
+                   size=(size['height'], size['width']),
+                   do_resize=image_processor.do_resize,
+                   do_rescale=do_rescale,
+                   rescale_factor=image_processor.rescale_factor,
+                   do_normalize=image_processor.do_normalize)
+
+    @classmethod
+    def from_config_dict(cls, config: dict, do_rescale: bool = False):
+        """Build the module from the dictionary saved in the preprocessor_config.json file of a Hugging Face image
+        processor, without transformers. As in from_image_processor the images are not rescaled by default."""
+        size = config.get('size', 224)
+        if isinstance(size, int):
+            size = {'height': size, 'width': size}
+        return cls(image_mean=config['image_mean'],
+                   image_std=config['image_std'],
+                   size=(size['height'], size['width']),
+                   do_resize=config.get('do_resize', True),
+                   do_rescale=do_rescale,
+                   rescale_factor=config.get('rescale_factor', 1 / 255),
+                   do_normalize=config.get('do_normalize', True))
+
+    def forward(self, images: torch.Tensor, resize: bool = True) -> torch.Tensor:
+        """Preprocess a batch of images (B, C, H, W), returning a float32 tensor.
+
+        Args:
+            images (torch.Tensor): Batch of images, uint8 or float.
+            resize (bool): If False the images are never resized, used for the views that have a different resolution.
+        """
+        is_uint8 = images.dtype == torch.uint8
+        images = images.to(torch.float32)
+
+        if resize and self.do_resize and tuple(images.shape[-2:]) != self.size:
+            images = F.interpolate(images, size=self.size, mode='bilinear', align_corners=False, antialias=True)
+            if is_uint8:
+                # the image processor resizes uint8 images with PIL, that rounds the result to integers
+                images = images.round().clamp(0, 255)
+        if self.do_rescale:
+            images = images * self.rescale_factor
+        if self.do_normalize:
+            images = (images - self.image_mean) / self.image_std
+        return images
+
+
+def check_against_processor(preprocessor: ViTImagePreprocessor, image_processor, images: torch.Tensor) -> float:
+    """Return the maximum absolute difference between the output of the module and the output of the Hugging Face
+    image processor, called as in the models of this project, for the batch of images in input."""
+    expected = image_processor(images, do_rescale=preprocessor.do_rescale, return_tensors='pt')['pixel_values']
+    with torch.no_grad():
+        output = preprocessor(images.to(preprocessor.image_mean.device)).cpu()
+    return (output - expected).abs().max().item()
+
+
+if __name__ == '__main__':
+
+    """Numerical check of the module against the image processor of the 'facebook/vit-msn-small' model."""
+
+    from transformers import AutoImageProcessor
+
+    image_processor = AutoImageProcessor.from_pretrained('facebook/vit-msn-small')
+    preprocessor = ViTImagePreprocessor.from_image_processor(image_processor)
+
+    images = torch.randint(0, 256, (8, 3, 224, 224), dtype=torch.uint8)
+    print('Max difference for 224x224 frames: ', check_against_processor(preprocessor, image_processor, images))
+    images = torch.randint(0, 256, (8, 3, 480, 854), dtype=torch.uint8)
+    print('Max difference for resized frames: ', check_against_processor(preprocessor, image_processor, images))